@@ -8,5 +8,6 @@ from .ai_chatgpt import ChatGPT
 from .ai_deepseek import DeepSeek
 from .ai_kimi import Kimi
 from .ai_perplexity import Perplexity
+from .openai_compatible import OpenAICompatibleProvider
 
-__all__ = ["ChatGPT", "DeepSeek", "Kimi", "Perplexity"]
+__all__ = ["ChatGPT", "DeepSeek", "Kimi", "Perplexity", "OpenAICompatibleProvider"]
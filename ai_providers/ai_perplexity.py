@@ -8,7 +8,9 @@ import time
 from typing import Optional, Dict, Callable, List
 import os
 from threading import Thread, Lock
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+
+from function.func_cancel import ToolCancelled, request_timeout
 
 
 class PerplexityThread(Thread):
@@ -319,6 +321,7 @@ class Perplexity:
         
         # 创建OpenAI客户端
         self.client = None
+        self._async_client = None  # 仅在 asyncio 运行时下按需创建
         if self.api_key:
             try:
                 self.client = OpenAI(
@@ -344,6 +347,51 @@ class Perplexity:
             return all(value is not None for key, value in args.items() if key != 'proxy')
         return False
         
+    @property
+    def async_client(self) -> Optional[AsyncOpenAI]:
+        if self._async_client is None and self.api_key:
+            # 代理已在初始化时通过环境变量设置，异步客户端同样生效
+            self._async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.api_base)
+        return self._async_client
+
+    def _select_model(self, deep_research: bool) -> str:
+        model = self.model_reasoning if (deep_research and self.has_reasoning_model) else self.model_flash or self.config.get('model', 'sonar')
+        if deep_research and self.has_reasoning_model:
+            self.LOG.info(f"Perplexity启动深度研究模式，使用模型: {model}")
+        return model
+
+    @staticmethod
+    def _timeout_kwargs() -> dict:
+        """作为 Agent 工具调用时，请求超时不超过该工具调用剩余的时间"""
+        timeout = request_timeout()
+        return {"timeout": timeout} if timeout is not None else {}
+
+    async def get_answer_async(self, prompt, session_id=None, deep_research: bool = False):
+        """get_answer 的异步版本，供 asyncio 运行时下的工具调用使用"""
+        try:
+            if not self.api_key or not self.async_client:
+                return "Perplexity API key 未配置或客户端初始化失败"
+
+            messages = [
+                {"role": "system", "content": self.prompt},
+                {"role": "user", "content": prompt}
+            ]
+            model = self._select_model(deep_research)
+            self.LOG.info(f"发送到Perplexity的消息: {json.dumps(messages, ensure_ascii=False)}")
+
+            response = await self.async_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                **self._timeout_kwargs()
+            )
+            return response.choices[0].message.content
+
+        except ToolCancelled:
+            raise
+        except Exception as e:
+            self.LOG.error(f"异步调用Perplexity API时发生错误: {str(e)}")
+            return f"发生错误: {str(e)}"
+
     def get_answer(self, prompt, session_id=None, deep_research: bool = False):
         """获取Perplexity回答
         
@@ -365,9 +413,7 @@ class Perplexity:
             ]
             
             # 获取模型
-            model = self.model_reasoning if (deep_research and self.has_reasoning_model) else self.model_flash or self.config.get('model', 'sonar')
-            if deep_research and self.has_reasoning_model:
-                self.LOG.info(f"Perplexity启动深度研究模式，使用模型: {model}")
+            model = self._select_model(deep_research)
             
             # 使用json序列化确保正确处理Unicode
             self.LOG.info(f"发送到Perplexity的消息: {json.dumps(messages, ensure_ascii=False)}")
@@ -375,12 +421,15 @@ class Perplexity:
             # 创建聊天完成
             response = self.client.chat.completions.create(
                 model=model,
-                messages=messages
+                messages=messages,
+                **self._timeout_kwargs()
             )
             
             # 返回回答内容
             return response.choices[0].message.content
                 
+        except ToolCancelled:
+            raise
         except Exception as e:
             self.LOG.error(f"调用Perplexity API时发生错误: {str(e)}")
             return f"发生错误: {str(e)}"
@@ -0,0 +1,706 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""OpenAI 兼容接口的公共实现
+
+ChatGPT、DeepSeek、Kimi 都通过 OpenAI SDK 调用 chat.completions，
+系统提示/时间提示/历史消息的组装、按 token 预算注入历史、以及工具调用循环都在这里实现一次；
+各家的差异（默认模型与接口地址、reasoning_content、回复后处理等）通过类属性和钩子方法覆盖。
+
+三家服务端都会缓存请求的公共前缀 (prompt caching)，命中部分计费更低、首字更快。
+因此消息按稳定程度排列：系统提示（含人设、工具指引）→ 早期摘要 → 历史消息 → 当前时间 → 本轮问题，
+每秒都在变化的时间提示放在最后，不会让前面的内容失去缓存。
+
+同一轮返回的多个工具调用互不依赖，各自在独立线程中并发执行，结果仍按调用顺序写回消息。
+每个工具调用有独立的超时，整轮对话还可以设置时间预算 (time_budget)：
+超时的调用通过 CancelToken 协作取消，预算用完后不再调用工具，由模型根据已有信息直接回答。
+
+传入 stream_handler 时以 stream=True 请求，回复文本的增量逐段交给 stream_handler.feed，
+由调用方边生成边发送；工具调用的增量在本地拼接后照常执行工具循环。
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from openai import APIConnectionError, APIError, AuthenticationError, AsyncOpenAI, OpenAI
+
+from function.func_cancel import CancelToken, ToolCancelled, use_token
+from function.func_tokens import context_window_for, history_token_budget
+
+try:
+    from function.func_summary import MessageSummary
+except ImportError:  # pragma: no cover - fallback when typing
+    MessageSummary = object
+
+DEFAULT_TOOL_TIMEOUT = 60.0  # 单个工具调用的最长等待秒数
+FINAL_ANSWER_TIMEOUT = 30.0  # 时间预算用完后，最后一次回答请求的超时秒数
+
+
+def _run_in_thread(fn, *args) -> Future:
+    """在新的守护线程中执行 fn(*args)，继承当前的 contextvars
+
+    不使用共享线程池：超时的调用无法中断，会一直占着所在线程，
+    放在共享池里会让其他会话的调用排队，还没开始就被判定超时。
+    """
+    future: Future = Future()
+    context = contextvars.copy_context()
+
+    def runner():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(context.run(fn, *args))
+        except BaseException as exc:
+            future.set_exception(exc)
+
+    threading.Thread(target=runner, name="ToolCall", daemon=True).start()
+    return future
+
+
+class OpenAICompatibleProvider:
+    """OpenAI 兼容 chat.completions 服务的基类"""
+
+    provider_name = "OpenAI"
+    default_api: Optional[str] = None
+    default_model = "gpt-3.5-turbo"
+    default_prompt = "You are a helpful assistant."
+    default_max_history_messages = 30
+    request_params: dict = {}  # 每次请求附带的额外参数
+    collapse_blank_lines = False  # 是否去掉回复开头的空行并把连续空行合并为单个换行
+    tool_limit_message = "你已经达到允许的最大工具调用次数，请根据现有信息直接给出最终回答。"
+    budget_exhausted_message = "本次回答的时间预算已经用完，请不要再调用工具，根据目前已获得的信息直接给出最终回答。"
+    supports_streaming = True  # 是否支持 stream_handler 增量输出
+    stream_include_usage = True  # 流式请求是否附带 stream_options.include_usage 以获取用量
+
+    def __init__(self, conf: dict, message_summary_instance: MessageSummary = None, bot_wxid: str = None) -> None:
+        key = conf.get("key")
+        api = conf.get("api", self.default_api)
+        proxy = conf.get("proxy")
+        prompt = conf.get("prompt")
+        self.model = conf.get("model", self.default_model)
+        self.max_history_messages = conf.get("max_history_messages", self.default_max_history_messages)
+        # 上下文窗口 (token)，未配置时按模型名推断，历史消息按剩余 token 预算装填
+        self.context_window = int(conf.get("context_window") or context_window_for(self.model))
+        self.LOG = logging.getLogger(self.provider_name)
+
+        self.message_summary = message_summary_instance
+        self.bot_wxid = bot_wxid
+        if not self.message_summary:
+            self.LOG.warning(f"MessageSummary 实例未提供给 {self.provider_name}，上下文功能将不可用！")
+        if not self.bot_wxid:
+            self.LOG.warning(f"bot_wxid 未提供给 {self.provider_name}，可能无法正确识别机器人自身消息！")
+
+        if proxy:
+            self.client = OpenAI(api_key=key, base_url=api, http_client=httpx.Client(proxy=proxy))
+        else:
+            self.client = OpenAI(api_key=key, base_url=api)
+        self._client_args = (key, api, proxy)
+        self._async_client = None  # 仅在 asyncio 运行时下按需创建
+
+        self.system_content_msg = {"role": "system", "content": prompt or self.default_prompt}
+
+        # 服务端前缀缓存的命中统计，来自每次响应的 usage 字段
+        self._usage_lock = threading.Lock()
+        self._usage = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+    def __repr__(self):
+        return self.provider_name
+
+    @staticmethod
+    def value_check(conf: dict) -> bool:
+        return bool(conf and conf.get("key"))
+
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        if self._async_client is None:
+            key, api, proxy = self._client_args
+            if proxy:
+                self._async_client = AsyncOpenAI(api_key=key, base_url=api, http_client=httpx.AsyncClient(proxy=proxy))
+            else:
+                self._async_client = AsyncOpenAI(api_key=key, base_url=api)
+        return self._async_client
+
+    def get_answer(
+        self,
+        question: str,
+        wxid: str,
+        system_prompt_override=None,
+        specific_max_history=None,
+        tools=None,
+        tool_handler=None,
+        tool_choice=None,
+        tool_max_iterations: int = 10,
+        stream_handler=None,
+        tool_timeout: Optional[float] = DEFAULT_TOOL_TIMEOUT,
+        tool_timeouts: Optional[Dict[str, float]] = None,
+        time_budget: Optional[float] = None
+    ) -> str:
+        api_messages = self._build_api_messages(question, wxid, system_prompt_override, specific_max_history)
+
+        if tools and not tool_handler:
+            # 如果提供了工具但没有处理器，则忽略工具以避免陷入死循环
+            self.LOG.warning(f"{self.provider_name}: 提供了 tools 但没有 tool_handler，忽略工具定义。")
+            tools = None
+
+        try:
+            response_text, reasoning_text = self._execute_with_tools(
+                api_messages=api_messages,
+                tools=tools,
+                tool_handler=tool_handler,
+                tool_choice=tool_choice,
+                tool_max_iterations=tool_max_iterations,
+                stream_handler=stream_handler,
+                tool_timeout=tool_timeout,
+                tool_timeouts=tool_timeouts,
+                time_budget=time_budget
+            )
+            return self._format_answer(response_text, reasoning_text)
+
+        except (AuthenticationError, APIConnectionError, APIError) as e:
+            self.LOG.error(f"{self.provider_name} API 调用失败: {e}")
+            raise
+        except Exception as e:
+            self.LOG.error(f"{self.provider_name} 未知错误: {e}", exc_info=True)
+            raise
+
+    async def get_answer_async(
+        self,
+        question: str,
+        wxid: str,
+        system_prompt_override=None,
+        specific_max_history=None,
+        tools=None,
+        tool_handler=None,
+        tool_choice=None,
+        tool_max_iterations: int = 10,
+        stream_handler=None,
+        tool_timeout: Optional[float] = DEFAULT_TOOL_TIMEOUT,
+        tool_timeouts: Optional[Dict[str, float]] = None,
+        time_budget: Optional[float] = None
+    ) -> str:
+        """get_answer 的异步版本，使用 AsyncOpenAI 客户端，tool_handler 可以是协程函数
+
+        stream_handler.feed 在事件循环上调用，不能阻塞。
+        """
+        # 历史记录读取 SQLite，放到线程池中执行，避免阻塞事件循环
+        api_messages = await asyncio.to_thread(
+            self._build_api_messages, question, wxid, system_prompt_override, specific_max_history
+        )
+
+        if tools and not tool_handler:
+            self.LOG.warning(f"{self.provider_name}: 提供了 tools 但没有 tool_handler，忽略工具定义。")
+            tools = None
+
+        try:
+            response_text, reasoning_text = await self._execute_with_tools_async(
+                api_messages=api_messages,
+                tools=tools,
+                tool_handler=tool_handler,
+                tool_choice=tool_choice,
+                tool_max_iterations=tool_max_iterations,
+                stream_handler=stream_handler,
+                tool_timeout=tool_timeout,
+                tool_timeouts=tool_timeouts,
+                time_budget=time_budget
+            )
+            return self._format_answer(response_text, reasoning_text)
+
+        except (AuthenticationError, APIConnectionError, APIError) as e:
+            self.LOG.error(f"{self.provider_name} API 异步调用失败: {e}")
+            raise
+        except Exception as e:
+            self.LOG.error(f"{self.provider_name} 异步调用未知错误: {e}", exc_info=True)
+            raise
+
+    # ---- 提示组装 ----
+
+    def _build_api_messages(self, question, wxid, system_prompt_override=None, specific_max_history=None) -> list:
+        """按稳定程度组装：系统提示、历史消息（含早期摘要）、当前时间、本轮问题"""
+        api_messages = self._system_messages(system_prompt_override)
+        tail_messages = self._volatile_messages()
+        if question:
+            tail_messages.append({"role": "user", "content": question})
+
+        if self.message_summary and self.bot_wxid:
+            api_messages.extend(self._history_messages(wxid, specific_max_history, api_messages + tail_messages))
+        else:
+            self.LOG.warning(f"无法为 wxid={wxid} 获取历史记录，因为 message_summary 或 bot_wxid 未设置。")
+
+        api_messages.extend(tail_messages)
+        return api_messages
+
+    def _system_messages(self, system_prompt_override=None) -> list:
+        """系统提示，同一会话的每次请求中保持不变"""
+        effective_system_prompt = system_prompt_override if system_prompt_override else self.system_content_msg["content"]
+        if effective_system_prompt:
+            return [{"role": "system", "content": effective_system_prompt}]
+        return []
+
+    def _volatile_messages(self) -> list:
+        """每次请求都会变化的提示，放在历史消息之后"""
+        now_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        return [{"role": "system", "content": f"Current time is: {now_time}"}]
+
+    def _history_messages(self, wxid, specific_max_history, fixed_messages) -> list:
+        """读取历史消息（使用上下文压缩），按角色转换为 API 消息
+
+        Args:
+            wxid: 聊天 ID
+            specific_max_history: 本次调用的历史条数上限，None 表示使用配置值
+            fixed_messages: 一定会发送的消息，从上下文窗口中扣除后剩余的 token 留给历史
+        """
+        limit_to_use = specific_max_history if specific_max_history is not None else self.max_history_messages
+        try:
+            limit_to_use = int(limit_to_use) if limit_to_use is not None else None
+        except (TypeError, ValueError):
+            limit_to_use = self.max_history_messages
+
+        if limit_to_use == 0:
+            return []
+
+        if hasattr(self.message_summary, 'get_compressed_context'):
+            token_budget = history_token_budget(
+                self.message_summary.token_counter, self.context_window, fixed_messages
+            )
+            history, context_summary = self.message_summary.get_compressed_context(
+                wxid, max_recent=limit_to_use, max_context_tokens=token_budget
+            )
+        else:
+            history = self.message_summary.get_messages(wxid)
+            if limit_to_use and limit_to_use > 0:
+                history = history[-limit_to_use:]
+            context_summary = None
+
+        messages = []
+        if context_summary:
+            messages.append({"role": "system", "content": f"Earlier conversation context:\n{context_summary}"})
+
+        for msg in history:
+            content = msg.get("content") or ""
+            if not content:
+                continue
+            if msg.get("sender_wxid") == self.bot_wxid:
+                messages.append({"role": "assistant", "content": content})
+            else:
+                sender_name = msg.get("sender", "未知用户")
+                messages.append({"role": "user", "content": f"{sender_name}: {content}"})
+        return messages
+
+    # ---- 工具调用循环 ----
+
+    def _execute_with_tools(
+        self,
+        api_messages,
+        tools=None,
+        tool_handler=None,
+        tool_choice=None,
+        tool_max_iterations: int = 10,
+        stream_handler=None,
+        tool_timeout: Optional[float] = DEFAULT_TOOL_TIMEOUT,
+        tool_timeouts: Optional[Dict[str, float]] = None,
+        time_budget: Optional[float] = None
+    ) -> Tuple[str, str]:
+        """执行带工具调用的对话逻辑，返回 (回复文本, 推理内容)
+
+        time_budget 是整轮对话（含多轮工具调用）的秒数预算，用完后取消进行中的工具调用，
+        不再允许调用工具，并提示模型根据已有信息直接回答。
+        """
+        iterations = 0
+        runtime_tools = tools if tools and isinstance(tools, list) else None
+        runtime_tool_choice = tool_choice
+        reasoning_segments: List[str] = []
+        streaming = stream_handler is not None and self.supports_streaming
+        budget = CancelToken(time_budget) if time_budget else None
+        finalizing = False
+        started = time.monotonic()
+
+        while True:
+            if runtime_tools and not finalizing and self._budget_exhausted(api_messages, budget, started):
+                finalizing = True
+                runtime_tool_choice = "none"
+            step_started = time.monotonic()
+            params = self._request_params(api_messages, runtime_tools, runtime_tool_choice, budget)
+            if streaming:
+                reply = _StreamedReply()
+                for chunk in self.client.chat.completions.create(**self._stream_params(params)):
+                    text = reply.add(chunk)
+                    if text:
+                        stream_handler.feed(text)
+                response = reply
+            else:
+                response = self.client.chat.completions.create(**params)
+            model_elapsed = time.monotonic() - step_started
+            self._record_usage(response)
+            message, finish_reason = response.choices[0].message, response.choices[0].finish_reason
+            reasoning_segments.append(self._extract_reasoning_text(message))
+
+            if finalizing or not self._wants_tools(message, finish_reason, runtime_tools, tool_handler):
+                self._log_agent_finished(iterations, started, model_elapsed)
+                return self._final_text(message, reasoning_segments)
+            if streaming:
+                stream_handler.discard()  # 工具调用前的铺垫文字不单独发送
+
+            iterations += 1
+            if self._append_tool_request(api_messages, message, iterations, tool_max_iterations):
+                runtime_tool_choice = "none"
+                continue
+
+            tool_started = time.monotonic()
+            tool_outputs = self._run_tool_calls(message.tool_calls, tool_handler, tool_timeout, tool_timeouts, budget)
+            for tool_call, tool_output in zip(message.tool_calls, tool_outputs):
+                self._append_tool_result(api_messages, tool_call, tool_output)
+            self._log_agent_step(iterations, model_elapsed, message.tool_calls, time.monotonic() - tool_started)
+
+            runtime_tool_choice = None
+
+    async def _execute_with_tools_async(
+        self,
+        api_messages,
+        tools=None,
+        tool_handler=None,
+        tool_choice=None,
+        tool_max_iterations: int = 10,
+        stream_handler=None,
+        tool_timeout: Optional[float] = DEFAULT_TOOL_TIMEOUT,
+        tool_timeouts: Optional[Dict[str, float]] = None,
+        time_budget: Optional[float] = None
+    ) -> Tuple[str, str]:
+        """_execute_with_tools 的异步版本；同步的 tool_handler 在独立线程中执行，同一轮的工具调用并发等待"""
+        iterations = 0
+        runtime_tools = tools if tools and isinstance(tools, list) else None
+        runtime_tool_choice = tool_choice
+        reasoning_segments: List[str] = []
+        streaming = stream_handler is not None and self.supports_streaming
+        budget = CancelToken(time_budget) if time_budget else None
+        finalizing = False
+        started = time.monotonic()
+
+        while True:
+            if runtime_tools and not finalizing and self._budget_exhausted(api_messages, budget, started):
+                finalizing = True
+                runtime_tool_choice = "none"
+            step_started = time.monotonic()
+            params = self._request_params(api_messages, runtime_tools, runtime_tool_choice, budget)
+            if streaming:
+                reply = _StreamedReply()
+                async for chunk in await self.async_client.chat.completions.create(**self._stream_params(params)):
+                    text = reply.add(chunk)
+                    if text:
+                        stream_handler.feed(text)
+                response = reply
+            else:
+                response = await self.async_client.chat.completions.create(**params)
+            model_elapsed = time.monotonic() - step_started
+            self._record_usage(response)
+            message, finish_reason = response.choices[0].message, response.choices[0].finish_reason
+            reasoning_segments.append(self._extract_reasoning_text(message))
+
+            if finalizing or not self._wants_tools(message, finish_reason, runtime_tools, tool_handler):
+                self._log_agent_finished(iterations, started, model_elapsed)
+                return self._final_text(message, reasoning_segments)
+            if streaming:
+                stream_handler.discard()
+
+            iterations += 1
+            if self._append_tool_request(api_messages, message, iterations, tool_max_iterations):
+                runtime_tool_choice = "none"
+                continue
+
+            tool_started = time.monotonic()
+            tool_outputs = await asyncio.gather(*(
+                self._run_tool_call_async(
+                    tool_call, tool_handler, self._tool_token(tool_call.function.name, tool_timeout, tool_timeouts, budget)
+                )
+                for tool_call in message.tool_calls
+            ))
+            for tool_call, tool_output in zip(message.tool_calls, tool_outputs):
+                self._append_tool_result(api_messages, tool_call, tool_output)
+            self._log_agent_step(iterations, model_elapsed, message.tool_calls, time.monotonic() - tool_started)
+
+            runtime_tool_choice = None
+
+    def _request_params(self, api_messages, runtime_tools, runtime_tool_choice, budget=None) -> dict:
+        params = {"model": self.model, **self.request_params, "messages": api_messages}
+        if runtime_tools:
+            params["tools"] = runtime_tools
+            if runtime_tool_choice:
+                params["tool_choice"] = runtime_tool_choice
+        if budget is not None:
+            # 预算快用完时仍给最后一次回答留出 FINAL_ANSWER_TIMEOUT 秒
+            params["timeout"] = max(budget.remaining(), FINAL_ANSWER_TIMEOUT)
+        return params
+
+    def _budget_exhausted(self, api_messages, budget, started) -> bool:
+        """对话时间预算用完时追加收尾提示并返回 True"""
+        if budget is None or not budget.cancelled:
+            return False
+        budget.cancel("time budget exhausted")
+        self.LOG.warning(f"Agent 已耗时 {time.monotonic() - started:.1f}s，超出时间预算，停止调用工具并直接回答")
+        api_messages.append({"role": "system", "content": self.budget_exhausted_message})
+        return True
+
+    def _log_agent_step(self, iterations, model_elapsed, tool_calls, tools_elapsed) -> None:
+        tool_names = [tool_call.function.name for tool_call in tool_calls]
+        self.LOG.info(f"Agent 第 {iterations} 步: 模型 {model_elapsed:.1f}s，工具 {tool_names} {tools_elapsed:.1f}s")
+
+    def _log_agent_finished(self, iterations, started, model_elapsed) -> None:
+        if iterations:
+            self.LOG.info(
+                f"Agent 完成: {iterations} 步工具调用，最终回答 {model_elapsed:.1f}s，总耗时 {time.monotonic() - started:.1f}s"
+            )
+
+    def _stream_params(self, params) -> dict:
+        params = {**params, "stream": True}
+        if self.stream_include_usage:
+            params["stream_options"] = {"include_usage": True}
+        return params
+
+    @staticmethod
+    def _wants_tools(message, finish_reason, runtime_tools, tool_handler) -> bool:
+        return bool(
+            runtime_tools
+            and message
+            and getattr(message, "tool_calls", None)
+            and finish_reason == "tool_calls"
+            and tool_handler
+        )
+
+    def _append_tool_request(self, api_messages, message, iterations, tool_max_iterations) -> bool:
+        """记录模型发起的工具调用；超过最大轮数时追加停止提示并返回 True"""
+        api_messages.append({
+            "role": "assistant",
+            "content": message.content or "",
+            "tool_calls": [
+                {
+                    "id": tool_call.id,
+                    "type": "function",
+                    "function": {"name": tool_call.function.name, "arguments": tool_call.function.arguments or ""},
+                }
+                for tool_call in message.tool_calls
+            ]
+        })
+        if tool_max_iterations is not None and iterations > max(tool_max_iterations, 0):
+            api_messages.append({"role": "system", "content": self.tool_limit_message})
+            return True
+        return False
+
+    @staticmethod
+    def _parse_tool_call(tool_call):
+        raw_arguments = tool_call.function.arguments or "{}"
+        try:
+            parsed_arguments = json.loads(raw_arguments)
+        except json.JSONDecodeError:
+            parsed_arguments = {"_raw": raw_arguments}
+        return tool_call.function.name, parsed_arguments
+
+    @staticmethod
+    def _tool_token(tool_name, tool_timeout, tool_timeouts, budget) -> CancelToken:
+        """单个工具调用的取消标记：按工具名取超时，并受整轮对话预算约束"""
+        timeout = (tool_timeouts or {}).get(tool_name, tool_timeout)
+        return budget.child(timeout) if budget is not None else CancelToken(timeout)
+
+    def _run_tool_calls(self, tool_calls, tool_handler, tool_timeout, tool_timeouts=None, budget=None) -> List[str]:
+        """执行同一轮的全部工具调用，返回与 tool_calls 顺序一致的结果
+
+        只有一个调用时直接在当前线程执行，超时由工具内部按 token 协作处理；
+        多个调用各自在新线程中并发执行，不经过共享线程池，因此不会因排队而消耗超时时间。
+        线程中的调用无法强制中断，超时后取消其 token（工具内部据此提前结束），并返回超时信息。
+        """
+        parsed_calls = [self._parse_tool_call(tool_call) for tool_call in tool_calls]
+        if len(parsed_calls) == 1:
+            tool_name, parsed_arguments = parsed_calls[0]
+            token = self._tool_token(tool_name, tool_timeout, tool_timeouts, budget)
+            return [self._call_tool(tool_handler, tool_name, parsed_arguments, token)]
+
+        tokens = []
+        futures = []
+        for tool_name, parsed_arguments in parsed_calls:
+            token = self._tool_token(tool_name, tool_timeout, tool_timeouts, budget)
+            tokens.append(token)
+            futures.append(_run_in_thread(self._call_tool, tool_handler, tool_name, parsed_arguments, token))
+        outputs = []
+        for (tool_name, _), token, future in zip(parsed_calls, tokens, futures):
+            try:
+                outputs.append(future.result(timeout=token.remaining()))
+            except FutureTimeoutError:
+                token.cancel("timeout")
+                outputs.append(self._tool_timeout_output(tool_name))
+        return outputs
+
+    def _call_tool(self, tool_handler, tool_name, parsed_arguments, token):
+        with use_token(token):
+            try:
+                token.raise_if_cancelled()  # 整轮预算可能已经用完
+                return tool_handler(tool_name, parsed_arguments)
+            except ToolCancelled:
+                return self._tool_timeout_output(tool_name)
+            except Exception as handler_exc:
+                return self._tool_error_output(tool_name, handler_exc)
+
+    async def _run_tool_call_async(self, tool_call, tool_handler, token):
+        tool_name, parsed_arguments = self._parse_tool_call(tool_call)
+        with use_token(token):
+            try:
+                token.raise_if_cancelled()
+                if asyncio.iscoroutinefunction(tool_handler):
+                    pending = tool_handler(tool_name, parsed_arguments)
+                else:
+                    pending = asyncio.wrap_future(_run_in_thread(tool_handler, tool_name, parsed_arguments))
+                return await asyncio.wait_for(pending, token.remaining())
+            except (asyncio.TimeoutError, ToolCancelled):
+                token.cancel("timeout")
+                return self._tool_timeout_output(tool_name)
+            except Exception as handler_exc:
+                return self._tool_error_output(tool_name, handler_exc)
+
+    def _tool_timeout_output(self, tool_name) -> str:
+        self.LOG.warning(f"工具 {tool_name} 超时未返回，已取消")
+        return json.dumps({"error": f"{tool_name} timed out"}, ensure_ascii=False)
+
+    def _tool_error_output(self, tool_name, handler_exc) -> str:
+        self.LOG.error(f"工具 {tool_name} 执行失败: {handler_exc}", exc_info=True)
+        return json.dumps({"error": f"{tool_name} failed: {handler_exc.__class__.__name__}"}, ensure_ascii=False)
+
+    @staticmethod
+    def _append_tool_result(api_messages, tool_call, tool_output) -> None:
+        if not isinstance(tool_output, str):
+            tool_output = json.dumps(tool_output, ensure_ascii=False)
+        api_messages.append({
+            "role": "tool",
+            "tool_call_id": tool_call.id,
+            "content": tool_output
+        })
+
+    # ---- 前缀缓存统计 ----
+
+    def _record_usage(self, response) -> None:
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        cached_tokens = self._cached_prompt_tokens(usage)
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        with self._usage_lock:
+            self._usage["requests"] += 1
+            self._usage["prompt_tokens"] += prompt_tokens
+            self._usage["cached_tokens"] += cached_tokens
+            self._usage["completion_tokens"] += completion_tokens
+        self.LOG.debug(f"{self.model} 用量: 输入={prompt_tokens} (缓存命中 {cached_tokens}), 输出={completion_tokens}")
+
+    @staticmethod
+    def _cached_prompt_tokens(usage) -> int:
+        """从 usage 中读取命中前缀缓存的输入 token 数，各家字段不同"""
+        details = getattr(usage, "prompt_tokens_details", None)  # OpenAI
+        cached = getattr(details, "cached_tokens", None) if details is not None else None
+        if cached is None:
+            cached = getattr(usage, "prompt_cache_hit_tokens", None)  # DeepSeek
+        if cached is None:
+            cached = getattr(usage, "cached_tokens", None)  # Moonshot
+        if cached is None and isinstance(getattr(usage, "model_extra", None), dict):
+            # SDK 未声明的字段保存在 model_extra 中
+            extra = usage.model_extra
+            cached = extra.get("prompt_cache_hit_tokens", extra.get("cached_tokens"))
+        try:
+            return int(cached or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    def get_usage_stats(self) -> Dict[str, float]:
+        """返回累计的 token 用量与前缀缓存命中率"""
+        with self._usage_lock:
+            stats = dict(self._usage)
+        stats["cache_hit_rate"] = stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+        return stats
+
+    def log_usage_stats(self) -> None:
+        stats = self.get_usage_stats()
+        if not stats["requests"]:
+            return
+        self.LOG.info(
+            f"{self.model} 用量统计: 请求={stats['requests']}, 输入={stats['prompt_tokens']}, "
+            f"缓存命中={stats['cached_tokens']} ({stats['cache_hit_rate']:.1%}), 输出={stats['completion_tokens']}"
+        )
+
+    # ---- 回复处理钩子 ----
+
+    def _final_text(self, message, reasoning_segments) -> Tuple[str, str]:
+        response_text = message.content if message and message.content else ""
+        if self.collapse_blank_lines:
+            if response_text.startswith("\n\n"):
+                response_text = response_text[2:]
+            response_text = response_text.replace("\n\n", "\n")
+        reasoning_text = "\n".join(seg for seg in reasoning_segments if seg).strip()
+        return response_text, reasoning_text
+
+    def _extract_reasoning_text(self, message) -> str:
+        """从回复中提取推理内容，默认不支持"""
+        return ""
+
+    def _format_answer(self, response_text, reasoning_text) -> str:
+        """把回复文本和推理内容组合成最终答案，默认只返回回复文本"""
+        return response_text
+
+
+class _StreamedReply:
+    """累积流式响应的增量，结束后按非流式响应的 choices[0].message / finish_reason / usage 访问"""
+
+    def __init__(self) -> None:
+        self._content: List[str] = []
+        self._reasoning: List[str] = []
+        self._tool_calls: Dict[int, SimpleNamespace] = {}
+        self.finish_reason = None
+        self.usage = None
+
+    def add(self, chunk) -> str:
+        """合并一个 chunk，返回其中新增的回复文本"""
+        if getattr(chunk, "usage", None):
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return ""
+        choice = chunk.choices[0]
+        if getattr(choice, "usage", None):  # Moonshot 把用量挂在最后一个 choice 上
+            self.usage = choice.usage
+        if choice.finish_reason:
+            self.finish_reason = choice.finish_reason
+        delta = choice.delta
+        if delta is None:
+            return ""
+
+        reasoning = getattr(delta, "reasoning_content", None)
+        if reasoning:
+            self._reasoning.append(reasoning)
+        for part in delta.tool_calls or []:
+            tool_call = self._tool_calls.get(part.index)
+            if tool_call is None:
+                tool_call = SimpleNamespace(id="", type="function", function=SimpleNamespace(name="", arguments=""))
+                self._tool_calls[part.index] = tool_call
+            if part.id:
+                tool_call.id = part.id
+            if part.function:
+                tool_call.function.name += part.function.name or ""
+                tool_call.function.arguments += part.function.arguments or ""
+
+        if delta.content:
+            self._content.append(delta.content)
+            return delta.content
+        return ""
+
+    @property
+    def choices(self) -> list:
+        message = SimpleNamespace(
+            content="".join(self._content),
+            reasoning_content="".join(self._reasoning) or None,
+            tool_calls=[self._tool_calls[index] for index in sorted(self._tool_calls)] or None,
+        )
+        return [SimpleNamespace(message=message, finish_reason=self.finish_reason)]
+
+
+__all__ = ["OpenAICompatibleProvider"]
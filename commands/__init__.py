@@ -2,9 +2,7 @@
 """
 消息处理组件包
 
-当前模块提供基于 AI 的功能派发能力:
 - context: 消息上下文类
-- handlers: 功能处理函数
-- ai_router: AI 智能路由核心
-- ai_functions: 面向 AI 路由的功能注册
+- handlers: Agent 入口，LLM 通过 tools/ 中注册的工具自主完成任务
+- reply_streamer: 流式回复按段落分条发送
 """ 
@@ -1,6 +1,8 @@
 import re
 from dataclasses import dataclass, field
-from typing import Dict, Optional, Any
+from typing import Dict, Optional, Any, Tuple
+
+from .send_queue import PRIORITY_REPLY
 
 
 @dataclass
@@ -23,7 +25,14 @@ class MessageContext:
     is_at_bot: bool = False    # 是否在群聊中 @ 了机器人
     sender_name: str = "未知用户" # 发送者昵称 (群内或私聊)
     reasoning_requested: bool = False  # 是否请求启用推理模式
-    router_decision: Optional[Dict[str, Any]] = None  # AI路由返回的决策结果
+
+    # 模型选择结果 (每条消息独立，不修改共享的 Robot 实例)
+    chat: Any = None                   # 本条消息使用的聊天模型实例
+    chat_model_id: Optional[int] = None  # 本条消息使用的模型 ID
+    reasoning_chat: Any = None         # 对应的推理模型实例 (未配置时为 None)
+    force_reasoning: bool = False      # 闲聊时是否强制使用推理模型
+    specific_max_history: Optional[int] = None  # 本次对话的历史消息数量限制
+    allowed_tools: Optional[Tuple[str, ...]] = None  # 会话配置的可用工具，None 表示不限制
     
     # 懒加载字段
     _room_members: Optional[Dict[str, str]] = field(default=None, init=False, repr=False)
@@ -65,18 +74,20 @@ class MessageContext:
         """获取应答接收者ID (群聊返回群ID，私聊返回用户ID)"""
         return self.msg.roomid if self.is_group else self.msg.sender
     
-    def send_text(self, content: str, at_list: str = "", record_message: bool = True) -> bool:
+    def send_text(self, content: str, at_list: str = "", record_message: bool = True,
+                  priority: int = PRIORITY_REPLY) -> bool:
         """
         发送文本消息
         :param content: 消息内容
         :param at_list: 要@的用户列表，多个用逗号分隔
         :param record_message: 是否将消息记录到数据库
-        :return: 是否发送成功
+        :param priority: 发送优先级，状态提示使用 PRIORITY_STATUS
+        :return: 是否成功放入发送队列
         """
         if self.robot and hasattr(self.robot, "sendTextMsg"):
             receiver = self.get_receiver()
             try:
-                self.robot.sendTextMsg(content, receiver, at_list, record_message=record_message)
+                self.robot.sendTextMsg(content, receiver, at_list, record_message=record_message, priority=priority)
                 return True
             except Exception as e:
                 if self.logger:
@@ -1,12 +1,13 @@
-import json
+import asyncio
 import logging
 import os
-import re
 import time as time_mod
-from datetime import datetime
 from typing import Optional, Match, TYPE_CHECKING
 
 from function.func_persona import build_persona_system_prompt
+from tools import tool_registry
+from tools.selector import tool_selector
+from .reply_streamer import create_reply_streamer
 
 if TYPE_CHECKING:
     from .context import MessageContext
@@ -14,331 +15,115 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 
 DEFAULT_CHAT_HISTORY = 30
-DEFAULT_VISIBLE_LIMIT = 30
+DEFAULT_AGENT_MAX_ITERATIONS = 20
+DEFAULT_AGENT_DEADLINE = 120
+DEFAULT_TOOL_TIMEOUT = 60
+
+# 工具使用指引：只列出本次提供给模型的工具对应的条目
+TOOL_GUIDANCE = (
+    (("web_search",), "用户询问需要最新信息、实时数据、或你不确定的事实 → 调用 web_search"),
+    (("reminder_create", "reminder_list", "reminder_delete"), "用户想设置/查看/删除提醒 → 调用 {tools}"),
+    (("lookup_chat_history",), "用户提到之前聊过的内容、或你需要回顾更早的对话 → 调用 lookup_chat_history"),
+)
 
 
 # ══════════════════════════════════════════════════════════
-#  工具 handler 函数
+#  Agent 入口
 # ══════════════════════════════════════════════════════════
 
-def _web_search(ctx, query: str = "", deep_research: bool = False, **_) -> str:
-    perplexity_instance = getattr(ctx.robot, "perplexity", None)
-    if not perplexity_instance:
-        return json.dumps({"error": "Perplexity 搜索功能不可用，未配置或未初始化"}, ensure_ascii=False)
-    if not query:
-        return json.dumps({"error": "请提供搜索关键词"}, ensure_ascii=False)
+def handle_chitchat(ctx: 'MessageContext', match: Optional[Match]) -> bool:
+    """Agent 入口 —— 处理用户消息，LLM 自主决定是否调用工具。"""
+    chat_model = _resolve_chat_model(ctx)
+    if not chat_model:
+        if ctx.logger:
+            ctx.logger.error("没有可用的AI模型")
+        ctx.send_text("抱歉，我现在无法进行对话。")
+        return False
+
+    # ── 引用图片特殊处理 ──────────────────────────────────
+    if getattr(ctx, 'is_quoted_image', False):
+        return _handle_quoted_image(ctx, chat_model)
+
+    request = _build_agent_request(ctx, chat_model, tool_registry.create_handler)
+    streamer = _create_streamer(ctx, chat_model)
+    if streamer:
+        request["stream_handler"] = streamer
+
+    # ── 调用 LLM ─────────────────────────────────────────
     try:
-        response = perplexity_instance.get_answer(query, ctx.get_receiver(), deep_research=deep_research)
-        if not response:
-            return json.dumps({"error": "搜索无结果"}, ensure_ascii=False)
-        cleaned = re.sub(r"<think>.*?</think>", "", response, flags=re.DOTALL).strip()
-        return json.dumps({"result": cleaned or response}, ensure_ascii=False)
-    except Exception as e:
-        return json.dumps({"error": f"搜索失败: {e}"}, ensure_ascii=False)
-
-
-def _reminder_create(ctx, type: str = "once", time: str = "",
-                     content: str = "", weekday: int = None, **_) -> str:
-    if not hasattr(ctx.robot, "reminder_manager"):
-        return json.dumps({"error": "提醒管理器未初始化"}, ensure_ascii=False)
-    if not time or not content:
-        return json.dumps({"error": "缺少必要字段: time 和 content"}, ensure_ascii=False)
-    if len(content.strip()) < 2:
-        return json.dumps({"error": "提醒内容太短"}, ensure_ascii=False)
-
-    if type == "once":
-        parsed_dt = None
-        for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S"):
-            try:
-                parsed_dt = datetime.strptime(time, fmt)
-                break
-            except ValueError:
-                continue
-        if not parsed_dt:
-            return json.dumps({"error": f"once 类型时间格式应为 YYYY-MM-DD HH:MM，收到: {time}"}, ensure_ascii=False)
-        if parsed_dt < datetime.now():
-            return json.dumps({"error": f"时间 {time} 已过去，请使用未来的时间"}, ensure_ascii=False)
-        time = parsed_dt.strftime("%Y-%m-%d %H:%M")
-    elif type in ("daily", "weekly"):
-        parsed_time = None
-        for fmt in ("%H:%M", "%H:%M:%S"):
-            try:
-                parsed_time = datetime.strptime(time, fmt)
-                break
-            except ValueError:
-                continue
-        if not parsed_time:
-            return json.dumps({"error": f"daily/weekly 类型时间格式应为 HH:MM，收到: {time}"}, ensure_ascii=False)
-        time = parsed_time.strftime("%H:%M")
-    else:
-        return json.dumps({"error": f"不支持的提醒类型: {type}"}, ensure_ascii=False)
-
-    if type == "weekly" and (weekday is None or not (isinstance(weekday, int) and 0 <= weekday <= 6)):
-        return json.dumps({"error": "weekly 类型需要 weekday 参数 (0=周一 … 6=周日)"}, ensure_ascii=False)
-
-    data = {"type": type, "time": time, "content": content, "extra": {}}
-    if weekday is not None:
-        data["weekday"] = weekday
-
-    roomid = ctx.msg.roomid if ctx.is_group else None
-    success, result = ctx.robot.reminder_manager.add_reminder(ctx.msg.sender, data, roomid=roomid)
-    if success:
-        type_label = {"once": "一次性", "daily": "每日", "weekly": "每周"}.get(type, type)
-        return json.dumps({"success": True, "id": result,
-                           "message": f"已创建{type_label}提醒: {time} - {content}"}, ensure_ascii=False)
-    return json.dumps({"success": False, "error": result}, ensure_ascii=False)
-
-
-def _reminder_list(ctx, **_) -> str:
-    if not hasattr(ctx.robot, "reminder_manager"):
-        return json.dumps({"error": "提醒管理器未初始化"}, ensure_ascii=False)
-    reminders = ctx.robot.reminder_manager.list_reminders(ctx.msg.sender)
-    if not reminders:
-        return json.dumps({"reminders": [], "message": "当前没有任何提醒"}, ensure_ascii=False)
-    return json.dumps({"reminders": reminders, "count": len(reminders)}, ensure_ascii=False)
-
-
-def _reminder_delete(ctx, reminder_id: str = "", delete_all: bool = False, **_) -> str:
-    if not hasattr(ctx.robot, "reminder_manager"):
-        return json.dumps({"error": "提醒管理器未初始化"}, ensure_ascii=False)
-    if delete_all:
-        success, message, count = ctx.robot.reminder_manager.delete_all_reminders(ctx.msg.sender)
-        return json.dumps({"success": success, "message": message, "deleted_count": count}, ensure_ascii=False)
-    if not reminder_id:
-        return json.dumps({"error": "请提供 reminder_id，或设置 delete_all=true 删除全部"}, ensure_ascii=False)
-    success, message = ctx.robot.reminder_manager.delete_reminder(ctx.msg.sender, reminder_id)
-    return json.dumps({"success": success, "message": message}, ensure_ascii=False)
-
-
-def _lookup_chat_history(ctx, mode: str = "", keywords: list = None,
-                         start_offset: int = None, end_offset: int = None,
-                         start_time: str = None, end_time: str = None, **_) -> str:
-    message_summary = getattr(ctx.robot, "message_summary", None) if ctx.robot else None
-    if not message_summary:
-        return json.dumps({"error": "消息历史功能不可用"}, ensure_ascii=False)
-
-    chat_id = ctx.get_receiver()
-    visible_limit = DEFAULT_VISIBLE_LIMIT
-    raw = getattr(ctx, "specific_max_history", None)
-    if raw is not None:
         try:
-            visible_limit = int(raw)
-        except (TypeError, ValueError):
-            pass
+            rsp = chat_model.get_answer(**request)
+        except Exception:
+            if streamer:
+                streamer.close(flush=False)
+            raise
 
-    mode = (mode or "").strip().lower()
-    if not mode:
-        if start_time and end_time:
-            mode = "time"
-        elif start_offset is not None and end_offset is not None:
-            mode = "range"
+        if streamer and streamer.close():
+            return True
+        if rsp:
+            ctx.send_text(rsp, "")
+            return True
         else:
-            mode = "keywords"
-
-    if mode == "keywords":
-        if isinstance(keywords, str):
-            keywords = [keywords]
-        elif not isinstance(keywords, list):
-            keywords = []
-        cleaned = []
-        seen = set()
-        for kw in keywords:
-            if kw is None:
-                continue
-            s = str(kw).strip()
-            if s and (len(s) > 1 or s.isdigit()):
-                low = s.lower()
-                if low not in seen:
-                    seen.add(low)
-                    cleaned.append(s)
-        if not cleaned:
-            return json.dumps({"error": "未提供有效关键词", "results": []}, ensure_ascii=False)
-        search_results = message_summary.search_messages_with_context(
-            chat_id=chat_id, keywords=cleaned, context_window=10,
-            max_groups=20, exclude_recent=visible_limit,
-        )
-        segments, lines_seen = [], set()
-        for seg in search_results:
-            formatted = [l for l in seg.get("formatted_messages", []) if l not in lines_seen]
-            lines_seen.update(formatted)
-            if formatted:
-                segments.append({"matched_keywords": seg.get("matched_keywords", []), "messages": formatted})
-        payload = {"segments": segments, "returned_groups": len(segments), "keywords": cleaned}
-        if not segments:
-            payload["notice"] = "未找到匹配的消息。"
-        return json.dumps(payload, ensure_ascii=False)
-
-    if mode == "range":
-        if start_offset is None or end_offset is None:
-            return json.dumps({"error": "range 模式需要 start_offset 和 end_offset"}, ensure_ascii=False)
-        try:
-            start_offset, end_offset = int(start_offset), int(end_offset)
-        except (TypeError, ValueError):
-            return json.dumps({"error": "start_offset 和 end_offset 必须是整数"}, ensure_ascii=False)
-        if start_offset <= visible_limit or end_offset <= visible_limit:
-            return json.dumps({"error": f"偏移量必须大于 {visible_limit} 以排除当前可见消息"}, ensure_ascii=False)
-        if start_offset > end_offset:
-            start_offset, end_offset = end_offset, start_offset
-        result = message_summary.get_messages_by_reverse_range(
-            chat_id=chat_id, start_offset=start_offset, end_offset=end_offset,
-        )
-        payload = {
-            "start_offset": result.get("start_offset"), "end_offset": result.get("end_offset"),
-            "messages": result.get("messages", []), "returned_count": result.get("returned_count", 0),
-            "total_messages": result.get("total_messages", 0),
-        }
-        if payload["returned_count"] == 0:
-            payload["notice"] = "请求范围内没有消息。"
-        return json.dumps(payload, ensure_ascii=False)
-
-    if mode == "time":
-        if not start_time or not end_time:
-            return json.dumps({"error": "time 模式需要 start_time 和 end_time"}, ensure_ascii=False)
-        time_lines = message_summary.get_messages_by_time_window(
-            chat_id=chat_id, start_time=start_time, end_time=end_time,
-        )
-        payload = {"start_time": start_time, "end_time": end_time,
-                    "messages": time_lines, "returned_count": len(time_lines)}
-        if not time_lines:
-            payload["notice"] = "该时间范围内没有消息。"
-        return json.dumps(payload, ensure_ascii=False)
+            if ctx.logger:
+                ctx.logger.error("无法从AI获得答案")
+            return False
+    except Exception as e:
+        if ctx.logger:
+            ctx.logger.error(f"获取AI回复时出错: {e}", exc_info=True)
+        return False
 
-    return json.dumps({"error": f"不支持的模式: {mode}"}, ensure_ascii=False)
 
+async def handle_chitchat_async(ctx: 'MessageContext', match: Optional[Match]) -> bool:
+    """handle_chitchat 的异步版本：模型支持 get_answer_async 时在事件循环上等待，否则退回线程池。"""
+    chat_model = _resolve_chat_model(ctx)
+    if not chat_model:
+        if ctx.logger:
+            ctx.logger.error("没有可用的AI模型")
+        await asyncio.to_thread(ctx.send_text, "抱歉，我现在无法进行对话。")
+        return False
 
-# ══════════════════════════════════════════════════════════
-#  工具注册表
-# ══════════════════════════════════════════════════════════
+    if getattr(ctx, 'is_quoted_image', False):
+        return await asyncio.to_thread(_handle_quoted_image, ctx, chat_model)
 
-TOOLS = {
-    "web_search": {
-        "handler": _web_search,
-        "description": "在网络上搜索信息。用于回答需要最新数据、实时信息或你不确定的事实性问题。deep_research 仅在问题非常复杂、需要深度研究时才开启。",
-        "status_text": "正在联网搜索: ",
-        "status_arg": "query",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "query": {"type": "string", "description": "搜索关键词或问题"},
-                "deep_research": {"type": "boolean", "description": "是否启用深度研究模式（耗时较长，仅用于复杂问题）"},
-            },
-            "required": ["query"],
-            "additionalProperties": False,
-        },
-    },
-    "reminder_create": {
-        "handler": _reminder_create,
-        "description": "创建提醒。支持 once(一次性)、daily(每日)、weekly(每周) 三种类型。当前时间已在对话上下文中提供，请据此计算目标时间。",
-        "status_text": "正在设置提醒...",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "type": {"type": "string", "enum": ["once", "daily", "weekly"], "description": "提醒类型"},
-                "time": {"type": "string", "description": "once → YYYY-MM-DD HH:MM；daily/weekly → HH:MM"},
-                "content": {"type": "string", "description": "提醒内容"},
-                "weekday": {"type": "integer", "description": "仅 weekly 需要。0=周一 … 6=周日"},
-            },
-            "required": ["type", "time", "content"],
-            "additionalProperties": False,
-        },
-    },
-    "reminder_list": {
-        "handler": _reminder_list,
-        "description": "查看当前用户的所有提醒列表。",
-        "parameters": {"type": "object", "properties": {}, "additionalProperties": False},
-    },
-    "reminder_delete": {
-        "handler": _reminder_delete,
-        "description": "删除提醒。需要先调用 reminder_list 获取 ID，再用 reminder_id 精确删除；或设置 delete_all=true 一次性删除全部。",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "reminder_id": {"type": "string", "description": "要删除的提醒完整 ID"},
-                "delete_all": {"type": "boolean", "description": "是否删除该用户全部提醒"},
-            },
-            "additionalProperties": False,
-        },
-    },
-    "lookup_chat_history": {
-        "handler": _lookup_chat_history,
-        "description": "查询聊天历史记录。你当前只能看到最近的消息，调用此工具可以回溯更早的上下文。支持 keywords/range/time 三种模式。",
-        "status_text": "正在翻阅聊天记录: ",
-        "status_arg": "keywords",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "mode": {"type": "string", "enum": ["keywords", "range", "time"], "description": "查询模式"},
-                "keywords": {"type": "array", "items": {"type": "string"}, "description": "mode=keywords 时的搜索关键词"},
-                "start_offset": {"type": "integer", "description": "mode=range 时的起始偏移（从最新消息倒数）"},
-                "end_offset": {"type": "integer", "description": "mode=range 时的结束偏移"},
-                "start_time": {"type": "string", "description": "mode=time 时的开始时间 (YYYY-MM-DD HH:MM)"},
-                "end_time": {"type": "string", "description": "mode=time 时的结束时间 (YYYY-MM-DD HH:MM)"},
-            },
-            "additionalProperties": False,
-        },
-    },
-}
-
-
-def _get_openai_tools():
-    return [
-        {"type": "function", "function": {"name": n, "description": s["description"], "parameters": s["parameters"]}}
-        for n, s in TOOLS.items()
-    ]
-
-
-def _create_tool_handler(ctx):
-    def _send_status(spec, arguments):
-        status = spec.get("status_text", "")
-        if not status:
-            return
-        try:
-            arg_name = spec.get("status_arg", "")
-            if arg_name:
-                val = arguments.get(arg_name)
-                if val is not None:
-                    if isinstance(val, list):
-                        val = "、".join(str(k) for k in val[:3])
-                    status = f"{status}{val}"
-            ctx.send_text(status, record_message=False)
-        except Exception:
-            pass
+    get_answer_async = getattr(chat_model, "get_answer_async", None)
+    tool_handler_factory = tool_registry.create_async_handler if get_answer_async else tool_registry.create_handler
+    request = _build_agent_request(ctx, chat_model, tool_handler_factory)
+    streamer = _create_streamer(ctx, chat_model)
+    if streamer:
+        request["stream_handler"] = streamer
 
-    def handler(tool_name, arguments):
-        spec = TOOLS.get(tool_name)
-        if not spec:
-            return json.dumps({"error": f"Unknown tool: {tool_name}"}, ensure_ascii=False)
-        _send_status(spec, arguments)
+    try:
         try:
-            result = spec["handler"](ctx, **arguments)
-            if not isinstance(result, str):
-                result = json.dumps(result, ensure_ascii=False)
-            return result
-        except Exception as e:
-            logger.error(f"工具 {tool_name} 执行失败: {e}", exc_info=True)
-            return json.dumps({"error": str(e)}, ensure_ascii=False)
-
-    return handler
+            if get_answer_async:
+                rsp = await get_answer_async(**request)
+            else:
+                rsp = await asyncio.to_thread(chat_model.get_answer, **request)
+        except Exception:
+            if streamer:
+                await asyncio.to_thread(streamer.close, False)
+            raise
 
+        if streamer and await asyncio.to_thread(streamer.close):
+            return True
+        if rsp:
+            await asyncio.to_thread(ctx.send_text, rsp, "")
+            return True
+        else:
+            if ctx.logger:
+                ctx.logger.error("无法从AI获得答案")
+            return False
+    except Exception as e:
+        if ctx.logger:
+            ctx.logger.error(f"获取AI回复时出错: {e}", exc_info=True)
+        return False
 
-# ══════════════════════════════════════════════════════════
-#  Agent 入口
-# ══════════════════════════════════════════════════════════
 
-def handle_chitchat(ctx: 'MessageContext', match: Optional[Match]) -> bool:
-    """Agent 入口 —— 处理用户消息，LLM 自主决定是否调用工具。"""
-    chat_model = None
-    if hasattr(ctx, 'chat'):
-        chat_model = ctx.chat
-    elif ctx.robot and hasattr(ctx.robot, 'chat'):
+def _resolve_chat_model(ctx: 'MessageContext'):
+    """确定本条消息使用的模型，并归一化历史消息数量限制。"""
+    chat_model = ctx.chat
+    if chat_model is None and ctx.robot and hasattr(ctx.robot, 'chat'):
         chat_model = ctx.robot.chat
 
-    if not chat_model:
-        if ctx.logger:
-            ctx.logger.error("没有可用的AI模型")
-        ctx.send_text("抱歉，我现在无法进行对话。")
-        return False
-
     # 历史消息数量限制
     raw_specific_max_history = getattr(ctx, 'specific_max_history', None)
     specific_max_history = None
@@ -353,10 +138,33 @@ def handle_chitchat(ctx: 'MessageContext', match: Optional[Match]) -> bool:
         specific_max_history = DEFAULT_CHAT_HISTORY
     setattr(ctx, 'specific_max_history', specific_max_history)
 
-    # ── 引用图片特殊处理 ──────────────────────────────────
-    if getattr(ctx, 'is_quoted_image', False):
-        return _handle_quoted_image(ctx, chat_model)
+    return chat_model
+
+
+def _receiver_quota(ctx: 'MessageContext'):
+    """当前会话的剩余发送限额（同时受全局和单会话频率限制），供 streamer 决定还能拆出几条"""
+    send_quota_remaining = getattr(ctx.robot, "send_quota_remaining", None)
+    if send_quota_remaining is None:
+        return None
+    receiver = ctx.get_receiver()
+    return lambda: send_quota_remaining(receiver)
+
+
+def _create_streamer(ctx: 'MessageContext', chat_model):
+    """模型支持流式输出且配置开启时，创建按段落分条发送回复的 streamer。"""
+    if not getattr(chat_model, "supports_streaming", False):
+        return None
+    return create_reply_streamer(
+        getattr(ctx.config, "STREAMING", None),
+        lambda text: ctx.send_text(text, ""),
+        quota=_receiver_quota(ctx),
+        collapse_blank_lines=getattr(chat_model, "collapse_blank_lines", False),
+        logger=ctx.logger,
+    )
 
+
+def _build_agent_request(ctx: 'MessageContext', chat_model, tool_handler_factory) -> dict:
+    """构建 get_answer / get_answer_async 的调用参数。"""
     # ── 构建用户消息 ──────────────────────────────────────
     content = ctx.text
     sender_name = ctx.sender_name
@@ -397,24 +205,25 @@ def handle_chitchat(ctx: 'MessageContext', match: Optional[Match]) -> bool:
     tool_handler = None
 
     if not is_auto_random_reply:
-        openai_tools = _get_openai_tools()
+        openai_tools = tool_selector.select(ctx)
         if openai_tools:
             tools = openai_tools
-            tool_handler = _create_tool_handler(ctx)
+            tool_handler = tool_handler_factory(ctx, allowed=[t["function"]["name"] for t in tools])
 
     # ── 构建系统提示 ──────────────────────────────────────
     persona_text = getattr(ctx, 'persona', None)
     system_prompt_override = None
 
+    # 工具指引按会话白名单生成而不是按本次实际提供的工具，保证同一会话的系统提示逐字节不变，
+    # 意图预筛开启时也不会让系统提示这一段前缀缓存失效
     tool_guidance = ""
-    if tools:
+    guidance_tools = tool_selector.allowed_names(ctx)
+    if guidance_tools:
         tool_guidance = (
             "\n\n## 工具使用指引\n"
             "你可以调用工具来辅助回答，以下是决策原则：\n"
-            "- 用户询问需要最新信息、实时数据、或你不确定的事实 → 调用 web_search\n"
-            "- 用户想设置/查看/删除提醒 → 调用 reminder_create / reminder_list / reminder_delete\n"
-            "- 用户提到之前聊过的内容、或你需要回顾更早的对话 → 调用 lookup_chat_history\n"
-            "- 日常闲聊、观点讨论、情感交流 → 直接回复，不需要调用任何工具\n"
+            + _tool_guidance_lines(guidance_tools)
+            + "- 日常闲聊、观点讨论、情感交流 → 直接回复，不需要调用任何工具\n"
             "你可以在一次对话中多次调用工具，每次调用的结果会反馈给你继续推理。"
         )
 
@@ -429,33 +238,34 @@ def handle_chitchat(ctx: 'MessageContext', match: Optional[Match]) -> bool:
     elif tool_guidance:
         system_prompt_override = tool_guidance
 
-    # ── 调用 LLM ─────────────────────────────────────────
-    try:
-        if ctx.logger:
-            tool_names = [t["function"]["name"] for t in tools] if tools else []
-            ctx.logger.info(f"Agent 调用: tools={tool_names}")
-
-        rsp = chat_model.get_answer(
-            question=latest_message_prompt,
-            wxid=ctx.get_receiver(),
-            system_prompt_override=system_prompt_override,
-            specific_max_history=specific_max_history,
-            tools=tools,
-            tool_handler=tool_handler,
-            tool_max_iterations=20,
-        )
-
-        if rsp:
-            ctx.send_text(rsp, "")
-            return True
-        else:
-            if ctx.logger:
-                ctx.logger.error("无法从AI获得答案")
-            return False
-    except Exception as e:
-        if ctx.logger:
-            ctx.logger.error(f"获取AI回复时出错: {e}", exc_info=True)
-        return False
+    if ctx.logger:
+        tool_names = [t["function"]["name"] for t in tools] if tools else []
+        ctx.logger.info(f"Agent 调用: tools={tool_names}")
+
+    # ── 时间预算 ──────────────────────────────────────────
+    agent_conf = getattr(ctx.config, "AGENT", None) or {}
+
+    return {
+        "question": latest_message_prompt,
+        "wxid": ctx.get_receiver(),
+        "system_prompt_override": system_prompt_override,
+        "specific_max_history": ctx.specific_max_history,
+        "tools": tools,
+        "tool_handler": tool_handler,
+        "tool_max_iterations": agent_conf.get("max_iterations", DEFAULT_AGENT_MAX_ITERATIONS),
+        "tool_timeout": agent_conf.get("tool_timeout_seconds", DEFAULT_TOOL_TIMEOUT) or None,
+        "tool_timeouts": agent_conf.get("tool_timeouts") or None,
+        "time_budget": agent_conf.get("deadline_seconds", DEFAULT_AGENT_DEADLINE) or None,
+    }
+
+
+def _tool_guidance_lines(tool_names) -> str:
+    lines = []
+    for names, line in TOOL_GUIDANCE:
+        present = [name for name in names if name in tool_names]
+        if present:
+            lines.append(f"- {line.format(tools=' / '.join(present))}\n")
+    return "".join(lines)
 
 
 def _handle_quoted_image(ctx, chat_model) -> bool:
@@ -0,0 +1,359 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_CHAT_QUEUE_SIZE = 50
+DEFAULT_MAX_IN_FLIGHT = 200
+DEFAULT_BRIDGE_WORKERS = 8
+
+
+def _positive_int(value: Any, default: int) -> int:
+    try:
+        parsed = int(value)
+    except (TypeError, ValueError):
+        return default
+    return parsed if parsed > 0 else default
+
+
+@dataclass
+class DispatcherStats:
+    enqueued: int = 0
+    processed: int = 0
+    failed: int = 0
+    dropped: int = 0
+    max_lag: float = 0.0
+    total_lag: float = 0.0
+
+    @property
+    def avg_lag(self) -> float:
+        return self.total_lag / self.processed if self.processed else 0.0
+
+
+class MessageDispatcher:
+    """Fan inbound messages out to a bounded worker pool, keyed by conversation.
+
+    同一会话（群 roomid 或私聊 sender）内的消息严格按到达顺序串行处理，
+    不同会话之间由工作线程并行处理，单个慢请求不会阻塞其他会话。
+    """
+
+    _busy_label = "忙碌线程"
+
+    def __init__(
+        self,
+        handler: Callable[[Any], None],
+        config: Dict[str, Any],
+        logger: Any,
+        on_drop: Optional[Callable[[Any], None]] = None,
+    ) -> None:
+        config = config if isinstance(config, dict) else {}
+        self.handler = handler
+        self.logger = logger
+        self.on_drop = on_drop
+        self.enabled = bool(config.get("enable", True))
+        self.max_workers = _positive_int(config.get("max_workers"), DEFAULT_MAX_WORKERS)
+        self.chat_queue_size = _positive_int(config.get("chat_queue_size"), DEFAULT_CHAT_QUEUE_SIZE)
+
+        # 会话键存在于 _queues 中，当且仅当它已在 _ready 中排队或正被某个工作线程处理
+        self._queues: Dict[str, Deque[Tuple[float, Any]]] = {}
+        self._ready: Deque[str] = deque()
+        self._cond = threading.Condition()
+        self._workers: List[threading.Thread] = []
+        self._running = False
+        self._busy_workers = 0
+        self._stats = DispatcherStats()
+
+    def start(self) -> None:
+        if not self.enabled:
+            if self.logger:
+                self.logger.info("消息分发器未启用，消息将在接收线程中串行处理。")
+            return
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        for index in range(self.max_workers):
+            worker = threading.Thread(
+                target=self._worker_loop,
+                name=f"MessageWorker-{index}",
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+        if self.logger:
+            self.logger.info(
+                f"消息分发器已启动: 工作线程={self.max_workers}, 单会话队列上限={self.chat_queue_size}"
+            )
+
+    def submit(self, key: str, msg: Any) -> bool:
+        """Queue a message for its conversation. Returns False if an older message was dropped."""
+        if not self.enabled or not self._running:
+            self._run_handler(msg)
+            return True
+
+        dropped = None
+        with self._cond:
+            self._stats.enqueued += 1
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = deque()
+                self._queues[key] = queue
+                self._schedule(key)
+            elif len(queue) >= self.chat_queue_size:
+                _, dropped = queue.popleft()
+                self._stats.dropped += 1
+            queue.append((time.monotonic(), msg))
+
+        if dropped is None:
+            return True
+
+        if self.logger:
+            self.logger.warning(
+                f"会话 {key} 待处理消息超过 {self.chat_queue_size} 条，已丢弃最早的一条"
+            )
+        if self.on_drop:
+            try:
+                self.on_drop(dropped)
+            except Exception as exc:
+                if self.logger:
+                    self.logger.error(f"处理被丢弃的消息失败: {exc}", exc_info=True)
+        return False
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Stop accepting work and wait (bounded) for queued messages to drain."""
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+
+        deadline = time.monotonic() + max(timeout, 0.0)
+        for worker in self._workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+
+        still_alive = [w.name for w in self._workers if w.is_alive()]
+        if still_alive and self.logger:
+            self.logger.warning(f"以下消息工作线程在退出时仍在运行: {still_alive}")
+        self._workers = []
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            backlog = {key: len(queue) for key, queue in self._queues.items() if queue}
+            stats = self._stats
+            return {
+                "enqueued": stats.enqueued,
+                "processed": stats.processed,
+                "failed": stats.failed,
+                "dropped": stats.dropped,
+                "pending": sum(backlog.values()),
+                "active_chats": len(self._queues),
+                "busy_workers": self._busy_workers,
+                "max_workers": self.max_workers,
+                "max_chat_backlog": max(backlog.values()) if backlog else 0,
+                "avg_lag": stats.avg_lag,
+                "max_lag": stats.max_lag,
+            }
+
+    def log_stats(self) -> None:
+        if not self.enabled or not self.logger:
+            return
+        stats = self.get_stats()
+        if not stats["enqueued"]:
+            return
+        self.logger.info(
+            "消息分发统计: "
+            f"入队={stats['enqueued']}, 已处理={stats['processed']}, 失败={stats['failed']}, "
+            f"丢弃={stats['dropped']}, 待处理={stats['pending']}, 活跃会话={stats['active_chats']}, "
+            f"{self._busy_label}={stats['busy_workers']}/{stats['max_workers']}, "
+            f"最大会话积压={stats['max_chat_backlog']}, "
+            f"平均排队={stats['avg_lag']:.2f}s, 最大排队={stats['max_lag']:.2f}s"
+        )
+
+    def _schedule(self, key: str) -> None:
+        """Hand a newly active conversation to the workers. Called with _cond held."""
+        self._ready.append(key)
+        self._cond.notify()
+
+    def _worker_loop(self) -> None:
+        while True:
+            with self._cond:
+                while self._running and not self._ready:
+                    self._cond.wait()
+                if not self._ready:
+                    return  # 已停止且没有剩余任务
+                key = self._ready.popleft()
+                enqueued_at, msg = self._queues[key].popleft()
+                self._busy_workers += 1
+
+            lag = time.monotonic() - enqueued_at
+            failed = not self._run_handler(msg)
+
+            with self._cond:
+                self._busy_workers -= 1
+                self._stats.processed += 1
+                self._stats.total_lag += lag
+                self._stats.max_lag = max(self._stats.max_lag, lag)
+                if failed:
+                    self._stats.failed += 1
+                if self._queues[key]:
+                    self._ready.append(key)
+                    self._cond.notify()
+                else:
+                    del self._queues[key]
+
+    def _run_handler(self, msg: Any) -> bool:
+        try:
+            self.handler(msg)
+            return True
+        except Exception as exc:
+            if self.logger:
+                self.logger.error(f"消息处理线程出错: {exc}", exc_info=True)
+            return False
+
+
+class AsyncMessageDispatcher(MessageDispatcher):
+    """Run an async handler per conversation on a dedicated asyncio event loop.
+
+    排队与丢弃策略与 MessageDispatcher 相同（同会话串行、跨会话并发），
+    区别在于每个活跃会话只占用一个协程而不是一个线程：LLM 请求在事件循环上
+    等待，wcf 和数据库等阻塞调用经由 asyncio.to_thread 进入一个小线程池。
+    这样少量 OS 线程即可承载数百个并发中的会话。
+    """
+
+    _busy_label = "进行中会话"
+
+    def __init__(
+        self,
+        handler: Callable[[Any], Awaitable[None]],
+        config: Dict[str, Any],
+        logger: Any,
+        on_drop: Optional[Callable[[Any], None]] = None,
+    ) -> None:
+        super().__init__(handler, config, logger, on_drop=on_drop)
+        config = config if isinstance(config, dict) else {}
+        self.max_in_flight = _positive_int(config.get("max_in_flight"), DEFAULT_MAX_IN_FLIGHT)
+        self.bridge_workers = _positive_int(config.get("bridge_workers"), DEFAULT_BRIDGE_WORKERS)
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        if not self.enabled:
+            if self.logger:
+                self.logger.info("消息分发器未启用，消息将在接收线程中串行处理。")
+            return
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+
+        self._loop = asyncio.new_event_loop()
+        # 默认执行器即 asyncio.to_thread 使用的线程池，也就是阻塞调用的线程桥
+        self._executor = ThreadPoolExecutor(max_workers=self.bridge_workers, thread_name_prefix="AsyncBridge")
+        self._loop.set_default_executor(self._executor)
+        self._loop_thread = threading.Thread(target=self._run_loop, name="MessageEventLoop", daemon=True)
+        self._loop_thread.start()
+        if self.logger:
+            self.logger.info(
+                f"异步消息分发器已启动: 最大并发={self.max_in_flight}, "
+                f"阻塞调用线程={self.bridge_workers}, 单会话队列上限={self.chat_queue_size}"
+            )
+
+    def stop(self, timeout: float = 10.0) -> None:
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+
+        loop = self._loop
+        drain = asyncio.run_coroutine_threadsafe(self._wait_idle(), loop)
+        try:
+            drain.result(max(timeout, 0.0))
+        except Exception:
+            if self.logger:
+                self.logger.warning(f"退出时仍有 {len(self._tasks)} 个会话未处理完，已取消")
+            loop.call_soon_threadsafe(self._cancel_all)
+
+        loop.call_soon_threadsafe(loop.stop)
+        self._loop_thread.join(max(timeout, 1.0))
+        if not self._loop_thread.is_alive():
+            loop.close()
+        self._executor.shutdown(wait=False)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = super().get_stats()
+        stats["max_workers"] = self.max_in_flight
+        return stats
+
+    def _run_loop(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._loop.run_forever()
+
+    def _schedule(self, key: str) -> None:
+        self._loop.call_soon_threadsafe(self._spawn_drain, key)
+
+    def _spawn_drain(self, key: str) -> None:
+        task = self._loop.create_task(self._drain(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key: str) -> None:
+        """Process one conversation's queue in order until it is empty."""
+        while True:
+            with self._cond:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                enqueued_at, msg = queue.popleft()
+
+            async with self._semaphore:
+                with self._cond:
+                    self._busy_workers += 1
+                lag = time.monotonic() - enqueued_at
+                failed = not await self._run_handler_async(msg)
+
+            with self._cond:
+                self._busy_workers -= 1
+                self._stats.processed += 1
+                self._stats.total_lag += lag
+                self._stats.max_lag = max(self._stats.max_lag, lag)
+                if failed:
+                    self._stats.failed += 1
+
+    async def _wait_idle(self) -> None:
+        while self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+    def _cancel_all(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def _run_handler_async(self, msg: Any) -> bool:
+        try:
+            await self.handler(msg)
+            return True
+        except Exception as exc:
+            if self.logger:
+                self.logger.error(f"消息处理协程出错: {exc}", exc_info=True)
+            return False
+
+    def _run_handler(self, msg: Any) -> bool:
+        # 分发器未运行时（未启用或已停止），在调用线程中直接跑完这条消息
+        try:
+            asyncio.run(self.handler(msg))
+            return True
+        except Exception as exc:
+            if self.logger:
+                self.logger.error(f"消息处理出错: {exc}", exc_info=True)
+            return False
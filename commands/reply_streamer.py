@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+DEFAULT_MIN_CHARS = 80
+DEFAULT_FLUSH_INTERVAL = 3.0
+DEFAULT_MAX_MESSAGES = 4
+
+_CLOSE = object()
+
+
+class ParagraphStreamer:
+    """把模型的流式输出按段落拆成多条微信消息
+
+    feed 收到的文本先进入缓冲，缓冲中已完整（以换行结尾）的段落累计到 min_chars 字，
+    或者距第一段到达已超过 flush_interval 秒时，作为一条消息交给后台线程发送；
+    未完整的最后一段和剩余内容在 close 时一起发出。feed 不会阻塞，可以在事件循环上调用。
+
+    拆分受发送频率限制约束：quota 返回本会话还能立即发送的条数（全局与单会话限额的较小值），
+    额度不足（要给结尾留一条）或已拆出 max_messages - 1 条时不再拆分，剩余内容合并到最后一条，
+    避免在发送队列中排队等待限流。
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], Any],
+        min_chars: int = DEFAULT_MIN_CHARS,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        max_messages: int = DEFAULT_MAX_MESSAGES,
+        quota: Optional[Callable[[], Optional[int]]] = None,
+        collapse_blank_lines: bool = False,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self._send = send
+        self.min_chars = max(1, int(min_chars))
+        self.flush_interval = max(0.0, float(flush_interval))
+        self.max_messages = max(1, int(max_messages))
+        self._quota = quota
+        self.collapse_blank_lines = collapse_blank_lines
+        self.LOG = logger or logging.getLogger("ReplyStreamer")
+
+        self._lock = threading.Lock()
+        self._buffer = ""
+        self._buffer_since = 0.0
+        self._closed = False
+        self._queued = 0     # 已交给发送线程的消息数
+        self._unsent = 0     # 已排队但尚未发送完成的消息数
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+        self.started_at = time.monotonic()
+        self.first_sent_at: Optional[float] = None
+
+    @property
+    def sent_any(self) -> bool:
+        return self._queued > 0
+
+    def feed(self, text: str) -> None:
+        if not text:
+            return
+        with self._lock:
+            if self._closed:
+                return
+            if not self._buffer.strip():
+                self._buffer_since = time.monotonic()
+            self._buffer += text
+            chunk = self._take_paragraphs()
+            if chunk:
+                self._enqueue(chunk)
+
+    def discard(self) -> None:
+        """丢弃尚未发出的内容（模型转而调用工具时，之前的铺垫文字不再需要）"""
+        with self._lock:
+            self._buffer = ""
+
+    def close(self, flush: bool = True, timeout: Optional[float] = None) -> bool:
+        """发出剩余内容并等待发送线程结束
+
+        Args:
+            flush: False 表示放弃缓冲中的剩余内容（例如生成中途出错）
+            timeout: 等待发送完成的最长秒数，None 表示一直等待
+
+        Returns:
+            bool: 是否至少发出过一条消息；为 False 时调用方需要自行发送完整回复
+        """
+        with self._lock:
+            if self._closed:
+                return self.sent_any
+            self._closed = True
+            rest = self._clean(self._buffer) if flush else ""
+            self._buffer = ""
+            if rest and self._queued:
+                # 只拆出一部分时才由这里发送结尾；从未拆分过时整条回复交还给调用方
+                self._enqueue(rest)
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(_CLOSE)
+
+        if thread is not None:
+            thread.join(timeout)
+        if self.sent_any and self.first_sent_at is not None:
+            self.LOG.info(
+                f"流式回复: 首条消息耗时 {self.first_sent_at - self.started_at:.1f}s，"
+                f"共 {self._queued} 条，总耗时 {time.monotonic() - self.started_at:.1f}s"
+            )
+        return self.sent_any
+
+    # ---- 内部实现（调用方持有 _lock） ----
+
+    def _take_paragraphs(self) -> str:
+        cut = self._buffer.rfind("\n")
+        if cut <= 0:
+            return ""
+        ready = self._clean(self._buffer[:cut])
+        if not ready:
+            return ""
+        waited = time.monotonic() - self._buffer_since
+        if len(ready) < self.min_chars and (waited < self.flush_interval or len(ready) < self.min_chars // 4):
+            return ""
+        if not self._can_split():
+            return ""
+        self._buffer = self._buffer[cut + 1:]
+        self._buffer_since = time.monotonic()
+        return ready
+
+    def _can_split(self) -> bool:
+        if self._queued >= self.max_messages - 1:
+            return False
+        if self._quota is None:
+            return True
+        try:
+            remaining = self._quota()
+        except Exception:
+            return False
+        # 排队中的消息还没有计入限流窗口；至少为结尾再留一条
+        return remaining is None or remaining - self._unsent >= 2
+
+    def _clean(self, text: str) -> str:
+        text = text.strip()
+        if self.collapse_blank_lines:
+            text = text.replace("\n\n", "\n")
+        return text
+
+    def _enqueue(self, chunk: str) -> None:
+        self._queued += 1
+        self._unsent += 1
+        self._queue.put(chunk)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="ReplyStreamer", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            chunk = self._queue.get()
+            if chunk is _CLOSE:
+                return
+            try:
+                self._send(chunk)
+            except Exception as e:
+                self.LOG.error(f"流式回复发送失败: {e}")
+            with self._lock:
+                self._unsent -= 1
+            if self.first_sent_at is None:
+                self.first_sent_at = time.monotonic()
+
+
+def create_reply_streamer(config: Optional[Dict[str, Any]], send: Callable[[str], Any], **kwargs) -> Optional[ParagraphStreamer]:
+    """按 streaming 配置创建 ParagraphStreamer，未启用时返回 None"""
+    config = config if isinstance(config, dict) else {}
+    if not config.get("enable", False):
+        return None
+    return ParagraphStreamer(
+        send,
+        min_chars=config.get("min_chars") or DEFAULT_MIN_CHARS,
+        flush_interval=config.get("flush_interval_seconds", DEFAULT_FLUSH_INTERVAL),
+        max_messages=config.get("max_messages") or DEFAULT_MAX_MESSAGES,
+        **kwargs,
+    )
+
+
+if __name__ == "__main__":
+    # 基准：模拟模型按 40 字/秒输出一段约 900 字的回答，微信发送每条耗时 0.3~1.3 秒，
+    # 对比等待完整回复后一次性发送与按段落流式发送的首条消息时间
+    # 用法: python -m commands.reply_streamer
+    import random
+
+    CHARS_PER_SECOND = 400  # 按 10 倍速回放，输出的耗时统一换算回真实秒数
+    SPEEDUP = 10
+    rng = random.Random(7)
+    paragraphs = ["".join(rng.choice("今天我们来聊聊这个问题的几个方面，首先需要明确背景。") for _ in range(rng.randint(60, 180)))
+                  for _ in range(7)]
+    answer = "\n\n".join(paragraphs)
+
+    def fake_send(text, sent):
+        time.sleep((0.3 + rng.random()) / SPEEDUP)
+        sent.append((time.monotonic(), len(text)))
+
+    def stream_tokens(callback):
+        for i in range(0, len(answer), 4):
+            time.sleep(4 / CHARS_PER_SECOND)
+            callback(answer[i:i + 4])
+
+    for label, quota_left in (("不限流", None), ("限流剩余 2 条", 2)):
+        sent = []
+        quota = None if quota_left is None else (lambda: quota_left - len(sent))
+        started = time.monotonic()
+        streamer = ParagraphStreamer(lambda text: fake_send(text, sent), flush_interval=DEFAULT_FLUSH_INTERVAL / SPEEDUP,
+                                     quota=quota)
+        streamer.started_at = started
+        stream_tokens(streamer.feed)
+        streamer.close()
+        first = (sent[0][0] - started) * SPEEDUP
+        total = (sent[-1][0] - started) * SPEEDUP
+        print(f"流式 ({label}): 首条 {first:.1f}s，完成 {total:.1f}s，共 {len(sent)} 条，{sum(n for _, n in sent)} 字")
+
+    sent = []
+    started = time.monotonic()
+    chunks = []
+    stream_tokens(chunks.append)
+    fake_send("".join(chunks), sent)
+    print(f"完整回复后发送: 首条 {(sent[0][0] - started) * SPEEDUP:.1f}s，共 1 条，{len(answer)} 字")
@@ -0,0 +1,389 @@
+from __future__ import annotations
+
+import heapq
+import itertools
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+PRIORITY_REPLY = 0    # 对用户消息的回复、提醒、转发等
+PRIORITY_STATUS = 1   # "正在联网搜索: …" 之类的过程提示，可以让位于回复，过期后丢弃
+
+DEFAULT_SEND_INTERVAL = (0.3, 1.3)   # 相邻两条消息之间的随机间隔（秒），模拟人工发送节奏
+DEFAULT_STATUS_TTL = 30.0
+DEFAULT_STOP_TIMEOUT = 10.0
+
+
+def _non_negative(value: Any, default: float) -> float:
+    try:
+        parsed = float(value)
+    except (TypeError, ValueError):
+        return default
+    return parsed if parsed >= 0 else default
+
+
+class TokenBucket:
+    """令牌桶：每分钟补充 rate 个令牌，最多积攒 burst 个"""
+
+    def __init__(self, rate_per_minute: float, burst: Optional[float] = None) -> None:
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, float(burst if burst else rate_per_minute))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def wait_time(self, now: float) -> float:
+        """距离有 1 个令牌可用的秒数，0 表示现在就可以发送"""
+        self._refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1.0
+
+    def available(self, now: float) -> int:
+        self._refill(now)
+        return int(self.tokens)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass(order=True)
+class OutboundMessage:
+    priority: int
+    seq: int
+    receiver: str = field(compare=False)
+    content: str = field(compare=False)
+    at_list: str = field(compare=False, default="")
+    enqueued_at: float = field(compare=False, default=0.0)
+
+
+@dataclass
+class SendQueueStats:
+    enqueued: int = 0
+    sent: int = 0
+    failed: int = 0
+    expired: int = 0
+    throttled: int = 0     # 发送线程因令牌不足而等待的次数
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    @property
+    def avg_wait(self) -> float:
+        return self.total_wait / self.sent if self.sent else 0.0
+
+
+class OutboundQueue:
+    """出站消息队列：由单独的发送线程按优先级、限流和发送节奏逐条发送
+
+    调用方（消息工作线程、流式回复线程、定时任务）只负责入队，立即返回，不会被发送节奏阻塞。
+    发送线程每次取出优先级最高、且接收者与全局令牌桶都有余量的最早一条消息：
+    - 回复优先于状态提示；状态提示排队超过 status_ttl 秒，或同一会话之后的回复已经发出时直接丢弃；
+    - 某个会话的令牌用完时只推迟该会话的消息，不影响其他会话；
+    - 超出频率限制的消息延后发送而不是丢弃。
+    """
+
+    def __init__(
+        self,
+        send: Callable[[OutboundMessage], None],
+        rate_limit: float = 0,
+        burst: Optional[float] = None,
+        per_receiver_rate_limit: float = 0,
+        per_receiver_burst: Optional[float] = None,
+        send_interval: Tuple[float, float] = DEFAULT_SEND_INTERVAL,
+        status_ttl: float = DEFAULT_STATUS_TTL,
+        logger: Any = None,
+    ) -> None:
+        self._send = send
+        self.logger = logger
+        self._global_bucket = TokenBucket(rate_limit, burst) if rate_limit and rate_limit > 0 else None
+        self.per_receiver_rate_limit = per_receiver_rate_limit if per_receiver_rate_limit and per_receiver_rate_limit > 0 else 0
+        self.per_receiver_burst = per_receiver_burst
+        low, high = send_interval
+        self.send_interval = (min(low, high), max(low, high))
+        self.status_ttl = status_ttl
+
+        self._heap: List[OutboundMessage] = []
+        self._seq = itertools.count()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._last_reply_seq: Dict[str, int] = {}  # 每个会话最近一条已发出的回复
+        self._next_send_at = 0.0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self._stop_deadline = 0.0
+        self._stats = SendQueueStats()
+
+    def start(self) -> None:
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="OutboundSender", daemon=True)
+        self._thread.start()
+
+    def submit(self, receiver: str, content: str, at_list: str = "", priority: int = PRIORITY_REPLY) -> None:
+        message = OutboundMessage(
+            priority=priority,
+            seq=next(self._seq),
+            receiver=receiver,
+            content=content,
+            at_list=at_list,
+            enqueued_at=time.monotonic(),
+        )
+        with self._cond:
+            if self._running:
+                self._stats.enqueued += 1
+                heapq.heappush(self._heap, message)
+                self._cond.notify()
+                return
+        self._deliver(message)  # 未启动或已停止时在调用方线程直接发送
+
+    def quota_remaining(self, receiver: Optional[str] = None) -> Optional[int]:
+        """还能立即发送的条数：全局令牌桶扣除所有排队消息；指定 receiver 时再与该会话令牌桶
+        扣除该会话排队消息（包括状态提示）后的余量取较小值。都未限流时返回 None"""
+        with self._cond:
+            now = time.monotonic()
+            quotas = []
+            if self._global_bucket is not None:
+                quotas.append(self._global_bucket.available(now) - len(self._heap))
+            bucket = self._receiver_bucket(receiver, now) if receiver else None
+            if bucket is not None:
+                queued = sum(1 for message in self._heap if message.receiver == receiver)
+                quotas.append(bucket.available(now) - queued)
+            return max(0, min(quotas)) if quotas else None
+
+    def stop(self, timeout: float = DEFAULT_STOP_TIMEOUT) -> None:
+        """停止接收新消息，在 timeout 秒内尽量发完剩余消息"""
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._stop_deadline = time.monotonic() + max(0.0, timeout)
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout + 1.0)
+        with self._cond:
+            left = len(self._heap)
+            self._heap.clear()
+        if left and self.logger:
+            self.logger.warning(f"发送队列退出时仍有 {left} 条消息未发送，已放弃")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stats = self._stats
+            return {
+                "enqueued": stats.enqueued,
+                "sent": stats.sent,
+                "failed": stats.failed,
+                "expired": stats.expired,
+                "throttled": stats.throttled,
+                "pending": len(self._heap),
+                "avg_wait": stats.avg_wait,
+                "max_wait": stats.max_wait,
+            }
+
+    def log_stats(self) -> None:
+        if not self.logger:
+            return
+        stats = self.get_stats()
+        if not stats["enqueued"]:
+            return
+        self.logger.info(
+            "发送队列统计: "
+            f"入队={stats['enqueued']}, 已发送={stats['sent']}, 失败={stats['failed']}, "
+            f"过期提示={stats['expired']}, 限流等待={stats['throttled']}次, 待发送={stats['pending']}, "
+            f"平均等待={stats['avg_wait']:.2f}s, 最大等待={stats['max_wait']:.2f}s"
+        )
+
+    # ---- 发送线程 ----
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                message, wait = self._next_message()
+                while message is None:
+                    if not self._running:
+                        left = self._stop_deadline - time.monotonic()
+                        if not self._heap or left <= 0:
+                            return
+                        wait = left if wait is None else min(wait, left)
+                    self._cond.wait(wait)
+                    message, wait = self._next_message()
+            self._deliver(message)
+            self._next_send_at = time.monotonic() + random.uniform(*self.send_interval)
+
+    def _next_message(self) -> Tuple[Optional[OutboundMessage], Optional[float]]:
+        """取出下一条可以发送的消息；都不能发送时返回需要等待的秒数（None 表示等待新消息）。调用方持有 _cond"""
+        now = time.monotonic()
+        self._prune_buckets(now)
+        if not self._heap:
+            return None, None
+        if now < self._next_send_at:
+            return None, self._next_send_at - now
+        if self._global_bucket is not None:
+            wait = self._global_bucket.wait_time(now)
+            if wait > 0:
+                self._stats.throttled += 1
+                return None, wait
+
+        skipped: List[OutboundMessage] = []
+        limited = set()  # 已推迟的会话：保证同一会话内的消息按顺序发出
+        chosen, min_wait = None, None
+        while self._heap:
+            message = heapq.heappop(self._heap)
+            if message.priority == PRIORITY_STATUS and self._is_stale(message, now):
+                self._stats.expired += 1
+                continue
+            if message.receiver in limited:
+                skipped.append(message)
+                continue
+            bucket = self._receiver_bucket(message.receiver, now)
+            wait = bucket.wait_time(now) if bucket is not None else 0.0
+            if wait > 0:
+                limited.add(message.receiver)
+                skipped.append(message)
+                min_wait = wait if min_wait is None else min(min_wait, wait)
+                continue
+            chosen = message
+            break
+        for message in skipped:
+            heapq.heappush(self._heap, message)
+        if chosen is None:
+            if min_wait is not None:
+                self._stats.throttled += 1
+            return None, min_wait
+
+        if self._global_bucket is not None:
+            self._global_bucket.take(now)
+        if bucket is not None:
+            bucket.take(now)
+        waited = now - chosen.enqueued_at
+        self._stats.total_wait += waited
+        self._stats.max_wait = max(self._stats.max_wait, waited)
+        if chosen.priority == PRIORITY_REPLY:
+            self._last_reply_seq[chosen.receiver] = chosen.seq
+        return chosen, None
+
+    def _is_stale(self, message: OutboundMessage, now: float) -> bool:
+        if self.status_ttl and now - message.enqueued_at > self.status_ttl:
+            return True
+        return self._last_reply_seq.get(message.receiver, -1) > message.seq
+
+    def _receiver_bucket(self, receiver: str, now: float) -> Optional[TokenBucket]:
+        if not self.per_receiver_rate_limit:
+            return None
+        bucket = self._buckets.get(receiver)
+        if bucket is None:
+            bucket = TokenBucket(self.per_receiver_rate_limit, self.per_receiver_burst)
+            self._buckets[receiver] = bucket
+        return bucket
+
+    def _prune_buckets(self, now: float) -> None:
+        """已经回满的会话令牌桶与回复记录可以丢弃，避免长期运行后无限增长"""
+        if len(self._buckets) > 1024:
+            self._buckets = {key: bucket for key, bucket in self._buckets.items() if not bucket.is_full(now)}
+        if len(self._last_reply_seq) > 1024 and not self._heap:
+            self._last_reply_seq.clear()
+
+    def _deliver(self, message: OutboundMessage) -> None:
+        try:
+            self._send(message)
+            with self._cond:
+                self._stats.sent += 1
+        except Exception as exc:
+            with self._cond:
+                self._stats.failed += 1
+            if self.logger:
+                self.logger.error(f"发送消息失败: {exc}", exc_info=True)
+
+
+def create_send_queue(config: Optional[Dict[str, Any]], rate_limit: float, send: Callable[[OutboundMessage], None],
+                      logger: Any = None) -> OutboundQueue:
+    """按 send_queue 配置创建发送队列；rate_limit 为全局每分钟上限（send_rate_limit），0 表示不限"""
+    config = config if isinstance(config, dict) else {}
+    interval = config.get("interval_seconds") or DEFAULT_SEND_INTERVAL
+    try:
+        low, high = (float(interval[0]), float(interval[1])) if isinstance(interval, (list, tuple)) else (0.0, float(interval))
+    except (TypeError, ValueError, IndexError):
+        low, high = DEFAULT_SEND_INTERVAL
+    return OutboundQueue(
+        send,
+        rate_limit=rate_limit,
+        burst=config.get("burst"),
+        per_receiver_rate_limit=_non_negative(config.get("per_receiver_rate_limit"), 0),
+        per_receiver_burst=config.get("per_receiver_burst"),
+        send_interval=(max(0.0, low), max(0.0, high)),
+        status_ttl=_non_negative(config.get("status_ttl_seconds"), DEFAULT_STATUS_TTL),
+        logger=logger,
+    )
+
+
+if __name__ == "__main__":
+    # 基准：8 个工作线程各自回复 5 条消息（其中夹带状态提示），对比原先在调用方线程 sleep + 限流丢弃
+    # 与入队后由发送线程统一发送时，工作线程被阻塞的时间和最终送达的条数
+    # 用法: python -m commands.send_queue
+    import logging
+    import statistics
+
+    logging.basicConfig(level=logging.WARNING)
+    SPEEDUP = 20
+    RATE_LIMIT = 30
+    WORKERS, REPLIES = 8, 5
+
+    def run_workers(send_fn):
+        blocked = []
+
+        def worker(index):
+            for n in range(REPLIES):
+                started = time.monotonic()
+                send_fn(f"room{index}", f"状态 {n}", PRIORITY_STATUS)
+                send_fn(f"room{index}", f"回复 {n}", PRIORITY_REPLY)
+                blocked.append((time.monotonic() - started) * SPEEDUP)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(WORKERS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return blocked
+
+    # 原实现：调用方线程 sleep 0.3~1.3 秒，60 秒窗口内超限直接丢弃
+    delivered, timestamps, lock = [], [], threading.Lock()
+
+    def legacy_send(receiver, content, priority):
+        time.sleep(random.uniform(*DEFAULT_SEND_INTERVAL) / SPEEDUP)
+        with lock:
+            now = time.monotonic()
+            timestamps[:] = [t for t in timestamps if (now - t) * SPEEDUP < 60]
+            if len(timestamps) >= RATE_LIMIT:
+                return
+            timestamps.append(now)
+            delivered.append(content)
+
+    blocked = run_workers(legacy_send)
+    print(f"原实现: 工作线程每次发送阻塞 平均 {statistics.mean(blocked):.2f}s，"
+          f"送达回复 {sum(c.startswith('回复') for c in delivered)}/{WORKERS * REPLIES}，共 {len(delivered)} 条")
+
+    delivered = []
+    queue = OutboundQueue(lambda m: delivered.append(m.content), rate_limit=RATE_LIMIT * SPEEDUP, burst=RATE_LIMIT,
+                          per_receiver_rate_limit=10 * SPEEDUP, per_receiver_burst=3,
+                          send_interval=(0.3 / SPEEDUP, 1.3 / SPEEDUP), status_ttl=DEFAULT_STATUS_TTL / SPEEDUP)
+    queue.start()
+    started = time.monotonic()
+    blocked = run_workers(lambda r, c, p: queue.submit(r, c, priority=p))
+    queue.stop(timeout=120)
+    stats = queue.get_stats()
+    print(f"发送队列: 工作线程每次发送阻塞 平均 {statistics.mean(blocked) * 1000:.2f}ms，"
+          f"送达回复 {sum(c.startswith('回复') for c in delivered)}/{WORKERS * REPLIES}，"
+          f"过期提示 {stats['expired']} 条，全部发完 {(time.monotonic() - started) * SPEEDUP:.0f}s")
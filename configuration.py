@@ -4,10 +4,111 @@
 import logging.config
 import os
 import shutil
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Optional, Tuple
 
 import yaml
 
 
+@dataclass(frozen=True)
+class ChatPolicy:
+    """单个会话（群或私聊）预先解析好的路由策略"""
+    chat_id: str
+    is_group: bool
+    model_id: Optional[int] = None              # 映射指定的模型ID，None 表示使用默认模型
+    max_history: Optional[Any] = None           # 映射指定的历史条数，None 表示使用模型默认值
+    random_chitchat_probability: float = 0.0    # 群聊随机闲聊基础概率
+    force_reasoning: bool = False               # 闲聊时强制使用推理模型
+    enabled: bool = False                       # 群是否在允许名单内（私聊恒为 True）
+    mapped: bool = False                        # 是否命中了 models.mapping / private_mapping
+    tools: Optional[Tuple[str, ...]] = None     # 映射指定的可用工具，None 表示不限制
+
+
+def _tool_allowlist(item: Dict[str, Any]) -> Optional[Tuple[str, ...]]:
+    """mapping 条目中的 tools 白名单；未配置时返回 None，空列表表示不提供任何工具"""
+    tools = item.get("tools")
+    if tools is None:
+        return None
+    if isinstance(tools, str):
+        tools = [tools]
+    return tuple(str(name) for name in tools)
+
+
+class ChatPolicyTable:
+    """按 chat_id 字典查找的会话策略表，在 Config.reload 中整体构建后一次性替换"""
+
+    def __init__(self, group_policies: Dict[str, ChatPolicy], private_policies: Dict[str, ChatPolicy],
+                 default_random_probability: float = 0.0) -> None:
+        self._groups = group_policies
+        self._privates = private_policies
+        self._default_group = ChatPolicy(
+            chat_id="", is_group=True, random_chitchat_probability=default_random_probability
+        )
+        self._default_private = ChatPolicy(chat_id="", is_group=False, enabled=True)
+
+    @classmethod
+    def build(cls, enabled_groups: Iterable[str], group_models: Dict[str, Any],
+              random_default: float = 0.0, random_mapping: Optional[Dict[str, float]] = None) -> "ChatPolicyTable":
+        enabled = set(enabled_groups or [])
+        random_mapping = random_mapping or {}
+        group_models = group_models if isinstance(group_models, dict) else {}
+
+        groups: Dict[str, ChatPolicy] = {}
+        # 与原先线性查找保持一致：同一个 room_id 出现多次时以第一条为准
+        for item in group_models.get("mapping", []) or []:
+            if not isinstance(item, dict):
+                continue
+            room_id = item.get("room_id")
+            if not room_id or room_id in groups:
+                continue
+            groups[room_id] = ChatPolicy(
+                chat_id=room_id,
+                is_group=True,
+                model_id=item.get("model"),
+                max_history=item.get("max_history"),
+                random_chitchat_probability=random_mapping.get(room_id, random_default),
+                force_reasoning=bool(item.get("force_reasoning", False)),
+                enabled=room_id in enabled,
+                mapped=True,
+                tools=_tool_allowlist(item),
+            )
+        for room_id in enabled | set(random_mapping):
+            if room_id not in groups:
+                groups[room_id] = ChatPolicy(
+                    chat_id=room_id,
+                    is_group=True,
+                    random_chitchat_probability=random_mapping.get(room_id, random_default),
+                    enabled=room_id in enabled,
+                )
+
+        privates: Dict[str, ChatPolicy] = {}
+        for item in group_models.get("private_mapping", []) or []:
+            if not isinstance(item, dict):
+                continue
+            wxid = item.get("wxid")
+            if not wxid or wxid in privates:
+                continue
+            privates[wxid] = ChatPolicy(
+                chat_id=wxid,
+                is_group=False,
+                model_id=item.get("model"),
+                max_history=item.get("max_history"),
+                enabled=True,
+                mapped=True,
+                tools=_tool_allowlist(item),
+            )
+
+        return cls(groups, privates, default_random_probability=random_default)
+
+    def lookup(self, chat_id: str, is_group: bool) -> ChatPolicy:
+        if is_group:
+            return self._groups.get(chat_id, self._default_group)
+        return self._privates.get(chat_id, self._default_private)
+
+    def __len__(self) -> int:
+        return len(self._groups) + len(self._privates)
+
+
 class Config(object):
     def __init__(self) -> None:
         self.reload()
@@ -84,17 +185,77 @@ class Config(object):
         self.GROUP_RANDOM_CHITCHAT_DEFAULT = legacy_default
         self.GROUP_RANDOM_CHITCHAT = random_chitchat_mapping
 
+        # 预先编译会话路由策略，整体替换引用，处理中的消息不会读到半更新的表
+        self.CHAT_POLICIES = ChatPolicyTable.build(
+            self.GROUPS,
+            self.GROUP_MODELS,
+            random_default=legacy_default,
+            random_mapping=random_chitchat_mapping,
+        )
+
         self.NEWS = yconfig["news"]["receivers"]
         self.CHATGPT = yconfig.get("chatgpt", {})
         self.DEEPSEEK = yconfig.get("deepseek", {})
         self.KIMI = yconfig.get("kimi", {})
         self.PERPLEXITY = yconfig.get("perplexity", {})
+        self.WEB_SEARCH_CACHE = yconfig.get("web_search_cache", {}) or {}
         self.ALIYUN_IMAGE = yconfig.get("aliyun_image", {})
-        self.AI_ROUTER = yconfig.get("ai_router", {"enable": True, "allowed_groups": []})
         self.AUTO_ACCEPT_FRIEND_REQUEST = yconfig.get("auto_accept_friend_request", False)
         self.MAX_HISTORY = yconfig.get("MAX_HISTORY", 300)
+        self.MESSAGE_HISTORY = yconfig.get("message_history", {}) or {}
         self.SEND_RATE_LIMIT = yconfig.get("send_rate_limit", 0)
+        self.SEND_QUEUE = yconfig.get("send_queue", {}) or {}
+        self.STREAMING = yconfig.get("streaming", {}) or {}
+        self.AGENT = yconfig.get("agent", {}) or {}
         self.MESSAGE_FORWARDING = yconfig.get(
             "message_forwarding",
             {"enable": False, "rules": []}
         )
+        self.MESSAGE_DISPATCHER = yconfig.get(
+            "message_dispatcher",
+            {"enable": True, "mode": "thread", "max_workers": 4, "chat_queue_size": 50}
+        )
+
+
+if __name__ == "__main__":
+    # 路由开销基准：1000 个映射群，对比线性扫描 mapping 与预编译策略表的单条消息开销
+    import random
+    import timeit
+
+    room_count = 1000
+    rooms = [f"{i:010d}@chatroom" for i in range(room_count)]
+    group_models = {
+        "default": 0,
+        "mapping": [
+            {"room_id": r, "model": 1 + i % 3, "max_history": 30, "force_reasoning": i % 7 == 0}
+            for i, r in enumerate(rooms)
+        ],
+        "private_mapping": [],
+    }
+    random_mapping = {r: 0.1 for r in rooms[::2]}
+    table = ChatPolicyTable.build(rooms, group_models, random_default=0.0, random_mapping=random_mapping)
+    probes = [random.choice(rooms) for _ in range(10000)]
+
+    def linear_scan():
+        for room_id in probes:
+            for mapping in group_models["mapping"]:  # _select_model_for_message
+                if mapping.get("room_id") == room_id:
+                    break
+            for mapping in group_models["mapping"]:  # _get_specific_history_limit
+                if mapping.get("room_id") == room_id:
+                    break
+            _ = room_id in rooms  # _is_group_enabled
+            _ = random_mapping.get(room_id, 0.0)
+
+    def policy_lookup():
+        for room_id in probes:
+            policy = table.lookup(room_id, True)
+            _ = (policy.model_id, policy.max_history, policy.enabled, policy.random_chitchat_probability)
+
+    build_cost = timeit.timeit(
+        lambda: ChatPolicyTable.build(rooms, group_models, random_mapping=random_mapping), number=10
+    ) / 10
+    for label, fn in (("线性扫描", linear_scan), ("策略表", policy_lookup)):
+        best = min(timeit.repeat(fn, number=1, repeat=5))
+        print(f"{label}: {best / len(probes) * 1e6:.2f} µs/消息")
+    print(f"策略表构建 ({room_count} 个群): {build_cost * 1e3:.2f} ms")
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""协作式取消
+
+Agent 的工具调用在线程中执行，线程无法被强制中断。每次工具调用都绑定一个 CancelToken
+（可带截止时间，也可以被主动取消），通过 contextvars 传到工具内部：
+发起网络请求的工具用 request_timeout() 作为请求超时，循环处理的工具定期检查 cancelled 提前退出，
+有副作用的工具在写入前调用 check_cancelled()，超时后不再落下已被调用方放弃的操作。
+工具超时或整轮对话的时间预算用完时，调用方取消对应的 token。
+"""
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+class ToolCancelled(Exception):
+    """工具调用已被取消或已超过截止时间"""
+
+
+class CancelToken:
+    """带截止时间的取消标记，子 token 继承父 token 的截止时间和取消状态"""
+
+    def __init__(self, timeout: Optional[float] = None, parent: Optional["CancelToken"] = None) -> None:
+        self._event = threading.Event()
+        self.parent = parent
+        self.reason = ""
+        self.deadline = None if timeout is None else time.monotonic() + max(0.0, float(timeout))
+        if parent is not None and parent.deadline is not None:
+            self.deadline = parent.deadline if self.deadline is None else min(self.deadline, parent.deadline)
+
+    def child(self, timeout: Optional[float] = None) -> "CancelToken":
+        return CancelToken(timeout, parent=self)
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        if self._event.is_set():
+            return True
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return True
+        return self.parent is not None and self.parent.cancelled
+
+    def remaining(self) -> Optional[float]:
+        """距截止时间的秒数，没有截止时间时返回 None"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def raise_if_cancelled(self) -> None:
+        if self.cancelled:
+            raise ToolCancelled(self.reason or "deadline exceeded")
+
+
+_current_token: contextvars.ContextVar[Optional[CancelToken]] = contextvars.ContextVar("cancel_token", default=None)
+
+
+def current_token() -> Optional[CancelToken]:
+    """当前工具调用绑定的 token，不在工具调用中时返回 None"""
+    return _current_token.get()
+
+
+@contextmanager
+def use_token(token: Optional[CancelToken]) -> Iterator[Optional[CancelToken]]:
+    """在当前上下文中绑定 token；asyncio.to_thread 和新建的 Task 会继承绑定"""
+    reset = _current_token.set(token)
+    try:
+        yield token
+    finally:
+        _current_token.reset(reset)
+
+
+def check_cancelled() -> None:
+    """产生副作用（写入提醒、发送消息等）之前调用：当前工具调用已被取消或超时时抛出 ToolCancelled"""
+    token = current_token()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def request_timeout(default: Optional[float] = None, minimum: float = 1.0) -> Optional[float]:
+    """当前工具调用剩余的秒数，可直接作为 HTTP 请求的 timeout
+
+    已被取消时抛出 ToolCancelled；没有截止时间时返回 default。
+    """
+    token = current_token()
+    if token is None:
+        return default
+    token.raise_if_cancelled()
+    remaining = token.remaining()
+    if remaining is None:
+        return default
+    return max(minimum, remaining)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""共享 SQLite 连接工厂
+
+MessageSummary、ReminderManager、PersonaManager 都读写 data/message_history.db，
+统一从这里创建连接，保证每个连接都启用 WAL 和相同的调优参数：
+WAL 模式下读不阻塞写、写不阻塞读，只有写与写之间互斥，并由 busy_timeout 排队等待。
+"""
+
+import logging
+import os
+import sqlite3
+from typing import Optional
+
+logger = logging.getLogger("SQLite")
+
+DEFAULT_BUSY_TIMEOUT_MS = 10000
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024   # 256MB，按需映射，不会预先占用内存
+DEFAULT_CACHE_SIZE_KB = 16 * 1024       # 每个连接 16MB 页缓存
+
+_wal_checked = set()  # 已确认启用 WAL 的数据库文件，避免重复输出日志
+
+
+def connect_sqlite(
+    db_path: str,
+    check_same_thread: bool = False,
+    row_factory=None,
+    busy_timeout_ms: int = DEFAULT_BUSY_TIMEOUT_MS,
+    mmap_size: int = DEFAULT_MMAP_SIZE,
+    cache_size_kb: int = DEFAULT_CACHE_SIZE_KB,
+) -> sqlite3.Connection:
+    """创建一个启用 WAL 和调优参数的 SQLite 连接
+
+    Args:
+        db_path: 数据库文件路径，所在目录不存在时自动创建
+        check_same_thread: 是否限制连接只能在创建它的线程中使用
+        row_factory: 可选的行工厂，例如 sqlite3.Row
+        busy_timeout_ms: 遇到写锁时的最长等待时间
+        mmap_size: 内存映射读取的最大字节数，0 表示关闭
+        cache_size_kb: 页缓存大小 (KB)
+
+    Returns:
+        sqlite3.Connection: 已设置好 PRAGMA 的连接
+    """
+    db_dir = os.path.dirname(db_path)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir, exist_ok=True)
+
+    conn = sqlite3.connect(
+        db_path,
+        timeout=busy_timeout_ms / 1000.0,
+        check_same_thread=check_same_thread,
+    )
+    if row_factory is not None:
+        conn.row_factory = row_factory
+
+    journal_mode = _enable_wal(conn, db_path)
+    # WAL 下 NORMAL 只在检查点时 fsync，断电最多丢失最近的事务，不会损坏数据库
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+    conn.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+    conn.execute(f"PRAGMA cache_size={-int(cache_size_kb)}")  # 负数表示以 KB 为单位
+    conn.execute("PRAGMA temp_store=MEMORY")
+
+    if journal_mode != "wal" and db_path != ":memory:":
+        logger.warning(f"数据库 {db_path} 未能启用 WAL 模式，当前为 {journal_mode}")
+    return conn
+
+
+def _enable_wal(conn: sqlite3.Connection, db_path: str) -> Optional[str]:
+    # journal_mode=WAL 是持久化在数据库文件上的，但每个连接设置一次代价很低
+    try:
+        row = conn.execute("PRAGMA journal_mode=WAL").fetchone()
+    except sqlite3.OperationalError as e:
+        # 另一个连接正持有写锁时切换模式会失败；文件若已是 WAL 则不影响
+        logger.warning(f"切换 {db_path} 到 WAL 模式失败: {e}")
+        row = conn.execute("PRAGMA journal_mode").fetchone()
+    journal_mode = str(row[0]).lower() if row else None
+    if journal_mode == "wal" and db_path not in _wal_checked:
+        _wal_checked.add(db_path)
+        logger.info(f"数据库 {db_path} 已启用 WAL 模式")
+    return journal_mode
+
+
+if __name__ == "__main__":
+    # 压力测试：多个线程各自持有连接，同时读写同一个数据库文件
+    # 用法: python -m function.func_db
+    import tempfile
+    import threading
+    import time
+
+    WRITERS = 4
+    READERS = 8
+    DURATION = 5.0
+
+    def _plain_connect(db_path: str) -> sqlite3.Connection:
+        # 对照组：默认回滚日志模式，只缩短锁等待时间以暴露锁冲突
+        return sqlite3.connect(db_path, timeout=0.05, check_same_thread=False)
+
+    def _stress(connect, label: str) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, "stress.db")
+            setup = connect(db_path)
+            setup.execute(
+                "CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id TEXT, content TEXT, ts REAL)"
+            )
+            setup.execute("CREATE INDEX idx_chat_ts ON messages (chat_id, ts)")
+            setup.commit()
+
+            stop_at = time.monotonic() + DURATION
+            counters = {"writes": 0, "reads": 0, "locked": 0, "other_errors": 0}
+            counter_lock = threading.Lock()
+
+            def bump(key: str, amount: int = 1) -> None:
+                with counter_lock:
+                    counters[key] += amount
+
+            def writer(index: int) -> None:
+                conn = connect(db_path)
+                while time.monotonic() < stop_at:
+                    try:
+                        conn.executemany(
+                            "INSERT INTO messages (chat_id, content, ts) VALUES (?, ?, ?)",
+                            [(f"chat_{index}", "压力测试消息" * 5, time.time()) for _ in range(20)],
+                        )
+                        conn.commit()
+                        bump("writes", 20)
+                    except sqlite3.OperationalError as e:
+                        conn.rollback()
+                        bump("locked" if "locked" in str(e) else "other_errors")
+                conn.close()
+
+            def reader(index: int) -> None:
+                conn = connect(db_path)
+                while time.monotonic() < stop_at:
+                    try:
+                        conn.execute(
+                            "SELECT content FROM messages WHERE chat_id = ? ORDER BY ts DESC LIMIT 300",
+                            (f"chat_{index % WRITERS}",),
+                        ).fetchall()
+                        bump("reads")
+                    except sqlite3.OperationalError as e:
+                        bump("locked" if "locked" in str(e) else "other_errors")
+                conn.close()
+
+            threads = [threading.Thread(target=writer, args=(i,)) for i in range(WRITERS)]
+            threads += [threading.Thread(target=reader, args=(i,)) for i in range(READERS)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            setup.close()
+
+        print(
+            f"{label:<10} 写入={counters['writes']:>7} 读取={counters['reads']:>7} "
+            f"database is locked={counters['locked']:>5} 其他错误={counters['other_errors']}"
+        )
+
+    logging.basicConfig(level=logging.WARNING)
+    print(f"{WRITERS} 个写线程 + {READERS} 个读线程，持续 {DURATION:.0f}s")
+    _stress(_plain_connect, "默认配置")
+    _stress(connect_sqlite, "WAL")
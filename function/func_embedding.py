@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+"""本地消息向量化
+
+为聊天记录的语义检索提供离线、纯 CPU 的文本向量：把文本切成字符 n-gram 和英文单词，
+用特征哈希 (feature hashing) 映射到固定维度并做 L2 归一化，向量间的点积即余弦相似度。
+不需要下载模型，也不依赖网络；措辞不同但共享字词的句子（"周末吃火锅" / "周六去吃火锅吗"）
+能得到较高的相似度。它本质上是字符重叠的模糊匹配，没有公共字词的同义说法（"火锅" / "涮肉"）无法命中。
+
+每个特征哈希到两个桶，单个桶冲突只贡献一半权重；只有一两个特征的短消息（"笑死"、"666"）
+仍可能因冲突得到虚高的相似度，因此检索时还要求锚点与查询至少共享一个多字符片段（key_terms）。
+
+任何提供 name、dim、embed、to_blob、from_blobs 和 similarities 的对象都可以替换
+HashingEmbedder 传给 MessageSummary，例如封装一个本地句向量模型；也可以在配置
+message_history.semantic_search.embedder 中以 "模块:类名" 指定，由 create_embedder 加载。
+"""
+
+import importlib
+import logging
+import math
+import re
+import zlib
+from collections import Counter
+from typing import Any, List, Optional, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # numpy 随 pandas 安装，缺失时语义检索不可用
+    np = None
+
+logger = logging.getLogger("Embedding")
+
+DEFAULT_EMBEDDING_DIM = 512  # 维度过低时哈希冲突会带来明显的噪声相似度
+QUANT_SCALE = 127.0  # 入库时把单位向量各分量量化为 int8（每维 1 字节），检索时再除回
+EMBEDDER_METHODS = ("embed", "to_blob", "from_blobs", "similarities")
+
+_ASCII_WORD = re.compile(r"[a-z0-9_]+")
+_NON_ASCII_RUN = re.compile(r"[^\x00-\x7f\s\u3000-\u303f\uff00-\uff0f\uff1a-\uff20]+")  # 跳过中文标点
+
+# 各类特征的权重：中文以双字词为主，单字和三字作为补充
+_WEIGHT_WORD = 1.0
+_WEIGHT_WORD_TRIGRAM = 0.3
+_WEIGHT_UNIGRAM = 0.4
+_WEIGHT_BIGRAM = 1.0
+_WEIGHT_TRIGRAM = 0.5
+_HASH_SEED_2 = 0x9E3779B9  # 第二个桶使用不同初值的 crc32
+
+
+class HashingEmbedder:
+    """字符 n-gram 特征哈希向量
+
+    同一段文本在任何进程中都得到相同的向量（使用 crc32 而不是带随机种子的 hash()），
+    因此写入数据库的向量在重启后仍然可用。每个特征分摊到两个桶，降低冲突带来的噪声相似度。
+    """
+
+    def __init__(self, dim: int = DEFAULT_EMBEDDING_DIM):
+        if np is None:
+            raise RuntimeError("HashingEmbedder 需要 numpy")
+        self.dim = int(dim)
+        self.name = f"hashing2-{self.dim}"
+        self._feature_cache = {}  # 特征字符串 -> ((下标, 符号), (下标, 符号))，常用字词反复出现
+
+    def embed(self, texts: Sequence[str]) -> "np.ndarray":
+        """把一批文本转换为 (len(texts), dim) 的 float32 单位向量，空文本得到零向量"""
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            features = self._features(text)
+            if not features:
+                continue
+            for feature, weight in features.items():
+                for index, sign in self._hash(feature):
+                    vectors[row, index] += sign * weight
+            norm = float(np.linalg.norm(vectors[row]))
+            if norm > 0:
+                vectors[row] /= norm
+        return vectors
+
+    def to_blob(self, vector: "np.ndarray") -> bytes:
+        return np.clip(np.rint(vector * QUANT_SCALE), -127, 127).astype(np.int8).tobytes()
+
+    def from_blobs(self, blobs: List[bytes]) -> "np.ndarray":
+        """把一批入库向量还原为 (len(blobs), dim) 的 int8 矩阵"""
+        if not blobs:
+            return np.zeros((0, self.dim), dtype=np.int8)
+        return np.frombuffer(b"".join(blobs), dtype=np.int8).reshape(len(blobs), self.dim)
+
+    def similarities(self, query_vector: "np.ndarray", matrix: "np.ndarray") -> "np.ndarray":
+        """计算查询向量与 from_blobs 矩阵各行的余弦相似度（暴力检索，单个聊天至多 max_history 条）"""
+        return (matrix @ (query_vector.astype(np.float32) / QUANT_SCALE)).astype(np.float32)
+
+    def key_terms(self, text: Optional[str]) -> List[str]:
+        """文本中的多字符片段（英文单词、中文双字），锚点的小写正文至少包含其一才算真正相关"""
+        if not text:
+            return []
+        text = text.lower()
+        terms = {word for word in _ASCII_WORD.findall(text) if len(word) >= 2}
+        for run in _NON_ASCII_RUN.findall(text):
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+        return sorted(terms)
+
+    def _hash(self, feature: str):
+        cached = self._feature_cache.get(feature)
+        if cached is None:
+            data = feature.encode("utf-8")
+            cached = tuple(
+                (h % self.dim, 1.0 if h & 0x80000000 else -1.0)
+                for h in (zlib.crc32(data), zlib.crc32(data, _HASH_SEED_2))
+            )
+            if len(self._feature_cache) < 200000:
+                self._feature_cache[feature] = cached
+        return cached
+
+    @staticmethod
+    def _features(text: Optional[str]) -> Counter:
+        features = Counter()
+        if not text:
+            return features
+        text = text.lower()
+
+        for word in _ASCII_WORD.findall(text):
+            features["w:" + word] += _WEIGHT_WORD
+            if len(word) > 4:  # 长单词再切三字母片段，兼顾 deploy / deployment 这类词形变化
+                for i in range(len(word) - 2):
+                    features["t:" + word[i:i + 3]] += _WEIGHT_WORD_TRIGRAM
+
+        for run in _NON_ASCII_RUN.findall(text):
+            for i, char in enumerate(run):
+                features[char] += _WEIGHT_UNIGRAM
+                if i + 2 <= len(run):
+                    features[run[i:i + 2]] += _WEIGHT_BIGRAM
+                if i + 3 <= len(run):
+                    features[run[i:i + 3]] += _WEIGHT_TRIGRAM
+
+        # 次线性词频，避免刷屏式重复的消息占据过大权重
+        for feature, weight in features.items():
+            features[feature] = 1 + math.log(weight) if weight > 1 else weight
+        return features
+
+
+def load_embedder(spec: str, options: Optional[dict] = None) -> Any:
+    """按 "模块:类名" 加载自定义向量化器，options 作为关键字参数传给构造函数"""
+    module_name, sep, class_name = spec.partition(":")
+    if not sep or not module_name or not class_name:
+        raise ValueError(f"向量化器应写成 模块:类名，而不是 {spec!r}")
+    embedder = getattr(importlib.import_module(module_name), class_name)(**(options or {}))
+    missing = [attr for attr in ("dim",) + EMBEDDER_METHODS if not hasattr(embedder, attr)]
+    if missing:
+        raise TypeError(f"向量化器 {spec} 缺少 {', '.join(missing)}")
+    if not getattr(embedder, "name", None):
+        embedder.name = spec
+    return embedder
+
+
+def create_embedder(
+    dim: int = DEFAULT_EMBEDDING_DIM,
+    spec: Optional[str] = None,
+    options: Optional[dict] = None,
+) -> Optional[Any]:
+    """创建向量化器：配置了 spec 时加载自定义实现，否则（或加载失败时）使用 HashingEmbedder；
+    numpy 不可用时返回 None"""
+    if spec:
+        try:
+            embedder = load_embedder(spec, options)
+            logger.info(f"已加载向量化器 {embedder.name} (dim={embedder.dim})")
+            return embedder
+        except Exception as e:
+            logger.error(f"加载向量化器 {spec} 失败，改用字符 n-gram 向量: {e}", exc_info=True)
+    if np is None:
+        logger.warning("未安装 numpy，聊天记录语义检索不可用")
+        return None
+    return HashingEmbedder(dim=dim)
+
+
+if __name__ == "__main__":
+    # 基准测试：10 万条消息（10 个聊天 × 1 万条）下的写入开销与语义检索延迟
+    # 用法: python -m function.func_embedding
+    import os
+    import random
+    import statistics
+    import tempfile
+    import time
+
+    from function.func_summary import MessageSummary
+
+    CHATS = 10
+    PER_CHAT = 10000
+    QUERIES = 200
+
+    words = ["今天", "天气", "不错", "周末", "一起", "吃饭", "火锅", "项目", "进度", "会议", "Python", "deploy",
+             "服务器", "数据库", "报错", "重启", "测试", "上线", "好的", "哈哈", "明天", "下班", "加班", "电影"]
+    queries = ["周末去吃火锅吗", "服务器报错了怎么办", "项目什么时候上线", "明天开会讨论进度", "deploy 失败",
+               "晚上一起看电影", "数据库要不要重启", "今天天气怎么样"]
+
+    def _fill(semantic: bool, db_path: str) -> float:
+        rng = random.Random(5)
+        summary = MessageSummary(max_history=PER_CHAT, db_path=db_path, semantic_search=semantic)
+        started = time.perf_counter()
+        for i in range(PER_CHAT):
+            for c in range(CHATS):
+                content = "".join(rng.choice(words) for _ in range(rng.randint(3, 10)))
+                summary.record_message(f"chat_{c}", f"用户{i % 7}", f"wxid_{i % 7}", content)
+        summary.close_db()
+        return time.perf_counter() - started
+
+    logging.basicConfig(level=logging.ERROR)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        plain_seconds = _fill(False, os.path.join(tmp_dir, "plain.db"))
+        db_path = os.path.join(tmp_dir, "semantic.db")
+        semantic_seconds = _fill(True, db_path)
+        total = CHATS * PER_CHAT
+        print(f"写入 {total} 条消息: 不生成向量 {plain_seconds:.1f}s，生成向量 {semantic_seconds:.1f}s "
+              f"(每条额外 {(semantic_seconds - plain_seconds) / total * 1e6:.0f}µs，在后台写线程中)")
+
+        summary = MessageSummary(max_history=PER_CHAT, db_path=db_path)
+        rng = random.Random(9)
+        latencies = []
+        for _ in range(QUERIES):
+            chat_id = f"chat_{rng.randrange(CHATS)}"
+            start = time.perf_counter()
+            results = summary.search_messages_semantic(chat_id, rng.choice(queries), context_window=10, max_groups=10)
+            latencies.append((time.perf_counter() - start) * 1000)
+        latencies.sort()
+        print(f"语义检索 ({PER_CHAT} 条/聊天，{QUERIES} 次查询): 平均 {statistics.mean(latencies):.1f}ms, "
+              f"p50 {latencies[len(latencies) // 2]:.1f}ms, p99 {latencies[int(len(latencies) * 0.99) - 1]:.1f}ms, "
+              f"最后一次返回 {len(results)} 组")
+
+        # 旧数据补齐：删除一个聊天的向量，测量首次检索时的补齐耗时
+        with summary._write_lock:
+            summary.conn.execute(
+                "DELETE FROM message_vectors WHERE id IN (SELECT id FROM messages WHERE chat_id = 'chat_0')"
+            )
+            summary.conn.commit()
+        summary._vector_ready_chats.clear()
+        start = time.perf_counter()
+        summary.search_messages_semantic("chat_0", queries[0])
+        print(f"为 {PER_CHAT} 条旧消息补齐向量并检索: {(time.perf_counter() - start):.2f}s")
+
+        # 噪声锚点检查：大量"笑死""666"之类的短消息中夹着一条相关消息，
+        # 检索结果不应出现因哈希冲突而入选、与查询没有公共片段的短消息
+        fillers = ["笑死", "嗯嗯", "666", "ok", "哈哈哈", "好的", "收到", "在吗", "571", "[捂脸]", "啊这", "绝了"]
+        rng = random.Random(3)
+        for i in range(1500):
+            summary.record_message("noise", "用户", "wxid_noise", rng.choice(fillers))
+            if i == 700:
+                summary.record_message("noise", "用户", "wxid_noise", "下个月房租怎么分摊，大家商量一下")
+        noise_queries = ["房租怎么分", "房租", "会议", "开会时间", "门卫", "上线时间", "年会节目"]
+        junk = []
+        for query in noise_queries:
+            for group in summary.search_messages_semantic("noise", query, context_window=0, max_groups=5,
+                                                          exclude_recent=0):
+                anchor = group["formatted_messages"][0].rsplit(" ", 1)[-1]
+                if anchor in fillers:
+                    junk.append((query, anchor, group["relevance"]))
+        print(f"噪声锚点检查 ({len(noise_queries)} 个查询): {len(junk)} 个无关锚点 {junk[:3]}")
+        assert not junk, junk
+        summary.close_db()
@@ -1,11 +1,14 @@
 import logging
 import os
 import sqlite3
+import threading
 from datetime import datetime
 from typing import Optional, Tuple
 
 from typing import TYPE_CHECKING
 
+from function.func_db import connect_sqlite
+
 if TYPE_CHECKING:  # pragma: no cover
     from commands.context import MessageContext
     from robot import Robot
@@ -20,7 +23,8 @@ class PersonaManager:
         self.LOG = logging.getLogger("PersonaManager")
         self.db_path = db_path
         self.conn: Optional[sqlite3.Connection] = None
-        self.cursor: Optional[sqlite3.Cursor] = None
+        # 连接会被多个消息工作线程同时使用，每次操作都在锁内用 conn.execute 创建独立游标
+        self._lock = threading.Lock()
         self._connect()
         self._prepare_table()
 
@@ -31,17 +35,16 @@ class PersonaManager:
                 os.makedirs(db_dir, exist_ok=True)
                 self.LOG.info(f"Created persona database directory: {db_dir}")
 
-            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-            self.cursor = self.conn.cursor()
+            self.conn = connect_sqlite(self.db_path)
             self.LOG.info(f"PersonaManager connected to database: {self.db_path}")
         except sqlite3.Error as exc:
             self.LOG.error(f"Failed to connect persona database: {exc}")
             raise
 
     def _prepare_table(self) -> None:
-        assert self.cursor is not None
+        assert self.conn is not None
         try:
-            self.cursor.execute(
+            self.conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS personas (
                     chat_id TEXT PRIMARY KEY,
@@ -63,51 +66,52 @@ class PersonaManager:
             raise ValueError("persona must not be None when setting persona")
 
         persona = persona.strip()
-        assert self.cursor is not None
+        assert self.conn is not None
 
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        try:
-            self.cursor.execute(
-                """
-                INSERT INTO personas (chat_id, persona, setter_wxid, updated_at)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(chat_id) DO UPDATE SET
-                    persona=excluded.persona,
-                    setter_wxid=excluded.setter_wxid,
-                    updated_at=excluded.updated_at
-                """,
-                (chat_id, persona, setter_wxid, timestamp),
-            )
-            self.conn.commit()
-            self.LOG.info(f"Persona updated for chat_id={chat_id}")
-        except sqlite3.Error as exc:
-            self.conn.rollback()
-            self.LOG.error(f"Failed to set persona for {chat_id}: {exc}")
-            raise
+        with self._lock:
+            try:
+                self.conn.execute(
+                    """
+                    INSERT INTO personas (chat_id, persona, setter_wxid, updated_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(chat_id) DO UPDATE SET
+                        persona=excluded.persona,
+                        setter_wxid=excluded.setter_wxid,
+                        updated_at=excluded.updated_at
+                    """,
+                    (chat_id, persona, setter_wxid, timestamp),
+                )
+                self.conn.commit()
+            except sqlite3.Error as exc:
+                self.conn.rollback()
+                self.LOG.error(f"Failed to set persona for {chat_id}: {exc}")
+                raise
+        self.LOG.info(f"Persona updated for chat_id={chat_id}")
 
     def clear_persona(self, chat_id: str) -> bool:
         if not chat_id:
             return False
-        assert self.cursor is not None
-        try:
-            self.cursor.execute("DELETE FROM personas WHERE chat_id = ?", (chat_id,))
-            deleted = self.cursor.rowcount
-            self.conn.commit()
-            if deleted:
-                self.LOG.info(f"Persona cleared for chat_id={chat_id}")
-            return bool(deleted)
-        except sqlite3.Error as exc:
-            self.conn.rollback()
-            self.LOG.error(f"Failed to clear persona for {chat_id}: {exc}")
-            return False
+        assert self.conn is not None
+        with self._lock:
+            try:
+                deleted = self.conn.execute("DELETE FROM personas WHERE chat_id = ?", (chat_id,)).rowcount
+                self.conn.commit()
+            except sqlite3.Error as exc:
+                self.conn.rollback()
+                self.LOG.error(f"Failed to clear persona for {chat_id}: {exc}")
+                return False
+        if deleted:
+            self.LOG.info(f"Persona cleared for chat_id={chat_id}")
+        return bool(deleted)
 
     def get_persona(self, chat_id: str) -> Optional[str]:
         if not chat_id:
             return None
-        assert self.cursor is not None
+        assert self.conn is not None
         try:
-            self.cursor.execute("SELECT persona FROM personas WHERE chat_id = ?", (chat_id,))
-            row = self.cursor.fetchone()
+            with self._lock:
+                row = self.conn.execute("SELECT persona FROM personas WHERE chat_id = ?", (chat_id,)).fetchone()
             return row[0] if row else None
         except sqlite3.Error as exc:
             self.LOG.error(f"Failed to fetch persona for {chat_id}: {exc}")
@@ -116,8 +120,9 @@ class PersonaManager:
     def close(self) -> None:
         if self.conn:
             try:
-                self.conn.commit()
-                self.conn.close()
+                with self._lock:
+                    self.conn.commit()
+                    self.conn.close()
                 self.LOG.info("PersonaManager database connection closed")
             except sqlite3.Error as exc:
                 self.LOG.error(f"Failed to close persona database connection: {exc}")
@@ -9,6 +9,8 @@ import logging
 import threading
 from typing import Optional, Dict, Tuple  # 添加类型提示导入
 
+from function.func_db import connect_sqlite
+
 # 获取 Logger 实例
 logger = logging.getLogger("ReminderManager")
 
@@ -25,6 +27,8 @@ class ReminderManager:
         """
         self.robot = robot
         self.db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None  # 复用同一个连接，由 _db_lock 串行化访问
+        self._change_listeners = []  # 提醒增删/触发删除后的回调 (wxid)，例如作废工具结果缓存
         self._create_table() # 初始化时确保表存在
 
         # 注册周期性检查任务
@@ -32,16 +36,42 @@ class ReminderManager:
         logger.info(f"提醒管理器已初始化，连接到数据库 '{db_path}'，每 {check_interval_minutes} 分钟检查一次。")
 
     def _get_db_conn(self) -> sqlite3.Connection:
-        """获取数据库连接"""
+        """获取数据库连接（调用方需持有 _db_lock）
+
+        返回的连接在实例内复用；`with conn:` 只管理事务的提交/回滚，不会关闭连接。
+        """
+        if self._conn is not None:
+            return self._conn
         try:
-            # connect_timeout 增加等待时间，check_same_thread=False 允许其他线程使用 (配合锁)
-            conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
-            conn.row_factory = sqlite3.Row # 让查询结果可以像字典一样访问列
-            return conn
+            # 共享连接工厂启用 WAL 和 busy_timeout，check_same_thread=False 允许其他线程使用 (配合锁)
+            self._conn = connect_sqlite(self.db_path, row_factory=sqlite3.Row) # 让查询结果可以像字典一样访问列
+            return self._conn
         except sqlite3.Error as e:
             logger.error(f"无法连接到 SQLite 数据库 '{self.db_path}': {e}", exc_info=True)
             raise # 连接失败是严重问题，直接抛出异常
 
+    def close(self):
+        """关闭数据库连接"""
+        with self._db_lock:
+            if self._conn is not None:
+                try:
+                    self._conn.close()
+                except sqlite3.Error as e:
+                    logger.error(f"关闭提醒数据库连接时出错: {e}")
+                self._conn = None
+
+    def add_change_listener(self, callback):
+        """注册提醒变更回调，callback(wxid) 在提醒新增、删除或一次性提醒触发删除之后调用"""
+        self._change_listeners.append(callback)
+
+    def _notify_change_listeners(self, wxids):
+        for wxid in wxids:
+            for callback in self._change_listeners:
+                try:
+                    callback(wxid)
+                except Exception as e:
+                    logger.error(f"提醒变更回调执行失败: {e}")
+
     def _create_table(self):
         """创建 reminders 表（如果不存在）"""
         sql = """
@@ -186,6 +216,7 @@ class ReminderManager:
             # 记录日志时包含群聊信息
             log_target = f"用户 {wxid}" + (f" 在群聊 {roomid}" if roomid else "")
             logger.info(f"成功添加提醒 {reminder_id} for {log_target} 到数据库。")
+            self._notify_change_listeners([wxid])
             return True, reminder_id
         except sqlite3.IntegrityError as e: # 例如，如果 UUID 冲突 (极不可能)
             logger.error(f"添加提醒失败 (数据冲突): {e}", exc_info=True)
@@ -203,6 +234,7 @@ class ReminderManager:
         current_hm = now.strftime("%H:%M") # 当前时分
         
         reminders_to_delete = [] # 存储需要删除的 once 提醒 ID
+        changed_wxids = set() # 有提醒被删除的用户，提交后通知变更回调
         reminders_to_update = [] # 存储需要更新 last_triggered_at 的 daily/weekly 提醒 ID
 
         try:
@@ -221,6 +253,7 @@ class ReminderManager:
                     for reminder in due_once_reminders:
                         self._send_reminder(reminder["wxid"], reminder["content"], reminder["id"], reminder["roomid"])
                         reminders_to_delete.append(reminder["id"])
+                        changed_wxids.add(reminder["wxid"])
                         logger.info(f"一次性提醒 {reminder['id']} 已触发并标记删除。")
 
                     # 2. 查询到期的每日提醒
@@ -292,6 +325,9 @@ class ReminderManager:
                     if reminders_to_delete or reminders_to_update:
                         conn.commit()
 
+            # 在锁外通知，避免回调里再访问提醒数据库时死锁
+            self._notify_change_listeners(changed_wxids)
+
         except sqlite3.Error as e:
             logger.error(f"检查并触发提醒时数据库出错: {e}", exc_info=True)
         except Exception as e: # 捕获其他潜在错误
@@ -380,7 +416,9 @@ class ReminderManager:
                     # 在日志中记录位置信息
                     location_info = f"在群聊 {roomid}" if roomid else "在私聊"
                     logger.info(f"用户 {wxid} 成功删除了{location_info}设置的提醒 {reminder_id}")
-                    return True, f"已成功删除提醒 (ID: {reminder_id[:6]}...)"
+
+            self._notify_change_listeners([wxid])
+            return True, f"已成功删除提醒 (ID: {reminder_id[:6]}...)"
 
         except sqlite3.Error as e:
             logger.error(f"用户 {wxid} 删除提醒 {reminder_id} 时数据库出错: {e}", exc_info=True)
@@ -414,7 +452,9 @@ class ReminderManager:
                     conn.commit()
                     
                     logger.info(f"用户 {wxid} 删除了其所有 {count} 条提醒")
-                    return True, f"已成功删除您的所有提醒（共 {count} 条）。", count
+
+            self._notify_change_listeners([wxid])
+            return True, f"已成功删除您的所有提醒（共 {count} 条）。", count
                     
         except sqlite3.Error as e:
             logger.error(f"用户 {wxid} 删除所有提醒时数据库出错: {e}", exc_info=True)
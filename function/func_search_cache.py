@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+
+"""联网搜索结果缓存
+
+web_search 每次调用 Perplexity 要等 5~20 秒并产生费用，而不同群经常在一两个小时内问同一个问题。
+这里把搜索结果持久化到消息历史所在的 SQLite 数据库 (web_search_cache 表)：
+
+- 键为归一化后的查询文本 + deep_research 标记；归一化会去掉标点、空白和"请问/帮我查一下"之类的口头词；
+- 按查询类别设置新鲜度：实时行情/天气很快过期，新闻类几小时，一般知识可以保留数天；
+- 近似重复：归一化文本的字符二元组 Jaccard 相似度超过阈值、且其中的数字完全相同时视为同一问题；
+- 条目数超过上限时按最近使用时间淘汰，过期条目由定时任务 evict() 清理。
+
+近似匹配使用内存中的二元组倒排索引，条目数受 max_entries 限制，查找只比较有公共二元组的候选。
+"""
+
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter
+from typing import Dict, FrozenSet, Optional, Set, Tuple
+
+from function.func_db import connect_sqlite
+
+DEFAULT_MAX_ENTRIES = 2000
+DEFAULT_SIMILARITY = 0.85
+DEFAULT_FRESHNESS_MINUTES = {
+    "realtime": 15,          # 天气、股价、汇率、比分等
+    "news": 120,             # 新闻、"今天/最新"类问题
+    "general": 7 * 24 * 60,  # 其他事实性问题
+}
+
+# 查询类别，按顺序匹配归一化后的文本，都不匹配时为 general
+QUERY_CLASSES = (
+    ("realtime", re.compile(r"天气|气温|下雨|股价|股票|汇率|油价|金价|比分|实时|现在|此刻|行情|weather|price|stock|score")),
+    ("news", re.compile(r"新闻|今天|今日|昨天|昨日|最新|最近|近期|刚刚|本周|这周|热搜|消息|news|today|latest|recent")),
+)
+
+_FILLERS = re.compile(r"请问|请帮我|帮我|帮忙|查一下|搜一下|搜索一下|查询一下|查查|搜搜|一下|告诉我|你知道|知道吗|是什么呢|呢|吗|呀|啊|吧")
+_PUNCTUATION = re.compile(r"[\W_]+", re.UNICODE)
+_DIGITS = re.compile(r"\d+")
+
+# Perplexity.get_answer 出错时返回以这些前缀开头的文本，不缓存
+_ERROR_PREFIXES = ("发生错误", "Perplexity API key")
+
+
+def is_error_response(response: str) -> bool:
+    """Perplexity 以文本返回的失败信息（超时、接口错误、未配置）"""
+    return response.startswith(_ERROR_PREFIXES)
+
+
+def normalize_query(query: str) -> str:
+    """查询归一化：全角转半角、忽略大小写、去掉口头词、标点与空白"""
+    text = unicodedata.normalize("NFKC", query or "").casefold()
+    text = _FILLERS.sub("", text)
+    return _PUNCTUATION.sub("", text)
+
+
+def classify_query(normalized: str) -> str:
+    for name, pattern in QUERY_CLASSES:
+        if pattern.search(normalized):
+            return name
+    return "general"
+
+
+def _shingles(normalized: str) -> FrozenSet[str]:
+    if len(normalized) < 2:
+        return frozenset((normalized,)) if normalized else frozenset()
+    return frozenset(normalized[i:i + 2] for i in range(len(normalized) - 1))
+
+
+class SearchCache:
+    """持久化的联网搜索结果缓存，线程安全"""
+
+    def __init__(
+        self,
+        db_path: str,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        similarity: float = DEFAULT_SIMILARITY,
+        freshness_minutes: Optional[Dict[str, float]] = None,
+    ) -> None:
+        self.LOG = logging.getLogger("SearchCache")
+        self.db_path = db_path
+        self.max_entries = max(1, int(max_entries))
+        self.similarity = min(1.0, max(0.0, float(similarity)))
+        self.freshness = {name: minutes * 60 for name, minutes in DEFAULT_FRESHNESS_MINUTES.items()}
+        for name, minutes in (freshness_minutes or {}).items():
+            try:
+                self.freshness[name] = max(0.0, float(minutes)) * 60
+            except (TypeError, ValueError):
+                self.LOG.warning(f"忽略无效的新鲜度配置: {name}={minutes}")
+
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = connect_sqlite(db_path)
+        self._create_table()
+
+        # 内存索引：id -> (归一化文本, deep_research, 类别, 写入时间, 二元组)，以及二元组倒排表
+        self._entries: Dict[int, Tuple[str, bool, str, float, FrozenSet[str]]] = {}
+        self._exact: Dict[Tuple[str, bool], int] = {}
+        self._postings: Dict[str, Set[int]] = {}
+        self._load_index()
+
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def _create_table(self) -> None:
+        with self._lock:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS web_search_cache (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    query TEXT NOT NULL,
+                    query_norm TEXT NOT NULL,
+                    deep_research INTEGER NOT NULL DEFAULT 0,
+                    query_class TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL,
+                    hit_count INTEGER NOT NULL DEFAULT 0,
+                    UNIQUE (query_norm, deep_research)
+                )
+            """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_web_search_cache_last_used ON web_search_cache (last_used_at)"
+            )
+            self._conn.commit()
+
+    def _load_index(self) -> None:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, query_norm, deep_research, query_class, created_at FROM web_search_cache"
+            ).fetchall()
+            for entry_id, query_norm, deep_research, query_class, created_at in rows:
+                self._index_entry(entry_id, query_norm, bool(deep_research), query_class, created_at)
+        if rows:
+            self.LOG.info(f"已加载 {len(rows)} 条联网搜索缓存")
+
+    # ---- 查询与写入 ----
+
+    def get(self, query: str, deep_research: bool = False) -> Optional[str]:
+        """查找新鲜的缓存结果（精确或近似匹配），未命中返回 None"""
+        normalized = normalize_query(query)
+        if not normalized:
+            return None
+        deep_research = bool(deep_research)
+        query_class = classify_query(normalized)
+        now = time.time()
+
+        with self._lock:
+            if self._conn is None:
+                return None
+            entry_id = self._exact.get((normalized, deep_research))
+            near = False
+            if entry_id is None or not self._is_fresh(entry_id, query_class, now):
+                entry_id = self._find_similar(normalized, deep_research, query_class, now)
+                near = entry_id is not None
+            if entry_id is None:
+                self.misses += 1
+                return None
+
+            row = self._conn.execute("SELECT response FROM web_search_cache WHERE id = ?", (entry_id,)).fetchone()
+            if row is None:
+                self._unindex_entry(entry_id)
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE web_search_cache SET last_used_at = ?, hit_count = hit_count + 1 WHERE id = ?",
+                (now, entry_id),
+            )
+            self._conn.commit()
+            if near:
+                self.near_hits += 1
+                self.LOG.info(f"联网搜索缓存近似命中: {query} ≈ {self._entries[entry_id][0]}")
+            else:
+                self.hits += 1
+            return row[0]
+
+    def put(self, query: str, deep_research: bool, response: str) -> None:
+        """保存搜索结果；空结果和错误信息不缓存"""
+        normalized = normalize_query(query)
+        if not normalized or not response or is_error_response(response):
+            return
+        deep_research = bool(deep_research)
+        query_class = classify_query(normalized)
+        now = time.time()
+
+        with self._lock:
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute(
+                    """
+                    INSERT INTO web_search_cache
+                        (query, query_norm, deep_research, query_class, response, created_at, last_used_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (query_norm, deep_research) DO UPDATE SET
+                        query = excluded.query, query_class = excluded.query_class, response = excluded.response,
+                        created_at = excluded.created_at, last_used_at = excluded.last_used_at
+                    """,
+                    (query, normalized, int(deep_research), query_class, response, now, now),
+                )
+                entry_id = self._conn.execute(
+                    "SELECT id FROM web_search_cache WHERE query_norm = ? AND deep_research = ?",
+                    (normalized, int(deep_research)),
+                ).fetchone()[0]
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self.LOG.error(f"写入联网搜索缓存失败: {e}")
+                return
+            self._unindex_entry(entry_id)
+            self._index_entry(entry_id, normalized, deep_research, query_class, now)
+            over_limit = len(self._entries) > self.max_entries * 1.1
+
+        if over_limit:
+            self.evict()
+
+    def evict(self) -> int:
+        """删除过期条目，并按最近使用时间淘汰超出 max_entries 的部分，返回删除的条数"""
+        now = time.time()
+        with self._lock:
+            if self._conn is None:
+                return 0
+            expired = [
+                entry_id for entry_id, (_, _, query_class, created_at, _) in self._entries.items()
+                if now - created_at > self._max_age(query_class)
+            ]
+            overflow = len(self._entries) - len(expired) - self.max_entries
+            try:
+                if expired:
+                    self._conn.executemany("DELETE FROM web_search_cache WHERE id = ?", [(i,) for i in expired])
+                lru = []
+                if overflow > 0:
+                    lru = [row[0] for row in self._conn.execute(
+                        "SELECT id FROM web_search_cache ORDER BY last_used_at LIMIT ?", (overflow,)
+                    )]
+                    self._conn.executemany("DELETE FROM web_search_cache WHERE id = ?", [(i,) for i in lru])
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self.LOG.error(f"清理联网搜索缓存失败: {e}")
+                return 0
+            for entry_id in expired + lru:
+                self._unindex_entry(entry_id)
+        removed = len(expired) + len(lru)
+        if removed:
+            self.LOG.info(f"联网搜索缓存清理: 过期 {len(expired)} 条，LRU 淘汰 {len(lru)} 条，剩余 {len(self._entries)} 条")
+        return removed
+
+    def log_stats(self) -> None:
+        total = self.hits + self.near_hits + self.misses
+        if not total:
+            return
+        self.LOG.info(
+            f"联网搜索缓存: 命中 {self.hits}，近似命中 {self.near_hits}，未命中 {self.misses}，"
+            f"命中率 {(self.hits + self.near_hits) / total:.1%}，条目数 {len(self._entries)}"
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.close()
+                except sqlite3.Error as e:
+                    self.LOG.error(f"关闭联网搜索缓存数据库连接时出错: {e}")
+                self._conn = None
+
+    # ---- 内存索引（调用方持有 _lock） ----
+
+    def _max_age(self, query_class: str) -> float:
+        return self.freshness.get(query_class, self.freshness["general"])
+
+    def _is_fresh(self, entry_id: int, query_class: str, now: float) -> bool:
+        _, _, entry_class, created_at, _ = self._entries[entry_id]
+        # 问题与缓存条目的类别不同时取较短的新鲜度
+        return now - created_at <= min(self._max_age(query_class), self._max_age(entry_class))
+
+    def _find_similar(self, normalized: str, deep_research: bool, query_class: str, now: float) -> Optional[int]:
+        shingles = _shingles(normalized)
+        if not shingles or self.similarity >= 1.0:
+            return None
+        overlaps = Counter()
+        for shingle in shingles:
+            for entry_id in self._postings.get(shingle, ()):
+                overlaps[entry_id] += 1
+
+        digits = _DIGITS.findall(normalized)
+        best_id, best_score = None, self.similarity
+        for entry_id, overlap in overlaps.items():
+            entry_norm, entry_deep, _, _, entry_shingles = self._entries[entry_id]
+            score = overlap / (len(shingles) + len(entry_shingles) - overlap)
+            if score < best_score or entry_deep != deep_research:
+                continue
+            if _DIGITS.findall(entry_norm) != digits or not self._is_fresh(entry_id, query_class, now):
+                continue  # 年份、日期、数量不同的问题不能复用
+            best_id, best_score = entry_id, score
+        return best_id
+
+    def _index_entry(self, entry_id: int, normalized: str, deep_research: bool, query_class: str,
+                     created_at: float) -> None:
+        shingles = _shingles(normalized)
+        self._entries[entry_id] = (normalized, deep_research, query_class, created_at, shingles)
+        self._exact[(normalized, deep_research)] = entry_id
+        for shingle in shingles:
+            self._postings.setdefault(shingle, set()).add(entry_id)
+
+    def _unindex_entry(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        normalized, deep_research, _, _, shingles = entry
+        if self._exact.get((normalized, deep_research)) == entry_id:
+            del self._exact[(normalized, deep_research)]
+        for shingle in shingles:
+            ids = self._postings.get(shingle)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._postings[shingle]
+
+
+def create_search_cache(config: Optional[dict], db_path: str) -> Optional[SearchCache]:
+    """按 web_search_cache 配置创建 SearchCache，未启用时返回 None"""
+    config = config if isinstance(config, dict) else {}
+    if not config.get("enable", True):
+        return None
+    return SearchCache(
+        db_path,
+        max_entries=config.get("max_entries") or DEFAULT_MAX_ENTRIES,
+        similarity=config.get("similarity", DEFAULT_SIMILARITY),
+        freshness_minutes=config.get("freshness_minutes"),
+    )
+
+
+if __name__ == "__main__":
+    # 基准：2000 条缓存中查找精确/近似/未命中的问题
+    # 用法: python -m function.func_search_cache
+    import os
+    import random
+    import statistics
+    import tempfile
+
+    logging.basicConfig(level=logging.WARNING)
+    rng = random.Random(3)
+    topics = ["北京", "上海", "苹果公司", "英伟达", "OpenAI", "世界杯", "诺贝尔奖", "量子计算", "电动车", "房价",
+              "高考", "iPhone", "特斯拉", "比特币", "黄金", "人民币", "美联储", "奥运会", "芯片", "光伏"]
+    asks = ["是什么", "的历史", "怎么样", "有哪些争议", "的发展前景", "和竞争对手比较", "的主要产品", "的最新政策"]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = SearchCache(os.path.join(tmp_dir, "cache.db"))
+        queries = [f"{rng.choice(topics)}{rng.choice(topics)}{rng.choice(asks)}{i}" for i in range(2000)]
+        for q in queries:
+            cache.put(q, False, f"关于 {q} 的回答" * 20)
+
+        probes = {
+            "精确": queries[:200],
+            "近似": [f"请问{q}哈？" for q in queries[200:400]],
+            "未命中": [f"{rng.choice(topics)}的天气{i}" for i in range(200)],
+        }
+        for label, items in probes.items():
+            latencies, found = [], 0
+            for q in items:
+                started = time.perf_counter()
+                found += cache.get(q) is not None
+                latencies.append((time.perf_counter() - started) * 1000)
+            print(f"{label}: 命中 {found}/{len(items)}，平均 {statistics.mean(latencies):.3f}ms，"
+                  f"P99 {sorted(latencies)[int(len(latencies) * 0.99)]:.3f}ms")
+
+        started = time.perf_counter()
+        cache.max_entries = 1000
+        removed = cache.evict()
+        print(f"LRU 淘汰 {removed} 条: {(time.perf_counter() - started) * 1000:.1f}ms")
+        cache.close()
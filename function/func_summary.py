@@ -1,17 +1,41 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import math
 import time
 import datetime
 import re
-from collections import deque
-# from threading import Lock  # 不再需要锁，使用SQLite的事务机制
+from collections import OrderedDict, deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import sqlite3  # 添加sqlite3模块
 import os  # 用于处理文件路径
 from function.func_xml_process import XmlProcessor  # 导入XmlProcessor
+from function.func_db import connect_sqlite
+from function.func_embedding import create_embedder, np
+from function.func_tokens import MESSAGE_TOKEN_OVERHEAD, create_token_counter
 
 MAX_DB_HISTORY_LIMIT = 10000
 SUMMARY_MESSAGE_LIMIT = 300
+DEFAULT_WRITE_BATCH_SIZE = 50
+DEFAULT_WRITE_FLUSH_INTERVAL_MS = 500
+MAX_FLUSH_ATTEMPTS = 5  # 同一批消息连续写入失败这么多次后放弃
+DEFAULT_CACHE_MAX_CHATS = 256
+DEFAULT_CACHE_MAX_MESSAGES = 50000
+FTS_MIN_KEYWORD_LENGTH = 3  # trigram 分词器只能检索不少于 3 个字符的关键词
+FTS_MAX_HITS_FACTOR = 2     # 全库命中超过 max_history 的这么多倍时，改为在聊天内按范围扫描
+BM25_K1 = 1.2
+BM25_B = 0.75
+RANK_RECENCY_HALF_LIFE_DAYS = 7.0  # 时间加成的半衰期
+RANK_RECENCY_BOOST = 1.0           # 最新消息的得分最多提升到 (1 + RANK_RECENCY_BOOST) 倍
+SEMANTIC_MIN_SIMILARITY = 0.15   # 语义检索中余弦相似度低于该值的消息不作为锚点
+VECTOR_CACHE_MAX_ROWS = 200000  # 内存中缓存的消息向量总条数上限（512 维 int8 约 100MB）
+ROLLING_SUMMARY_BATCH = 20           # 移出近期窗口的消息累计到这么多条时，才并入滚动摘要
+ROLLING_SUMMARY_MAX_CHARS = 2000     # 滚动摘要保存的最大字符数
+ROLLING_SUMMARY_MAX_INPUT_CHARS = 6000  # 一次交给模型合并的新消息字符上限（保留最新部分）
+SUMMARY_TOKEN_BUDGET = 1000  # 按 token 装填时为早期摘要固定预留的 token 数，摘要在两次合并之间保持不变
+TIME_WINDOW_MARGIN_SECONDS = 60  # timestamp_str 与 timestamp_float 可能相差几秒，按浮点时间预筛时放宽的余量
 
 
 def _is_internal_tool_message(content: str) -> bool:
@@ -27,17 +51,43 @@ def _is_internal_tool_message(content: str) -> bool:
     return any(marker in content for marker in markers)
 
 
+def _vector_text(content: str) -> str:
+    """生成向量时使用的文本：内部工具日志记为空文本（零向量），不会被语义检索命中"""
+    return "" if _is_internal_tool_message(content) else content
+
+
 class MessageSummary:
     """消息总结功能类 (使用SQLite持久化)
     用于记录、管理和生成聊天历史消息的总结
     """
 
-    def __init__(self, max_history=MAX_DB_HISTORY_LIMIT, db_path="data/message_history.db"):
+    def __init__(
+        self,
+        max_history=MAX_DB_HISTORY_LIMIT,
+        db_path="data/message_history.db",
+        write_batch_size=DEFAULT_WRITE_BATCH_SIZE,
+        write_flush_interval_ms=DEFAULT_WRITE_FLUSH_INTERVAL_MS,
+        trim_slack=None,
+        cache_max_chats=DEFAULT_CACHE_MAX_CHATS,
+        cache_max_messages=DEFAULT_CACHE_MAX_MESSAGES,
+        semantic_search=True,
+        embedder=None,
+        token_counter=None
+    ):
         """初始化消息总结功能
 
         Args:
             max_history: 每个聊天保存的最大消息数量
             db_path: SQLite数据库文件路径
+            write_batch_size: 写缓冲累计多少条消息后合并为一个事务写入，1 表示每条立即写入
+            write_flush_interval_ms: 缓冲中的消息最长等待多少毫秒后写入
+            trim_slack: 单个聊天超出 max_history 多少条后才执行一次裁剪，默认为 max_history 的 10%
+            cache_max_chats: 内存中最多缓存多少个聊天的近期消息，0 表示关闭缓存
+            cache_max_messages: 所有缓存聊天合计最多保留的消息条数
+            semantic_search: 是否在写入时为消息生成向量，用于 search_messages_semantic
+            embedder: 自定义向量化器，默认使用 function.func_embedding 中的 HashingEmbedder；
+                更换后旧向量会被清空并在检索时重新生成
+            token_counter: 自定义 token 计数器，默认使用 function.func_tokens.create_token_counter()
         """
         self.LOG = logging.getLogger("MessageSummary")
         try:
@@ -57,6 +107,80 @@ class MessageSummary:
         self.max_history = parsed_history_limit
         self.db_path = db_path
 
+        # 摊还裁剪：记录每个聊天的行数，超出 max_history + trim_slack 时才一次性删掉多余的旧消息
+        try:
+            self.trim_slack = max(0, int(trim_slack)) if trim_slack is not None else max(10, self.max_history // 10)
+        except (TypeError, ValueError):
+            self.trim_slack = max(10, self.max_history // 10)
+        self._chat_row_counts = {}  # chat_id -> 表中行数，仅在持有 _write_lock 时读写
+
+        # 写缓冲 (write-behind)：record_message 只入队，由后台线程批量写入
+        try:
+            self.write_batch_size = max(1, int(write_batch_size))
+        except (TypeError, ValueError):
+            self.write_batch_size = DEFAULT_WRITE_BATCH_SIZE
+        try:
+            self.write_flush_interval = max(10, int(write_flush_interval_ms)) / 1000.0
+        except (TypeError, ValueError):
+            self.write_flush_interval = DEFAULT_WRITE_FLUSH_INTERVAL_MS / 1000.0
+        # 连接池：self.conn 是唯一的写连接，只在持有 _write_lock 时使用；
+        # 读取使用线程本地连接 (WAL 模式下读不会被写阻塞)，游标从不跨线程共享
+        self._write_lock = threading.RLock()    # 串行化批量写入事务
+        self._read_local = threading.local()
+        self._read_conns = []                   # 所有线程本地读连接，close_db 时统一关闭
+        self._read_conns_lock = threading.Lock()
+        self._closed = False
+        self._pending_lock = threading.Lock()   # 保护缓冲区本身，只在入队/出队时短暂持有
+        self._pending = []                      # 待写入的行
+        self._pending_chats = {}                # chat_id -> 尚未提交的消息数，用于读己之写
+        self._flush_failures = 0                # 缓冲区头部那批消息连续写入失败的次数
+        self._stale_cache_chats = set()         # 消息被放弃写入、内存缓存需要作废的聊天
+        self._flush_wakeup = threading.Event()
+        self._writer_stop = threading.Event()
+        self._writer_thread = None
+
+        # 热点聊天的近期消息缓存：chat_id -> deque[(sender, sender_wxid, content, timestamp_str)]，
+        # 按 LRU 淘汰。缓存由 record_message 同步追加（包含尚未落盘的消息），命中时无需读库。
+        try:
+            self.cache_max_chats = max(0, int(cache_max_chats))
+        except (TypeError, ValueError):
+            self.cache_max_chats = DEFAULT_CACHE_MAX_CHATS
+        try:
+            self.cache_max_messages = max(0, int(cache_max_messages))
+        except (TypeError, ValueError):
+            self.cache_max_messages = DEFAULT_CACHE_MAX_MESSAGES
+        self._cache_lock = threading.Lock()
+        self._history_cache = OrderedDict()
+        self._cache_size = 0  # 所有缓存聊天的消息总数
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._fts_enabled = False  # messages_fts 全文索引是否可用，由 _ensure_fts_index 设置
+
+        # 语义检索：向量随消息写入同一事务生成，存于 message_vectors；旧消息在首次检索时补齐
+        self.embedder = None
+        if semantic_search:
+            self.embedder = embedder if embedder is not None else create_embedder()
+        self._vector_ready_chats = set()  # 本进程内已补齐向量的聊天
+        # 语义检索用的向量矩阵缓存：chat_id -> (ids, timestamps, matrix)，按 LRU 淘汰。
+        # messages 只追加且 id 递增，命中后只需读取 id 更大的新行
+        self._vector_cache = OrderedDict()
+        self._vector_cache_rows = 0
+        self._vector_cache_lock = threading.Lock()
+
+        # 滚动摘要：chat_summaries 记录每个聊天已并入摘要的最后一条消息 id，
+        # 构建上下文时只处理之后移出近期窗口的消息。配置了摘要模型时在后台线程中异步合并
+        self.summary_model = None
+        self._summary_executor = None
+        self._summary_in_flight = set()
+        self._summary_lock = threading.Lock()
+
+        # token 计数：每条消息的 token 数在写入时计算并缓存在 messages.token_count，
+        # 更换计数器后旧的缓存值会被清空，在下次构建上下文时重新计算
+        self.token_counter = token_counter if token_counter is not None else create_token_counter()
+        self._record_listeners = []  # 新消息写入后的回调 (chat_id)，例如作废工具结果缓存
+        self._sender_tokens = lru_cache(maxsize=4096)(self.token_counter.count)  # 发送者昵称反复出现
+        self._stored_summary_part = lru_cache(maxsize=256)(self._truncate_to_tokens)  # 摘要在两次合并之间不变
+
         # 实例化XML处理器用于提取引用消息
         self.xml_processor = XmlProcessor(self.LOG)
 
@@ -66,27 +190,27 @@ class MessageSummary:
                 os.makedirs(db_dir)
                 self.LOG.info(f"创建数据库目录: {db_dir}")
 
-            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-            self.cursor = self.conn.cursor()
+            self.conn = connect_sqlite(self.db_path)
+            cursor = self.conn.cursor()  # 仅用于初始化，之后各处使用独立游标
             self.LOG.info(f"已连接到 SQLite 数据库: {self.db_path}")
 
             # 检查并添加 sender_wxid 列 (如果不存在)
-            self.cursor.execute("PRAGMA table_info(messages)")
-            columns = [col[1] for col in self.cursor.fetchall()]
+            cursor.execute("PRAGMA table_info(messages)")
+            columns = [col[1] for col in cursor.fetchall()]
             if 'sender_wxid' not in columns:
                 try:
-                    self.cursor.execute("ALTER TABLE messages ADD COLUMN sender_wxid TEXT")
+                    cursor.execute("ALTER TABLE messages ADD COLUMN sender_wxid TEXT")
                     self.conn.commit()
                     self.LOG.info("已向 messages 表添加 sender_wxid 列")
                 except sqlite3.OperationalError as e:
                      # 如果表是空的，直接删除重建可能更简单
                      self.LOG.warning(f"添加 sender_wxid 列失败 ({e})，可能是因为表非空且有主键？尝试重建表。")
                      # 注意：这会丢失现有数据！
-                     self.cursor.execute("DROP TABLE IF EXISTS messages")
+                     cursor.execute("DROP TABLE IF EXISTS messages")
                      self.conn.commit()
 
 
-            self.cursor.execute("""
+            cursor.execute("""
                 CREATE TABLE IF NOT EXISTS messages (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     chat_id TEXT NOT NULL,
@@ -94,20 +218,39 @@ class MessageSummary:
                     sender_wxid TEXT, -- 新增: 存储发送者wxid
                     content TEXT NOT NULL,
                     timestamp_float REAL NOT NULL,
-                    timestamp_str TEXT NOT NULL -- 存储完整时间格式 YYYY-MM-DD HH:MM:SS
+                    timestamp_str TEXT NOT NULL, -- 存储完整时间格式 YYYY-MM-DD HH:MM:SS
+                    token_count INTEGER -- content 的 token 数，NULL 表示尚未计算
                 )
             """)
+            self._ensure_token_column(cursor)
 
-            self.cursor.execute("""
+            cursor.execute("""
                 CREATE INDEX IF NOT EXISTS idx_chat_time ON messages (chat_id, timestamp_float)
             """)
             # 新增 sender_wxid 索引 (可选，如果经常需要按wxid查询)
-            self.cursor.execute("""
+            cursor.execute("""
                 CREATE INDEX IF NOT EXISTS idx_sender_wxid ON messages (sender_wxid)
             """)
             self.conn.commit() # 提交更改
+            self._fts_enabled = self._ensure_fts_index(cursor)
+            self._ensure_vector_table(cursor)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS chat_summaries (
+                    chat_id TEXT PRIMARY KEY,
+                    last_message_id INTEGER NOT NULL, -- 摘要已覆盖到的最后一条消息 id
+                    summary TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self.conn.commit()
             self.LOG.info("消息表已准备就绪")
 
+            if self.write_batch_size > 1:
+                self._writer_thread = threading.Thread(
+                    target=self._writer_loop, name="MessageHistoryWriter", daemon=True
+                )
+                self._writer_thread.start()
+
         except sqlite3.Error as e:
             self.LOG.error(f"数据库初始化失败: {e}")
             raise ConnectionError(f"无法连接或初始化数据库: {e}") from e
@@ -115,12 +258,131 @@ class MessageSummary:
             self.LOG.error(f"创建数据库目录失败: {e}")
             raise OSError(f"无法创建数据库目录: {e}") from e
 
+    def _ensure_token_column(self, cursor):
+        """为旧数据库添加 token_count 列；计数器变化时清空已缓存的 token 数"""
+        cursor.execute("PRAGMA table_info(messages)")
+        if "token_count" not in [col[1] for col in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE messages ADD COLUMN token_count INTEGER")
+            self.LOG.info("已向 messages 表添加 token_count 列")
+
+        cursor.execute("CREATE TABLE IF NOT EXISTS history_meta (key TEXT PRIMARY KEY, value TEXT)")
+        cursor.execute("SELECT value FROM history_meta WHERE key = 'token_counter'")
+        row = cursor.fetchone()
+        counter_name = getattr(self.token_counter, "name", type(self.token_counter).__name__)
+        if row is None or row[0] != counter_name:
+            if row is not None:
+                cursor.execute("UPDATE messages SET token_count = NULL WHERE token_count IS NOT NULL")
+                self.LOG.info(f"token 计数器由 {row[0]} 变为 {counter_name}，已清空缓存的 token 数")
+            cursor.execute(
+                "INSERT OR REPLACE INTO history_meta (key, value) VALUES ('token_counter', ?)", (counter_name,)
+            )
+        self.conn.commit()
+
+    def _ensure_fts_index(self, cursor):
+        """创建与 messages 同步的 FTS5 trigram 全文索引，返回索引是否可用
+
+        messages_fts 是外部内容表，只存倒排索引不存正文，由触发器随 messages 的
+        插入和删除（包括裁剪）自动维护。trigram 按 3 字符切分，不依赖分词，中文可直接做子串检索。
+        """
+        try:
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'messages_fts_ai'"
+            )
+            if cursor.fetchone():
+                return True
+
+            # 触发器不存在：首次启用，或 messages 表被重建过，需要按现有数据重建索引
+            cursor.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    content,
+                    content='messages',
+                    content_rowid='id',
+                    tokenize='trigram'
+                )
+            """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+                END
+            """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                END
+            """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+                END
+            """)
+            started = time.perf_counter()
+            cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            self.conn.commit()
+            self.LOG.info(f"已建立消息全文索引，耗时 {time.perf_counter() - started:.2f}s")
+            return True
+        except sqlite3.OperationalError as e:
+            # SQLite 低于 3.34 或未编译 FTS5 时没有 trigram 分词器，关键词搜索退回按范围扫描
+            self.conn.rollback()
+            self.LOG.warning(f"无法创建消息全文索引，关键词搜索将使用逐条匹配: {e}")
+            return False
+
+    def _ensure_vector_table(self, cursor):
+        """创建消息向量表，向量随 messages 中的行一起删除（包括裁剪）；
+        更换向量化器后旧向量不可比较，全部删除，在各聊天下次语义检索时重新生成"""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS message_vectors (
+                id INTEGER PRIMARY KEY, -- 对应 messages.id
+                vector BLOB NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS message_vectors_ad AFTER DELETE ON messages BEGIN
+                DELETE FROM message_vectors WHERE id = old.id;
+            END
+        """)
+        if self.embedder is not None:
+            cursor.execute("SELECT value FROM history_meta WHERE key = 'embedder'")
+            row = cursor.fetchone()
+            # 没有记录时库中只可能是默认 HashingEmbedder 生成的向量
+            previous = row[0] if row else "hashing-512"
+            embedder_name = getattr(self.embedder, "name", type(self.embedder).__name__)
+            if previous != embedder_name:
+                cursor.execute("DELETE FROM message_vectors")
+                self.LOG.info(f"向量化器由 {previous} 变为 {embedder_name}，已清空旧的消息向量")
+            if row is None or previous != embedder_name:
+                cursor.execute(
+                    "INSERT OR REPLACE INTO history_meta (key, value) VALUES ('embedder', ?)", (embedder_name,)
+                )
+        self.conn.commit()
+
     def close_db(self):
-        """关闭数据库连接"""
+        """写入缓冲中剩余的消息并关闭数据库连接"""
+        if self._summary_executor:
+            # 不等待进行中的模型调用，未完成的合并会在下次启动后重新触发
+            self._summary_executor.shutdown(wait=False, cancel_futures=True)
+            self._summary_executor = None
+        if self._writer_thread:
+            self._writer_stop.set()
+            self._flush_wakeup.set()
+            self._writer_thread.join(timeout=5)
+            self._writer_thread = None
         if hasattr(self, 'conn') and self.conn:
+            self.flush()
+            if self._pending:
+                self.LOG.error(f"关闭数据库时仍有 {len(self._pending)} 条消息写入失败，已放弃")
+            self._closed = True
+            with self._read_conns_lock:
+                read_conns, self._read_conns = self._read_conns, []
+            for read_conn in read_conns:
+                try:
+                    read_conn.close()
+                except sqlite3.Error:
+                    pass
             try:
-                self.conn.commit() # 确保所有更改都已保存
-                self.conn.close()
+                with self._write_lock:
+                    self.conn.commit() # 确保所有更改都已保存
+                    self.conn.close()
                 self.LOG.info("数据库连接已关闭")
             except sqlite3.Error as e:
                 self.LOG.error(f"关闭数据库连接时出错: {e}")
@@ -128,6 +390,10 @@ class MessageSummary:
     def record_message(self, chat_id, sender_name, sender_wxid, content, timestamp=None):
         """记录单条消息到数据库
 
+        消息先进入写缓冲，累计 write_batch_size 条或等待 write_flush_interval_ms 后
+        由后台线程合并为一个事务写入；已缓存的聊天同时追加到内存缓存，
+        未缓存的聊天在读取时先把缓冲写入，两种情况都保证读己之写。
+
         Args:
             chat_id: 聊天ID（群ID或用户ID）
             sender_name: 发送者名称
@@ -135,7 +401,10 @@ class MessageSummary:
             content: 消息内容
             timestamp: 外部提供的时间字符串（优先使用），否则生成
         """
-        try:
+        # 缓存追加与入队在同一把锁内完成，与 _load_history 的"写入缓冲+读库+建缓存"互斥，
+        # 保证每条消息要么已在读出的快照里，要么追加到了新建的缓存中，不会丢失或重复；
+        # 时间戳也在锁内生成，使缓存中的顺序与数据库按 timestamp_float 排序的结果一致
+        with self._cache_lock:
             current_time_float = time.time()
 
             if not timestamp:
@@ -154,32 +423,338 @@ class MessageSummary:
                  else:
                      timestamp_str = timestamp # 假设是完整格式
 
-            # 插入新消息，包含 sender_wxid
-            self.cursor.execute("""
-                INSERT INTO messages (chat_id, sender, sender_wxid, content, timestamp_float, timestamp_str)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (chat_id, sender_name, sender_wxid, content, current_time_float, timestamp_str))
-
-            # 删除超出 max_history 的旧消息
-            self.cursor.execute("""
-                DELETE FROM messages
-                WHERE chat_id = ? AND id NOT IN (
-                    SELECT id
+            row = (chat_id, sender_name, sender_wxid, content, current_time_float, timestamp_str)
+            cached = self._history_cache.get(chat_id)
+            if cached is not None:
+                if len(cached) < cached.maxlen:
+                    self._cache_size += 1
+                cached.append((sender_name, sender_wxid, content, timestamp_str))
+                self._history_cache.move_to_end(chat_id)
+            with self._pending_lock:
+                self._pending.append(row)
+                self._pending_chats[chat_id] = self._pending_chats.get(chat_id, 0) + 1
+                batch_full = len(self._pending) >= self.write_batch_size
+            if cached is not None:
+                self._evict_cache()
+
+        if not self._writer_thread:
+            self.flush()  # 未启用写缓冲：立即写入，失败的消息随下一条消息重试
+            self._drop_stale_cache()
+        elif batch_full:
+            self._flush_wakeup.set()
+        self._notify_record_listeners(chat_id)
+
+    def add_record_listener(self, callback):
+        """注册新消息回调，callback(chat_id) 在 record_message 和 clear_message_history 之后调用"""
+        self._record_listeners.append(callback)
+
+    def _notify_record_listeners(self, chat_id):
+        for callback in self._record_listeners:
+            try:
+                callback(chat_id)
+            except Exception as e:
+                self.LOG.error(f"消息写入回调执行失败: {e}")
+
+    def flush(self):
+        """把写缓冲中的消息合并为一个事务写入数据库
+
+        Returns:
+            int: 本次写入的消息条数
+        """
+        with self._write_lock:
+            with self._pending_lock:
+                batch = self._pending
+                self._pending = []
+            if not batch:
+                return 0
+
+            chat_counts = {}
+            for row in batch:
+                chat_counts[row[0]] = chat_counts.get(row[0], 0) + 1
+
+            try:
+                cursor = self.conn.cursor()
+                # 插入新消息，包含 sender_wxid 和 content 的 token 数
+                cursor.executemany("""
+                    INSERT INTO messages (chat_id, sender, sender_wxid, content, timestamp_float, timestamp_str,
+                                          token_count)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, [row + (tokens,) for row, tokens in zip(batch, self._count_batch_tokens(batch))])
+                if self.embedder is not None:
+                    self._insert_vectors(cursor, batch)
+
+                # 删除超出 max_history 的旧消息（超出 trim_slack 后才裁剪）
+                new_counts = self._trim_chats(cursor, chat_counts)
+
+                self.conn.commit() # 提交事务
+                self._chat_row_counts.update(new_counts)
+                written = len(batch)
+
+            except sqlite3.Error as e:
+                try:
+                    self.conn.rollback()
+                except:
+                    pass
+                self._flush_failures += 1
+                if self._flush_failures < MAX_FLUSH_ATTEMPTS:
+                    # 放回缓冲区头部，保持顺序和未提交计数，下次写入时重试
+                    self.LOG.warning(
+                        f"批量记录 {len(batch)} 条消息到数据库时出错 "
+                        f"(第 {self._flush_failures} 次)，稍后重试: {e}"
+                    )
+                    with self._pending_lock:
+                        self._pending = batch + self._pending
+                    return 0
+                self.LOG.error(
+                    f"批量记录 {len(batch)} 条消息连续失败 {self._flush_failures} 次，已放弃这些消息: {e}"
+                )
+                written = 0
+                # 内存缓存里可能已有这些消息，作废后从数据库重新读取，避免缓存与数据库不一致。
+                # 调用方可能持有 _cache_lock（_load_history），这里只登记，由 _drop_stale_cache 处理
+                with self._pending_lock:
+                    self._stale_cache_chats.update(chat_counts)
+
+            self._flush_failures = 0
+            # 提交（或放弃）之后才清除计数，读取方在此之前会等待 _write_lock
+            with self._pending_lock:
+                for chat_id, count in chat_counts.items():
+                    remaining = self._pending_chats.get(chat_id, 0) - count
+                    if remaining > 0:
+                        self._pending_chats[chat_id] = remaining
+                    else:
+                        self._pending_chats.pop(chat_id, None)
+
+            return written
+
+    def _drop_stale_cache(self):
+        """作废写入失败被放弃的聊天的内存缓存（调用方不能持有 _cache_lock）"""
+        if not self._stale_cache_chats:
+            return
+        with self._pending_lock:
+            chat_ids, self._stale_cache_chats = self._stale_cache_chats, set()
+        for chat_id in chat_ids:
+            self._drop_cached_chat(chat_id)
+
+    def _count_batch_tokens(self, batch):
+        """计算一批待写入消息的 token 数，失败时记为 NULL，构建上下文时再补算"""
+        try:
+            return self.token_counter.count_many([row[3] for row in batch])
+        except Exception as e:
+            self.LOG.warning(f"计算消息 token 数失败，将在使用时补算: {e}")
+            return [None] * len(batch)
+
+    def _insert_vectors(self, cursor, batch):
+        """为刚插入的一批消息写入向量
+
+        写连接是唯一的写入方，同一事务内 AUTOINCREMENT 分配的 id 连续，
+        由 last_insert_rowid() 倒推即可得到整批消息的 id。向量化失败不影响消息本身，
+        缺失的向量会在该聊天下次语义检索时补齐。
+        """
+        try:
+            last_id = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+            first_id = last_id - len(batch) + 1
+            vectors = self.embedder.embed([_vector_text(row[3]) for row in batch])
+            cursor.executemany(
+                "INSERT OR REPLACE INTO message_vectors (id, vector) VALUES (?, ?)",
+                [(first_id + i, self.embedder.to_blob(vector)) for i, vector in enumerate(vectors)],
+            )
+        except Exception as e:
+            self.LOG.warning(f"生成消息向量失败，将在检索时补齐: {e}")
+
+    def _backfill_vectors(self, chat_id):
+        """为聊天中还没有向量的消息（启用语义检索之前写入的）生成向量"""
+        if chat_id in self._vector_ready_chats:
+            return
+        missing = self._read_conn().execute("""
+            SELECT m.id, m.content
+            FROM messages AS m
+            LEFT JOIN message_vectors AS v ON v.id = m.id
+            WHERE m.chat_id = ? AND v.id IS NULL
+        """, (chat_id,)).fetchall()
+        if missing:
+            started = time.perf_counter()
+            for offset in range(0, len(missing), 500):
+                batch = missing[offset:offset + 500]
+                vectors = self.embedder.embed([_vector_text(content) for _, content in batch])
+                with self._write_lock:
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO message_vectors (id, vector) VALUES (?, ?)",
+                        [(row_id, self.embedder.to_blob(vector)) for (row_id, _), vector in zip(batch, vectors)],
+                    )
+                    self.conn.commit()
+            self.LOG.info(
+                f"已为 chat_id={chat_id} 补齐 {len(missing)} 条消息向量，耗时 {time.perf_counter() - started:.2f}s"
+            )
+        self._vector_ready_chats.add(chat_id)
+        self._drop_chat_vectors(chat_id)  # 补齐的是旧 id，增量读取读不到，需要整体重建
+
+    def _chat_vectors(self, conn, chat_id, oldest):
+        """返回聊天中不早于 oldest 的消息向量 (ids, timestamps, matrix)，按 id 升序"""
+        with self._vector_cache_lock:
+            cached = self._vector_cache.pop(chat_id, None)
+            if cached is not None:
+                self._vector_cache_rows -= len(cached[0])
+                ids, timestamps, matrix = cached
+                last_id = int(ids[-1]) if len(ids) else 0
+            else:
+                ids = np.zeros(0, dtype=np.int64)
+                timestamps = np.zeros(0, dtype=np.float64)
+                matrix = self.embedder.from_blobs([])
+                last_id = 0
+
+            new_rows = conn.execute("""
+                SELECT m.id, m.timestamp_float, v.vector
+                FROM messages AS m
+                JOIN message_vectors AS v ON v.id = m.id
+                WHERE m.chat_id = ? AND m.id > ?
+                ORDER BY m.id
+            """, (chat_id, last_id)).fetchall()
+            if new_rows:
+                ids = np.concatenate([ids, np.array([r[0] for r in new_rows], dtype=np.int64)])
+                timestamps = np.concatenate([timestamps, np.array([r[1] for r in new_rows], dtype=np.float64)])
+                matrix = np.concatenate([matrix, self.embedder.from_blobs([r[2] for r in new_rows])])
+
+            # 去掉已被裁剪（早于最旧保留消息）的行
+            keep = (timestamps > oldest[0]) | ((timestamps == oldest[0]) & (ids >= oldest[1]))
+            if not keep.all():
+                ids, timestamps, matrix = ids[keep], timestamps[keep], matrix[keep]
+
+            self._vector_cache[chat_id] = (ids, timestamps, matrix)
+            self._vector_cache_rows += len(ids)
+            while self._vector_cache_rows > VECTOR_CACHE_MAX_ROWS and len(self._vector_cache) > 1:
+                _, evicted = self._vector_cache.popitem(last=False)
+                self._vector_cache_rows -= len(evicted[0])
+            return ids, timestamps, matrix
+
+    def _drop_chat_vectors(self, chat_id):
+        with self._vector_cache_lock:
+            cached = self._vector_cache.pop(chat_id, None)
+            if cached is not None:
+                self._vector_cache_rows -= len(cached[0])
+
+    def _trim_chats(self, cursor, chat_counts):
+        """在当前事务内按需裁剪本批次涉及的聊天
+
+        Args:
+            cursor: 当前写事务使用的游标
+            chat_counts: {chat_id: 本批次新插入条数}
+
+        Returns:
+            dict: {chat_id: 裁剪后的行数}，提交成功后写回 _chat_row_counts
+        """
+        new_counts = {}
+        for chat_id, inserted in chat_counts.items():
+            count = self._chat_row_counts.get(chat_id)
+            if count is None:
+                # 进程启动后首次写入该聊天，从数据库读取一次行数（已包含本批次插入）
+                cursor.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,))
+                count = cursor.fetchone()[0]
+            else:
+                count += inserted
+
+            if count > self.max_history + self.trim_slack:
+                overshoot = count - self.max_history
+                # 沿 idx_chat_time 取出最旧的 overshoot 条，代价只与删除条数有关
+                cursor.execute("""
+                    DELETE FROM messages
+                    WHERE id IN (
+                        SELECT id
+                        FROM messages
+                        WHERE chat_id = ?
+                        ORDER BY timestamp_float ASC, id ASC
+                        LIMIT ?
+                    )
+                """, (chat_id, overshoot))
+                count -= cursor.rowcount
+            new_counts[chat_id] = count
+        return new_counts
+
+    def _read_conn(self):
+        """返回当前线程专用的只读连接，首次使用时创建"""
+        conn = getattr(self._read_local, "conn", None)
+        if conn is None:
+            if self._closed:
+                raise sqlite3.ProgrammingError("MessageSummary 数据库已关闭")
+            conn = connect_sqlite(self.db_path, check_same_thread=True)
+            self._read_local.conn = conn
+            with self._read_conns_lock:
+                self._read_conns.append(conn)
+        return conn
+
+    def _load_history(self, chat_id):
+        """返回聊天最新的 max_history 条消息 (按时间升序的元组列表)，优先命中内存缓存"""
+        self._drop_stale_cache()
+        with self._cache_lock:
+            cached = self._history_cache.get(chat_id)
+            if cached is not None:
+                self._history_cache.move_to_end(chat_id)
+                self._cache_hits += 1
+                return list(cached)
+
+            self._cache_misses += 1
+            self._flush_chat(chat_id)
+            # 查询需要的字段，包括 sender_wxid 和 timestamp_str
+            # 表中可能暂时多出待裁剪的旧消息，取最新的 max_history 条再按时间升序返回
+            cursor = self._read_conn().execute("""
+                SELECT sender, sender_wxid, content, timestamp_str
+                FROM (
+                    SELECT id, sender, sender_wxid, content, timestamp_str, timestamp_float
                     FROM messages
                     WHERE chat_id = ?
-                    ORDER BY timestamp_float DESC
+                    ORDER BY timestamp_float DESC, id DESC
                     LIMIT ?
                 )
-            """, (chat_id, chat_id, self.max_history))
+                ORDER BY timestamp_float ASC, id ASC
+            """, (chat_id, self.max_history))
+            rows = cursor.fetchall()
+
+            if self.cache_max_chats and len(rows) <= self.cache_max_messages:
+                self._history_cache[chat_id] = deque(rows, maxlen=self.max_history)
+                self._cache_size += len(rows)
+                self._evict_cache()
+            return rows
+
+    def _evict_cache(self):
+        """按 LRU 淘汰缓存直到满足条数和总消息数上限（调用方需持有 _cache_lock）"""
+        while self._history_cache and (
+            len(self._history_cache) > self.cache_max_chats
+            or self._cache_size > self.cache_max_messages
+        ):
+            _, evicted = self._history_cache.popitem(last=False)
+            self._cache_size -= len(evicted)
+
+    def _drop_cached_chat(self, chat_id):
+        with self._cache_lock:
+            evicted = self._history_cache.pop(chat_id, None)
+            if evicted is not None:
+                self._cache_size -= len(evicted)
+
+    def get_cache_stats(self):
+        """返回近期消息缓存的命中统计"""
+        with self._cache_lock:
+            total = self._cache_hits + self._cache_misses
+            return {
+                "cached_chats": len(self._history_cache),
+                "cached_messages": self._cache_size,
+                "hits": self._cache_hits,
+                "misses": self._cache_misses,
+                "hit_rate": self._cache_hits / total if total else 0.0,
+            }
 
-            self.conn.commit() # 提交事务
+    def _flush_chat(self, chat_id):
+        """读取前调用：该聊天还有未提交的消息时先写入，保证读己之写"""
+        if self._pending_chats.get(chat_id):
+            self.flush()
 
-        except sqlite3.Error as e:
-            self.LOG.error(f"记录消息到数据库时出错: {e}")
+    def _writer_loop(self):
+        while not self._writer_stop.is_set():
+            self._flush_wakeup.wait(self.write_flush_interval)
+            self._flush_wakeup.clear()
             try:
-                self.conn.rollback()
-            except:
-                pass
+                self.flush()
+                self._drop_stale_cache()
+            except Exception as e:
+                self.LOG.error(f"后台写入消息历史失败: {e}", exc_info=True)
 
     def clear_message_history(self, chat_id):
         """清除指定聊天的消息历史记录
@@ -190,10 +765,19 @@ class MessageSummary:
         Returns:
             bool: 是否成功清除
         """
+        self._flush_chat(chat_id)
         try:
-            self.cursor.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
-            rows_deleted = self.cursor.rowcount
-            self.conn.commit()
+            with self._write_lock:
+                cursor = self.conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+                rows_deleted = cursor.rowcount
+                self.conn.commit()
+                self._chat_row_counts[chat_id] = 0
+            self._drop_cached_chat(chat_id)
+            self._drop_chat_vectors(chat_id)
+            with self._write_lock:
+                self.conn.execute("DELETE FROM chat_summaries WHERE chat_id = ?", (chat_id,))
+                self.conn.commit()
+            self._notify_record_listeners(chat_id)
             self.LOG.info(f"为 chat_id={chat_id} 清除了 {rows_deleted} 条历史消息")
             return True
 
@@ -210,10 +794,18 @@ class MessageSummary:
         Returns:
             int: 消息数量
         """
+        with self._cache_lock:
+            cached = self._history_cache.get(chat_id)
+            if cached is not None:
+                return len(cached)
+
+        self._flush_chat(chat_id)
         try:
-            self.cursor.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,))
-            result = self.cursor.fetchone()
-            return result[0] if result else 0
+            result = self._read_conn().execute(
+                "SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+            # 表中可能暂时多出不超过 trim_slack 条待裁剪的旧消息，对外只暴露 max_history 条
+            return min(result[0], self.max_history) if result else 0
 
         except sqlite3.Error as e:
             self.LOG.error(f"获取消息数量时出错 (chat_id={chat_id}): {e}")
@@ -230,16 +822,7 @@ class MessageSummary:
         """
         messages = []
         try:
-            # 查询需要的字段，包括 sender_wxid 和 timestamp_str
-            self.cursor.execute("""
-                SELECT sender, sender_wxid, content, timestamp_str
-                FROM messages
-                WHERE chat_id = ?
-                ORDER BY timestamp_float ASC
-                LIMIT ?
-            """, (chat_id, self.max_history))
-
-            rows = self.cursor.fetchall()
+            rows = self._load_history(chat_id)
 
             # 将数据库行转换为期望的字典列表格式
             for row in rows:
@@ -261,7 +844,8 @@ class MessageSummary:
         keywords,
         context_window=5,
         max_groups=20,
-        exclude_recent=30
+        exclude_recent=30,
+        ranked=False
     ):
         """根据关键词搜索消息，返回包含前后上下文的结果
 
@@ -269,8 +853,10 @@ class MessageSummary:
             chat_id (str): 聊天ID（群ID或用户ID）
             keywords (Union[str, list[str]]): 需要搜索的关键词或关键词列表
             context_window (int): 每条匹配消息前后额外提供的消息数量
-            max_groups (int): 返回的最多结果组数（按时间倒序，优先最新消息）
+            max_groups (int): 返回的最多结果组数
             exclude_recent (int): 跳过最近的若干条消息（默认30条）
+            ranked (bool): 为 True 时按 BM25 相关度（带时间衰减）从高到低返回，
+                结果额外包含 relevance 字段；否则按时间倒序，优先最新消息
 
         Returns:
             list[dict]: 搜索结果列表，每个元素包含匹配关键词、锚点消息及上下文消息
@@ -304,81 +890,397 @@ class MessageSummary:
             max_groups = 20
         max_groups = max(1, min(max_groups, 20))
 
-        messages = self.get_messages(chat_id)
-        if not messages:
-            return []
-
         try:
             exclude_recent = int(exclude_recent)
         except (TypeError, ValueError):
             exclude_recent = 30
         exclude_recent = max(0, exclude_recent)
 
-        results = []
-        total_messages = len(messages)
+        total_messages = self.get_message_count(chat_id)
+        if not total_messages:
+            return []
+
         cutoff_index = total_messages - exclude_recent
         if cutoff_index <= 0:
             return []
 
-        used_indices = set()
+        results = []
+        try:
+            self._flush_chat(chat_id)
+            conn = self._read_conn()
+            # 可检索范围：最新 total_messages 条中除去最新 exclude_recent 条，用边界行的 (timestamp_float, id) 表示
+            newest = self._row_at_reverse_offset(conn, chat_id, exclude_recent)
+            oldest = self._row_at_reverse_offset(conn, chat_id, total_messages - 1)
+            if not newest or not oldest:
+                return []
+
+            if ranked:
+                return self._search_ranked(
+                    conn, chat_id, normalized_keywords, context_window, max_groups,
+                    cutoff_index, oldest, newest
+                )
 
-        for idx in range(cutoff_index - 1, -1, -1):
-            message = messages[idx]
-            content = message.get("content", "")
+            # 已返回片段中最早一条的位置；候选锚点按时间倒序出现，落在其后的都已被之前的片段覆盖
+            covered_from = None
+            for row in self._iter_keyword_candidates(conn, chat_id, normalized_keywords, oldest, newest):
+                row_id, ts, sender, sender_wxid, content, time_str = row
+                if not content:
+                    continue
+                if covered_from is not None and (ts, row_id) >= covered_from:
+                    continue
+
+                # 索引只负责圈定候选，是否命中仍按原来的不区分大小写子串规则判断
+                lower_content = content.lower()
+                matched_keywords = [
+                    orig
+                    for orig, lower in normalized_keywords
+                    if lower in lower_content
+                ]
+                if not matched_keywords:
+                    continue
+
+                before = conn.execute("""
+                    SELECT id, timestamp_float, sender, sender_wxid, content, timestamp_str
+                    FROM messages
+                    WHERE chat_id = ? AND (timestamp_float, id) < (?, ?) AND (timestamp_float, id) >= (?, ?)
+                    ORDER BY timestamp_float DESC, id DESC
+                    LIMIT ?
+                """, (chat_id, ts, row_id, oldest[0], oldest[1], context_window)).fetchall()
+                after = conn.execute("""
+                    SELECT id, timestamp_float, sender, sender_wxid, content, timestamp_str
+                    FROM messages
+                    WHERE chat_id = ? AND (timestamp_float, id) > (?, ?)
+                    ORDER BY timestamp_float ASC, id ASC
+                    LIMIT ?
+                """, (chat_id, ts, row_id, context_window)).fetchall()
+                window = list(reversed(before)) + [row] + after
+                covered_from = (window[0][1], window[0][0])
+
+                # 锚点在保留消息中的下标（从最旧一条算起）
+                newer_count = conn.execute("""
+                    SELECT COUNT(*)
+                    FROM messages
+                    WHERE chat_id = ? AND (timestamp_float, id) > (?, ?)
+                """, (chat_id, ts, row_id)).fetchone()[0]
+                anchor_index = total_messages - 1 - newer_count
+
+                results.append(self._build_search_result(window, len(before), matched_keywords, anchor_index))
+                if len(results) >= max_groups:
+                    break
+        except sqlite3.Error as e:
+            self.LOG.error(f"搜索消息时出错 (chat_id={chat_id}): {e}")
+
+        return results
+
+    def _search_ranked(self, conn, chat_id, normalized_keywords, context_window, max_groups,
+                       searchable_count, oldest, newest):
+        """按相关度排序的关键词搜索
+
+        候选消息仍由 _iter_keyword_candidates 圈定，再在进程内按 BM25 打分：
+        IDF 取自本聊天可检索范围内的消息，文档长度按字符计（中文没有分词）。
+        得分乘以时间加成 1 + RANK_RECENCY_BOOST * 0.5 ** (距最新可检索消息的天数 / 半衰期)，
+        同等相关时较新的讨论靠前，但高度相关的旧讨论不会被新消息淹没。
+        """
+        candidates = []
+        doc_freq = {lower: 0 for _, lower in normalized_keywords}
+        for row in self._iter_keyword_candidates(conn, chat_id, normalized_keywords, oldest, newest):
+            content = row[4]
             if not content:
                 continue
-
             lower_content = content.lower()
+            term_freqs = {}
+            for _, lower in normalized_keywords:
+                tf = lower_content.count(lower)
+                if tf:
+                    term_freqs[lower] = tf
+            if not term_freqs:
+                continue
+            for lower in term_freqs:
+                doc_freq[lower] += 1
+            candidates.append((row, term_freqs, len(content)))
+
+        if not candidates:
+            return []
+
+        # 平均长度只用于长度归一化，取最近一段消息估算即可，避免读取整个聊天的正文
+        avg_length = conn.execute("""
+            SELECT AVG(LENGTH(content)) FROM (
+                SELECT content
+                FROM messages
+                WHERE chat_id = ? AND (timestamp_float, id) <= (?, ?)
+                ORDER BY timestamp_float DESC, id DESC
+                LIMIT 500
+            )
+        """, (chat_id, newest[0], newest[1])).fetchone()[0] or 1.0
+        idf = {
+            lower: math.log(1 + (searchable_count - df + 0.5) / (df + 0.5))
+            for lower, df in doc_freq.items()
+        }
+
+        scored = []
+        for row, term_freqs, length in candidates:
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+            score = sum(
+                idf[lower] * tf * (BM25_K1 + 1) / (tf + norm)
+                for lower, tf in term_freqs.items()
+            )
+            age_days = max(0.0, newest[0] - row[1]) / 86400
+            score *= 1 + RANK_RECENCY_BOOST * 0.5 ** (age_days / RANK_RECENCY_HALF_LIFE_DAYS)
+            scored.append((score, row))
+        scored.sort(key=lambda item: (item[0], item[1][1], item[1][0]), reverse=True)
+        return self._collect_ranked_segments(
+            conn, chat_id, oldest, scored, context_window, max_groups, normalized_keywords
+        )
+
+    def _collect_ranked_segments(self, conn, chat_id, oldest, scored, context_window, max_groups,
+                                 normalized_keywords=()):
+        """按得分从高到低选取互不覆盖的锚点，取出上下文并组装结果
+
+        Args:
+            scored: [(得分, 消息行)]，已按得分降序排列
+            normalized_keywords: [(原关键词, 小写关键词)]，用于标注锚点命中的关键词
+        """
+        # 保留消息的 id 按时间顺序排列，用于确定锚点下标和上下文范围（只走覆盖索引，不读正文）
+        ordered_ids = [r[0] for r in conn.execute("""
+            SELECT id
+            FROM messages
+            WHERE chat_id = ? AND (timestamp_float, id) >= (?, ?)
+            ORDER BY timestamp_float ASC, id ASC
+        """, (chat_id, oldest[0], oldest[1]))]
+        positions = {row_id: index for index, row_id in enumerate(ordered_ids)}
+
+        chosen = []
+        covered = []  # 已选片段的 [start, end) 区间
+        for score, row in scored:
+            anchor_index = positions.get(row[0])
+            if anchor_index is None:
+                continue
+            if any(start <= anchor_index < end for start, end in covered):
+                continue
+            start = max(0, anchor_index - context_window)
+            end = min(len(ordered_ids), anchor_index + context_window + 1)
+            covered.append((start, end))
+            chosen.append((score, row, anchor_index, start, end))
+            if len(chosen) >= max_groups:
+                break
+
+        wanted_ids = {row_id for _, _, _, start, end in chosen for row_id in ordered_ids[start:end]}
+        rows_by_id = {}
+        wanted = list(wanted_ids)
+        for offset in range(0, len(wanted), 500):  # 控制单条语句的参数个数
+            batch = wanted[offset:offset + 500]
+            for window_row in conn.execute(f"""
+                SELECT id, timestamp_float, sender, sender_wxid, content, timestamp_str
+                FROM messages
+                WHERE id IN ({",".join("?" * len(batch))})
+            """, batch):
+                rows_by_id[window_row[0]] = window_row
+
+        results = []
+        for score, row, anchor_index, start, end in chosen:
+            window = [rows_by_id[row_id] for row_id in ordered_ids[start:end] if row_id in rows_by_id]
+            anchor_pos = next((i for i, window_row in enumerate(window) if window_row[0] == row[0]), None)
+            if anchor_pos is None:
+                continue  # 锚点在两次查询之间被裁剪
             matched_keywords = [
                 orig
                 for orig, lower in normalized_keywords
-                if lower in lower_content
+                if lower in (row[4] or "").lower()
             ]
-            if not matched_keywords:
-                continue
+            result = self._build_search_result(window, anchor_pos, matched_keywords, anchor_index)
+            result["relevance"] = round(score, 4)
+            results.append(result)
+        return results
 
-            if idx in used_indices:
-                continue
+    @staticmethod
+    def _build_search_result(window, anchor_pos, matched_keywords, anchor_index):
+        """把锚点及其上下文行组装成搜索结果，window 中的行格式与 _iter_keyword_candidates 相同"""
+        segment_messages = []
+        formatted_lines = []
+        seen_lines = set()
+        for pos, msg in enumerate(window, start=-anchor_pos):
+            _, _, msg_sender, msg_wxid, msg_content, msg_time = msg
+            line = f"{msg_time} {msg_sender} {msg_content}"
+            if line not in seen_lines:
+                seen_lines.add(line)
+                formatted_lines.append(line)
+
+            segment_messages.append({
+                "time": msg_time,
+                "sender": msg_sender,
+                "sender_wxid": msg_wxid,
+                "content": msg_content,
+                "relative_offset": pos,
+                "is_match": pos == 0
+            })
 
-            start = max(0, idx - context_window)
-            end = min(total_messages, idx + context_window + 1)
-            segment_messages = []
-            formatted_lines = []
-            seen_lines = set()
+        anchor = window[anchor_pos]
+        return {
+            "matched_keywords": matched_keywords,
+            "anchor_index": anchor_index,
+            "anchor_time": anchor[5],
+            "anchor_sender": anchor[2],
+            "anchor_sender_wxid": anchor[3],
+            "messages": segment_messages,
+            "formatted_messages": formatted_lines
+        }
 
-            for pos in range(start, end):
-                msg = messages[pos]
-                line = f"{msg.get('time')} {msg.get('sender')} {msg.get('content')}"
-                if line not in seen_lines:
-                    seen_lines.add(line)
-                    formatted_lines.append(line)
-
-                segment_messages.append({
-                    "time": msg.get("time"),
-                    "sender": msg.get("sender"),
-                    "sender_wxid": msg.get("sender_wxid"),
-                    "content": msg.get("content"),
-                    "relative_offset": pos - idx,
-                    "is_match": pos == idx
-                })
+    def _iter_keyword_candidates(self, conn, chat_id, normalized_keywords, oldest, newest):
+        """按时间倒序产出可能包含任一关键词的消息行，调用方需要再精确判断是否命中
 
-            results.append({
-                "matched_keywords": matched_keywords,
-                "anchor_index": idx,
-                "anchor_time": message.get("time"),
-                "anchor_sender": message.get("sender"),
-                "anchor_sender_wxid": message.get("sender_wxid"),
-                "messages": segment_messages,
-                "formatted_messages": formatted_lines
-            })
+        关键词都不短于 3 个字符时走 messages_fts 全文索引；否则沿 idx_chat_time
+        在可检索范围内用 LIKE 过滤（仅 ASCII 不区分大小写，与 str.lower 在少数非 ASCII 字母上有差异）。
+        全文索引覆盖所有聊天，关键词在全库过于常见时命中 id 集合本身就很大，
+        此时直接扫描本聊天的保留消息（至多 max_history 条）反而更快。
+        """
+        params = [chat_id, oldest[0], oldest[1], newest[0], newest[1]]
+        use_fts = self._fts_enabled and all(
+            len(lower) >= FTS_MIN_KEYWORD_LENGTH for _, lower in normalized_keywords
+        )
+        if use_fts:
+            match_query = " OR ".join(
+                '"' + lower.replace('"', '""') + '"' for _, lower in normalized_keywords
+            )
+            hit_limit = self.max_history * FTS_MAX_HITS_FACTOR
+            hits = conn.execute("""
+                SELECT COUNT(*) FROM (
+                    SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? LIMIT ?
+                )
+            """, (match_query, hit_limit)).fetchone()[0]
+            use_fts = hits < hit_limit
+
+        if use_fts:
+            # 写成 IN 子查询：全文检索只执行一次得到命中 id 集合，再沿 idx_chat_time 倒序过滤；
+            # 写成 JOIN 时规划器会对聊天内每一行各做一次全文查询
+            return conn.execute("""
+                SELECT id, timestamp_float, sender, sender_wxid, content, timestamp_str
+                FROM messages
+                WHERE chat_id = ?
+                  AND (timestamp_float, id) BETWEEN (?, ?) AND (?, ?)
+                  AND id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)
+                ORDER BY timestamp_float DESC, id DESC
+            """, params + [match_query])
+
+        like_clauses = " OR ".join(["content LIKE ? ESCAPE '\\'"] * len(normalized_keywords))
+        like_params = [
+            "%" + lower.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            for _, lower in normalized_keywords
+        ]
+        return conn.execute(f"""
+            SELECT id, timestamp_float, sender, sender_wxid, content, timestamp_str
+            FROM messages
+            WHERE chat_id = ?
+              AND (timestamp_float, id) BETWEEN (?, ?) AND (?, ?)
+              AND ({like_clauses})
+            ORDER BY timestamp_float DESC, id DESC
+        """, params + like_params)
+
+    def search_messages_semantic(
+        self,
+        chat_id,
+        query,
+        context_window=5,
+        max_groups=10,
+        exclude_recent=30,
+        min_similarity=SEMANTIC_MIN_SIMILARITY
+    ):
+        """按语义相似度搜索消息，返回包含前后上下文的结果
 
-            for off in range(start, end):
-                used_indices.add(off)
+        用本地向量对聊天内可检索范围的所有消息做暴力余弦检索（单个聊天至多 max_history 条），
+        措辞与原文不完全一致时也能找到相关讨论。向量化器提供 key_terms 时，
+        锚点还必须包含查询中的至少一个多字符片段，排除哈希冲突造成的"笑死""666"之类的噪声。
 
-            if len(results) >= max_groups:
-                break
+        Args:
+            chat_id (str): 聊天ID（群ID或用户ID）
+            query (str): 自然语言描述的检索内容
+            context_window (int): 每条匹配消息前后额外提供的消息数量
+            max_groups (int): 返回的最多结果组数
+            exclude_recent (int): 跳过最近的若干条消息（默认30条）
+            min_similarity (float): 锚点的最低余弦相似度
 
-        return results
+        Returns:
+            list[dict]: 与 search_messages_with_context(ranked=True) 格式相同的结果，
+                按相似度从高到低排列，relevance 为余弦相似度
+        """
+        if self.embedder is None or not query or not str(query).strip():
+            return []
+
+        try:
+            context_window = max(0, min(int(context_window), 10))
+        except (TypeError, ValueError):
+            context_window = 5
+        try:
+            max_groups = max(1, min(int(max_groups), 20))
+        except (TypeError, ValueError):
+            max_groups = 10
+        try:
+            exclude_recent = max(0, int(exclude_recent))
+        except (TypeError, ValueError):
+            exclude_recent = 30
+
+        total_messages = self.get_message_count(chat_id)
+        if total_messages - exclude_recent <= 0:
+            return []
+
+        query_vector = self.embedder.embed([str(query).strip()])[0]
+        if not query_vector.any():
+            return []
+
+        try:
+            self._flush_chat(chat_id)
+            self._backfill_vectors(chat_id)
+            conn = self._read_conn()
+            newest = self._row_at_reverse_offset(conn, chat_id, exclude_recent)
+            oldest = self._row_at_reverse_offset(conn, chat_id, total_messages - 1)
+            if not newest or not oldest:
+                return []
+
+            ids, timestamps, matrix = self._chat_vectors(conn, chat_id, oldest)
+            # 排除最新 exclude_recent 条
+            searchable = (timestamps < newest[0]) | ((timestamps == newest[0]) & (ids <= newest[1]))
+            similarities = self.embedder.similarities(query_vector, matrix)
+            similarities[~searchable] = -1.0
+            if not len(similarities):
+                return []
+
+            # 每个入选片段最多覆盖 2 * context_window 个其他候选，取这么多候选足以选满 max_groups 组，
+            # 再放宽一倍留给被过滤掉的工具日志
+            candidate_limit = min(len(similarities), 2 * max_groups * (2 * context_window + 1))
+            eligible = np.flatnonzero(similarities >= min_similarity)
+            if not len(eligible):
+                return []
+            eligible = eligible[np.argsort(-similarities[eligible], kind="stable")]
+
+            # 哈希向量的相似度可能来自桶冲突：锚点必须与查询共享至少一个多字符片段。
+            # 候选按相似度从高到低分批读取，被过滤掉的不占名额，直到凑够 candidate_limit 个
+            key_terms = getattr(self.embedder, "key_terms", None)
+            terms = key_terms(str(query).strip()) if key_terms else []
+            scored = []
+            step = max(candidate_limit, 500)
+            for offset in range(0, len(eligible), step):
+                scores = {int(ids[i]): float(similarities[i]) for i in eligible[offset:offset + step]}
+                batch = list(scores)
+                for row in conn.execute(f"""
+                    SELECT id, timestamp_float, sender, sender_wxid, content, timestamp_str
+                    FROM messages
+                    WHERE id IN ({",".join("?" * len(batch))})
+                """, batch):
+                    if not row[4] or _is_internal_tool_message(row[4]):
+                        continue
+                    if terms:
+                        lower_content = row[4].lower()
+                        if not any(term in lower_content for term in terms):
+                            continue
+                    scored.append((scores[row[0]], row))
+                if len(scored) >= candidate_limit:
+                    break
+            if not scored:
+                return []
+            scored.sort(key=lambda item: (item[0], item[1][1], item[1][0]), reverse=True)
+            return self._collect_ranked_segments(conn, chat_id, oldest, scored, context_window, max_groups)
+        except sqlite3.Error as e:
+            self.LOG.error(f"语义搜索消息时出错 (chat_id={chat_id}): {e}")
+            return []
 
     def get_messages_by_reverse_range(
         self,
@@ -416,8 +1318,7 @@ class MessageSummary:
             max_messages_limit = 500
         max_messages_limit = max(1, min(max_messages_limit, 1000))
 
-        messages = self.get_messages(chat_id)
-        total_messages = len(messages)
+        total_messages = self.get_message_count(chat_id)
         if total_messages == 0:
             return {
                 "start_offset": start_offset,
@@ -430,25 +1331,25 @@ class MessageSummary:
         start_offset = min(start_offset, total_messages)
         end_offset = min(end_offset, total_messages)
 
-        start_index = max(total_messages - end_offset, 0)
-        end_index = min(total_messages - start_offset, total_messages - 1)
-
-        if end_index < start_index:
-            return {
-                "start_offset": start_offset,
-                "end_offset": end_offset,
-                "messages": [],
-                "returned_count": 0,
-                "total_messages": total_messages
-            }
-
-        selected = messages[start_index:end_index + 1]
-        if len(selected) > max_messages_limit:
-            selected = selected[-max_messages_limit:]
+        # 倒数第 start_offset..end_offset 条，超过上限时保留较新的部分；
+        # 沿 idx_chat_time 倒序跳过 start_offset-1 条，只读取要返回的行
+        limit = min(end_offset - start_offset + 1, max_messages_limit)
+        try:
+            self._flush_chat(chat_id)
+            rows = self._read_conn().execute("""
+                SELECT sender, content, timestamp_str
+                FROM messages
+                WHERE chat_id = ?
+                ORDER BY timestamp_float DESC, id DESC
+                LIMIT ? OFFSET ?
+            """, (chat_id, limit, start_offset - 1)).fetchall()
+        except sqlite3.Error as e:
+            self.LOG.error(f"按倒数范围获取消息时出错 (chat_id={chat_id}): {e}")
+            rows = []
 
         formatted_lines = [
-            f"{msg.get('time')} {msg.get('sender')} {msg.get('content')}"
-            for msg in selected
+            f"{time_str} {sender} {content}"
+            for sender, content, time_str in reversed(rows)
         ]
 
         return {
@@ -752,12 +1653,12 @@ class MessageSummary:
             max_messages = 500
         max_messages = max(1, min(max_messages, 500))
 
-        messages = self.get_messages(chat_id)
-        if not messages:
+        total_messages = self.get_message_count(chat_id)
+        if not total_messages:
             return []
 
-        total_messages = len(messages)
-        cutoff_index = total_messages - max(exclude_recent, 0)
+        exclude_recent = max(exclude_recent, 0)
+        cutoff_index = total_messages - exclude_recent
         if cutoff_index <= 0:
             return []
 
@@ -766,95 +1667,678 @@ class MessageSummary:
         if start_dt > end_dt:
             start_dt, end_dt = end_dt, start_dt
 
-        for idx in range(cutoff_index - 1, -1, -1):
-            msg = messages[idx]
-            content = msg.get("content")
-            if _is_internal_tool_message(content):
-                continue
-
-            time_str = msg.get("time")
-            dt = self._parse_datetime(time_str)
-            if not dt:
-                continue
-
-            if start_dt <= dt <= end_dt:
-                collected.append(f"{time_str} {msg.get('sender')} {content}")
-                if len(collected) >= max_messages:
-                    break
+        try:
+            self._flush_chat(chat_id)
+            conn = self._read_conn()
+            # 可检索范围是最新 total_messages 条中除去最新 exclude_recent 条的部分，
+            # 用两端边界行的 (timestamp_float, id) 表示，配合时间窗口走 idx_chat_time 范围扫描
+            newest = self._row_at_reverse_offset(conn, chat_id, exclude_recent)
+            oldest = self._row_at_reverse_offset(conn, chat_id, total_messages - 1)
+            if not newest or not oldest:
+                return []
+
+            lower_ts = max(oldest[0], start_dt.timestamp() - TIME_WINDOW_MARGIN_SECONDS)
+            upper_ts = min(newest[0], end_dt.timestamp() + 1 + TIME_WINDOW_MARGIN_SECONDS)
+            cursor = conn.execute("""
+                SELECT id, timestamp_float, sender, content, timestamp_str
+                FROM messages
+                WHERE chat_id = ? AND timestamp_float BETWEEN ? AND ?
+                ORDER BY timestamp_float DESC, id DESC
+            """, (chat_id, lower_ts, upper_ts))
+
+            for row_id, ts, sender, content, time_str in cursor:
+                # 边界行时间戳相同时按 id 判断是否在可检索范围内
+                if (ts, row_id) > newest or (ts, row_id) < oldest:
+                    continue
+                if _is_internal_tool_message(content):
+                    continue
+
+                # 浮点时间只用于预筛，是否命中仍以 timestamp_str 为准
+                dt = self._parse_datetime(time_str)
+                if not dt:
+                    continue
+
+                if start_dt <= dt <= end_dt:
+                    collected.append(f"{time_str} {sender} {content}")
+                    if len(collected) >= max_messages:
+                        break
+        except sqlite3.Error as e:
+            self.LOG.error(f"按时间窗口获取消息时出错 (chat_id={chat_id}): {e}")
+            return []
 
         collected.reverse()
         return collected
 
+    @staticmethod
+    def _row_at_reverse_offset(conn, chat_id, offset):
+        """返回倒数第 offset+1 条消息的 (timestamp_float, id)，不存在时返回 None"""
+        row = conn.execute("""
+            SELECT timestamp_float, id
+            FROM messages
+            WHERE chat_id = ?
+            ORDER BY timestamp_float DESC, id DESC
+            LIMIT 1 OFFSET ?
+        """, (chat_id, offset)).fetchone()
+        return tuple(row) if row else None
+
     # ── 上下文压缩 ────────────────────────────────────────
 
-    def get_compressed_context(self, chat_id, max_context_chars=8000, max_recent=None):
+    def set_summary_model(self, chat_model):
+        """设置用于合并滚动摘要的模型（通常是 flash 模型），None 表示只做文本截断"""
+        self.summary_model = chat_model if chat_model and hasattr(chat_model, "get_answer") else None
+
+    def get_compressed_context(self, chat_id, max_context_chars=8000, max_recent=None, max_context_tokens=None):
         """返回压缩后的上下文：近期完整消息 + 早期消息摘要。
 
-        使用字符预算而非固定条数，短消息多保留、长消息少保留，充分利用上下文窗口。
+        使用字符或 token 预算而非固定条数，短消息多保留、长消息少保留，充分利用上下文窗口。
+        给出 max_context_tokens 时按缓存的 token_count 精确装填，忽略 max_context_chars。
+        早期消息由 chat_summaries 中持久化的滚动摘要表示，每次只读取摘要之后、
+        近期窗口之前的新消息，开销与新移出窗口的消息数成正比，而不是整个历史。
 
         Args:
             chat_id: 聊天 ID
             max_context_chars: 近期消息的字符预算（粗略对应 token 数的 2 倍）
             max_recent: 近期消息条数硬上限，None 表示不限制
+            max_context_tokens: 近期消息与摘要的 token 预算，通常由模型上下文窗口减去固定消息得到
 
         Returns:
             tuple: (recent_messages, summary_text)
                 recent_messages: 按时间升序的消息 dict 列表
                 summary_text: 早期消息的压缩摘要，无需压缩时为 None
         """
-        messages = self.get_messages(chat_id)
-        if not messages:
-            return [], None
-
-        # 从最新消息倒序填充，直到字符预算或条数上限耗尽
-        char_budget = max_context_chars
-        recent = []
-        cutoff_idx = len(messages)
+        try:
+            self._flush_chat(chat_id)
+            conn = self._read_conn()
+
+            # 从最新消息倒序填充，直到预算或条数上限耗尽
+            use_tokens = max_context_tokens is not None
+            if use_tokens:
+                # 摘要的预算固定预留，不随近期消息的长度变化，保证同一摘要生成的文本逐字节相同
+                summary_tokens = min(SUMMARY_TOKEN_BUDGET, max_context_tokens // 4)
+                budget = max_context_tokens - summary_tokens
+            else:
+                budget = max_context_chars
+            recent = []
+            boundary = None  # 近期窗口中最早一条的 (timestamp_float, id)
+            has_older = False
+            uncounted = []  # token_count 为 NULL 的消息，装填后写回
+            cursor = conn.execute("""
+                SELECT id, timestamp_float, sender, sender_wxid, content, timestamp_str, token_count
+                FROM messages
+                WHERE chat_id = ?
+                ORDER BY timestamp_float DESC, id DESC
+                LIMIT ?
+            """, (chat_id, self.max_history))
+            for row_id, ts, sender, sender_wxid, content, time_str, token_count in cursor:
+                if _is_internal_tool_message(content):
+                    continue
+                if use_tokens:
+                    content_tokens = self._message_tokens(row_id, content, token_count)
+                    if token_count is None:
+                        uncounted.append((content_tokens, row_id))
+                    # "sender: content" 加上每条消息的角色开销
+                    msg_cost = self._sender_tokens(sender or "") + 1 + content_tokens + MESSAGE_TOKEN_OVERHEAD
+                else:
+                    msg_cost = len(sender or "") + 2 + len(content or "")  # "sender: content"
+
+                if (budget - msg_cost < 0 and recent) or (max_recent and len(recent) >= max_recent):
+                    has_older = True  # 预算耗尽，之后还有更早的消息
+                    break
 
-        for i in range(len(messages) - 1, -1, -1):
-            msg = messages[i]
-            content = msg.get("content", "")
-            if _is_internal_tool_message(content):
-                continue
-            sender = msg.get("sender", "")
-            msg_chars = len(sender) + 2 + len(content)  # "sender: content"
+                budget -= msg_cost
+                recent.append({
+                    "sender": sender,
+                    "sender_wxid": sender_wxid,
+                    "content": content,
+                    "time": time_str
+                })
+                boundary = (ts, row_id)
+            cursor.close()
+            recent.reverse()
+            if uncounted:
+                self._save_token_counts(uncounted)
+
+            # 没有更早的消息，无需压缩
+            if not has_older or boundary is None:
+                return recent, None
+
+            if use_tokens:
+                token_budget = summary_tokens - MESSAGE_TOKEN_OVERHEAD
+                if token_budget < 64:
+                    return recent, None
+                return recent, self._rolling_summary(conn, chat_id, boundary, token_budget=token_budget)
+            summary_budget = min(2000, max(500, budget))
+            return recent, self._rolling_summary(conn, chat_id, boundary, summary_budget)
+        except sqlite3.Error as e:
+            self.LOG.error(f"构建压缩上下文时出错 (chat_id={chat_id}): {e}")
+            return [], None
 
-            if char_budget - msg_chars < 0 and recent:
-                break  # 预算耗尽
+    def _message_tokens(self, row_id, content, cached):
+        """返回消息 content 的 token 数，优先使用写入时缓存的值"""
+        return cached if cached is not None else self.token_counter.count(content)
 
-            char_budget -= msg_chars
-            recent.insert(0, msg)
-            cutoff_idx = i
+    def _save_token_counts(self, counts):
+        """写回补算的 token 数，counts 为 [(token_count, id)]"""
+        try:
+            with self._write_lock:
+                if self._closed:
+                    return
+                self.conn.executemany("UPDATE messages SET token_count = ? WHERE id = ?", counts)
+                self.conn.commit()
+        except sqlite3.Error as e:
+            self.LOG.warning(f"写回消息 token 数失败: {e}")
 
-            if max_recent and len(recent) >= max_recent:
-                break
+    def _rolling_summary(self, conn, chat_id, boundary, summary_budget=None, token_budget=None):
+        """返回近期窗口之前所有消息的摘要，必要时把新移出窗口的消息并入持久化摘要
 
-        # 没有更早的消息，无需压缩
-        older = [m for m in messages[:cutoff_idx]
-                 if not _is_internal_tool_message(m.get("content", ""))]
-        if not older:
-            return recent, None
+        summary_budget 为字符上限；给出 token_budget 时改为按 token 数装填。
+        """
+        row = conn.execute(
+            "SELECT last_message_id, summary FROM chat_summaries WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        last_id, stored = (row[0], row[1]) if row else (0, "")
+
+        # 摘要之后、近期窗口之前的消息；窗口向前扩大时可能与摘要末尾少量重叠，不影响使用。
+        # 已覆盖的最后一条若已被裁剪，说明它早于当前保留的全部消息
+        covered = conn.execute(
+            "SELECT timestamp_float FROM messages WHERE id = ?", (last_id,)
+        ).fetchone() if last_id else None
+        last_ts = covered[0] if covered else float("-inf")
+        pending = [
+            (row_id, f"[{time_str}] {sender}: {content}")
+            for row_id, sender, content, time_str in conn.execute("""
+                SELECT id, sender, content, timestamp_str
+                FROM messages
+                WHERE chat_id = ? AND timestamp_float >= ? AND timestamp_float <= ?
+                  AND (timestamp_float, id) > (?, ?) AND (timestamp_float, id) < (?, ?)
+                ORDER BY timestamp_float ASC, id ASC
+            """, (chat_id, last_ts, boundary[0], last_ts, last_id, boundary[0], boundary[1]))
+            if not _is_internal_tool_message(content)
+        ]
 
-        # 压缩早期消息
-        summary_budget = min(2000, max(500, char_budget))
-        summary = self._compress_messages(older, summary_budget)
-        return recent, summary
+        # 累计够一批，或按 token 装填时新消息已放不进摘要预算的另一半，就并入摘要；
+        # 新消息在两次合并之间只在末尾追加，摘要文本的前缀保持不变
+        overflow = token_budget is not None and pending and sum(
+            self.token_counter.count(line) + 1 for _, line in pending
+        ) > token_budget - token_budget // 2
+        if len(pending) >= ROLLING_SUMMARY_BATCH or overflow:
+            if self.summary_model is not None:
+                self._schedule_summary_merge(chat_id, last_id, stored, pending)
+            else:
+                stored = self._fold_summary_text(stored, [line for _, line in pending], ROLLING_SUMMARY_MAX_CHARS)
+                self._save_summary(chat_id, last_id, pending[-1][0], stored)
+                pending = []
+
+        lines = [line for _, line in pending]
+        if token_budget is not None:
+            return self._compose_summary_tokens(stored, lines, token_budget) or None
+
+        if self.summary_model is not None and stored and lines:
+            # 模型摘要与尚未合并的原文各占一半预算，避免摘要被新消息挤掉
+            half = summary_budget // 2
+            stored_part = stored if len(stored) <= half else stored[:half] + "…"
+            return f"{stored_part}\n{self._fold_summary_text('', lines, summary_budget - len(stored_part))}"
+        return self._fold_summary_text(stored, lines, summary_budget) or None
+
+    def _compose_summary_tokens(self, stored, lines, token_budget):
+        """按 token 预算拼接已保存的摘要与尚未并入的消息
+
+        已保存的摘要固定占用至多一半预算，截断方式只取决于摘要本身；新消息只在末尾追加。
+        这样在两次合并之间，摘要部分逐字节不变，可以命中服务端的前缀缓存。
+        """
+        count = self.token_counter.count
+        parts = []
+        remaining = token_budget
+        if stored:
+            stored_part, stored_tokens = self._stored_summary_part(
+                stored, token_budget // 2, self.summary_model is not None
+            )
+            parts.append(stored_part)
+            remaining -= stored_tokens
 
-    def _compress_messages(self, messages, max_chars=2000):
-        """将消息列表压缩成简短文本，保留最近的信息优先。"""
-        lines = []
-        for msg in messages:
-            line = f"[{msg.get('time', '')}] {msg.get('sender', '')}: {msg.get('content', '')}"
-            lines.append(line)
+        kept = []
+        for line in reversed(lines):
+            cost = count(line) + 1
+            if cost > remaining:
+                break
+            kept.append(line)
+            remaining -= cost
+        if len(kept) < len(lines) and not stored:
+            parts.append("(earlier messages omitted)")
+        parts.extend(reversed(kept))
+        return "\n".join(parts)
+
+    def _truncate_to_tokens(self, text, max_tokens, keep_head):
+        """把文本截断到 max_tokens 以内，返回 (文本, token 数)；
+        keep_head 为 False 时保留末尾（逐行拼接的原文越靠后越新）"""
+        tokens = self.token_counter.count(text)
+        if tokens <= max_tokens:
+            return text, tokens
+        max_chars = len(text)
+        for _ in range(4):
+            max_chars = int(max_chars * max_tokens / max(tokens, 1) * 0.95)
+            if keep_head:
+                candidate = text[:max_chars] + "…"
+            else:
+                candidate = text[-max_chars:]
+                newline_idx = candidate.find("\n")
+                if 0 < newline_idx < 100:
+                    candidate = candidate[newline_idx + 1:]
+                candidate = f"(earlier messages omitted)\n{candidate}"
+            tokens = self.token_counter.count(candidate)
+            if tokens <= max_tokens:
+                return candidate, tokens
+        candidate = candidate[:max_tokens]  # 极端情况下每个字符至少是 1 个 token
+        return candidate, self.token_counter.count(candidate)
+
+    def _schedule_summary_merge(self, chat_id, last_id, stored, pending):
+        """在后台线程中用摘要模型把 pending 并入已有摘要，每个聊天同时只有一个合并任务"""
+        with self._summary_lock:
+            if chat_id in self._summary_in_flight or self._closed:
+                return
+            self._summary_in_flight.add(chat_id)
+            if self._summary_executor is None:
+                self._summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ChatSummary")
+            executor = self._summary_executor
+        executor.submit(self._merge_summary, chat_id, last_id, stored, pending)
+
+    def _merge_summary(self, chat_id, last_id, stored, pending):
+        try:
+            lines = [line for _, line in pending]
+            new_text = "\n".join(lines)
+            if len(new_text) > ROLLING_SUMMARY_MAX_INPUT_CHARS:
+                new_text = new_text[-ROLLING_SUMMARY_MAX_INPUT_CHARS:]
+            system_prompt = (
+                "你负责维护一段聊天的滚动摘要。请把新增聊天记录合并进已有摘要，输出更新后的完整摘要。\n"
+                f"要求：不超过 {ROLLING_SUMMARY_MAX_CHARS // 2} 字；保留仍然重要的早期信息（人物、约定、结论、未决问题），"
+                "新内容优先；用简洁的要点陈述事实，注明关键发言人，不要评论，不要输出摘要以外的内容。"
+            )
+            prompt = f"已有摘要：\n{stored or '（无）'}\n\n新增聊天记录：\n{new_text}"
+            summary = None
+            try:
+                summary = self.summary_model.get_answer(
+                    prompt, f"summary_{chat_id}", system_prompt_override=system_prompt
+                )
+            except Exception as e:
+                self.LOG.warning(f"模型合并滚动摘要失败，改用文本截断 (chat_id={chat_id}): {e}")
+            if not summary or not isinstance(summary, str):
+                summary = self._fold_summary_text(stored, lines, ROLLING_SUMMARY_MAX_CHARS)
+            elif len(summary) > ROLLING_SUMMARY_MAX_CHARS:
+                summary = summary[:ROLLING_SUMMARY_MAX_CHARS]
+            self._save_summary(chat_id, last_id, pending[-1][0], summary.strip())
+        except Exception as e:
+            self.LOG.error(f"合并滚动摘要时出错 (chat_id={chat_id}): {e}", exc_info=True)
+        finally:
+            with self._summary_lock:
+                self._summary_in_flight.discard(chat_id)
+
+    def _save_summary(self, chat_id, expected_last_id, new_last_id, summary):
+        """保存摘要；只有摘要自读取以来没有被其他调用推进过时才写入"""
+        with self._write_lock:
+            if self._closed:
+                return
+            cursor = self.conn.execute("""
+                UPDATE chat_summaries
+                SET last_message_id = ?, summary = ?, updated_at = ?
+                WHERE chat_id = ? AND last_message_id = ?
+            """, (new_last_id, summary, time.time(), chat_id, expected_last_id))
+            if cursor.rowcount == 0 and expected_last_id == 0:
+                self.conn.execute("""
+                    INSERT OR IGNORE INTO chat_summaries (chat_id, last_message_id, summary, updated_at)
+                    VALUES (?, ?, ?, ?)
+                """, (chat_id, new_last_id, summary, time.time()))
+            self.conn.commit()
 
-        text = "\n".join(lines)
+    @staticmethod
+    def _fold_summary_text(summary, lines, max_chars):
+        """把新消息行接在已有摘要之后，超出预算时保留最近的部分（靠后的消息更重要）"""
+        omitted_marker = "(earlier messages omitted)\n"
+        if summary.startswith(omitted_marker):
+            summary = summary[len(omitted_marker):]
+        text = "\n".join(part for part in [summary] + list(lines) if part)
         if len(text) <= max_chars:
             return text
 
-        # 超预算：保留最近的部分（靠后的消息更重要）
         text = text[-max_chars:]
         newline_idx = text.find("\n")
         if 0 < newline_idx < 100:
             text = text[newline_idx + 1:]
 
-        return f"(earlier messages omitted)\n{text}"
+        return f"{omitted_marker}{text}"
+
+if __name__ == "__main__":
+    # 基准测试：对比逐条 NOT IN 全量裁剪与摊还裁剪在不同保留条数下的单条写入延迟
+    # 用法: python -m function.func_summary
+    import statistics
+    import tempfile
+
+    class _LegacyTrimSummary(MessageSummary):
+        """旧实现：每次写入后按时间倒序重排整个聊天，删除 max_history 之外的所有消息"""
+
+        def _trim_chats(self, cursor, chat_counts):
+            for chat_id in chat_counts:
+                cursor.execute("""
+                    DELETE FROM messages
+                    WHERE chat_id = ? AND id NOT IN (
+                        SELECT id
+                        FROM messages
+                        WHERE chat_id = ?
+                        ORDER BY timestamp_float DESC
+                        LIMIT ?
+                    )
+                """, (chat_id, chat_id, self.max_history))
+            return {}
+
+    def _bench(summary_cls, retained, inserts=500):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            summary = summary_cls(
+                max_history=retained,
+                db_path=os.path.join(tmp_dir, "bench.db"),
+                write_batch_size=1,  # 每条消息一个事务，只比较裁剪本身的开销
+            )
+            # 预先填满到保留上限
+            base = time.time() - retained
+            summary.conn.executemany(
+                "INSERT INTO messages (chat_id, sender, sender_wxid, content, timestamp_float, timestamp_str) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [("bench_chat", "u", "wxid_u", f"预填充消息 {i}", base + i, "2024-01-01 00:00:00") for i in range(retained)],
+            )
+            summary.conn.commit()
+
+            latencies = []
+            for i in range(inserts):
+                start = time.perf_counter()
+                summary.record_message("bench_chat", "u", "wxid_u", f"新消息 {i}")
+                latencies.append((time.perf_counter() - start) * 1000)
+            remaining = summary.get_message_count("bench_chat")
+            summary.close_db()
+
+        latencies.sort()
+        return statistics.mean(latencies), latencies[int(len(latencies) * 0.99) - 1], remaining
+
+    logging.basicConfig(level=logging.ERROR)
+    print(f"{'保留条数':>8} | {'实现':<6} | {'平均(ms)':>9} | {'p99(ms)':>9} | 剩余")
+    for retained in (300, 3000, 10000):
+        for label, cls in (("旧", _LegacyTrimSummary), ("摊还", MessageSummary)):
+            avg_ms, p99_ms, remaining = _bench(cls, retained)
+            print(f"{retained:>8} | {label:<6} | {avg_ms:>9.3f} | {p99_ms:>9.3f} | {remaining}")
+
+    # 一致性校验：按倒数范围/时间窗口查询下推到 SQL 后，输出应与旧的 Python 切片实现完全相同
+    import random
+
+    def _legacy_reverse_range(summary, chat_id, start_offset, end_offset, max_messages_limit=500):
+        messages = summary.get_messages(chat_id)
+        total_messages = len(messages)
+        start_offset, end_offset = sorted((start_offset, end_offset))
+        if total_messages == 0:
+            return {"start_offset": start_offset, "end_offset": end_offset,
+                    "messages": [], "returned_count": 0, "total_messages": 0}
+        start_offset = min(start_offset, total_messages)
+        end_offset = min(end_offset, total_messages)
+        start_index = max(total_messages - end_offset, 0)
+        end_index = min(total_messages - start_offset, total_messages - 1)
+        selected = messages[start_index:end_index + 1][-max_messages_limit:]
+        lines = [f"{msg.get('time')} {msg.get('sender')} {msg.get('content')}" for msg in selected]
+        return {"start_offset": start_offset, "end_offset": end_offset, "messages": lines,
+                "returned_count": len(lines), "total_messages": total_messages}
+
+    def _legacy_time_window(summary, chat_id, start_time, end_time, exclude_recent=30, max_messages=500):
+        start_dt = summary._parse_datetime(start_time)
+        end_dt = summary._parse_datetime(end_time)
+        messages = summary.get_messages(chat_id)
+        cutoff_index = len(messages) - max(exclude_recent, 0)
+        if start_dt > end_dt:
+            start_dt, end_dt = end_dt, start_dt
+        collected = []
+        for msg in reversed(messages[:max(cutoff_index, 0)]):
+            if _is_internal_tool_message(msg.get("content")):
+                continue
+            dt = summary._parse_datetime(msg.get("time"))
+            if dt and start_dt <= dt <= end_dt:
+                collected.append(f"{msg.get('time')} {msg.get('sender')} {msg.get('content')}")
+                if len(collected) >= max_messages:
+                    break
+        collected.reverse()
+        return collected
+
+    def _check_windowing(retained=300, rows=1000, rounds=300, seed=7):
+        rng = random.Random(seed)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            summary = MessageSummary(
+                max_history=retained,
+                db_path=os.path.join(tmp_dir, "check.db"),
+                trim_slack=retained // 2,  # 保留待裁剪的旧行，确认它们不会被查询返回
+            )
+            base = time.time() - rows * 30
+            data = []
+            ts = base
+            for i in range(rows):
+                ts += rng.choice((0, 0, 1, 7, 45, 300))  # 含时间戳相同的消息
+                # timestamp_str 与 timestamp_float 之间允许几秒偏差，另有少量无法解析的时间
+                time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts + rng.choice((0, 0, 0, 2, -3))))
+                if rng.random() < 0.02:
+                    time_str = "未知时间"
+                content = f"消息 {i}"
+                if rng.random() < 0.05:
+                    content = f"[search_chat_history] 工具日志 {i}"
+                data.append(("check_chat", f"用户{i % 5}", f"wxid_{i % 5}", content, ts, time_str))
+            summary.conn.executemany(
+                "INSERT INTO messages (chat_id, sender, sender_wxid, content, timestamp_float, timestamp_str) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                data,
+            )
+            summary.conn.commit()
+            for i in range(20):  # 经由写缓冲和内存缓存的新消息
+                summary.record_message("check_chat", "机器人", "wxid_bot", f"新消息 {i}")
+
+            mismatches = 0
+            for _ in range(rounds):
+                start_offset = rng.randint(1, retained + 50)
+                end_offset = rng.randint(1, retained + 50)
+                limit = rng.choice((5, 50, 500))
+                if summary.get_messages_by_reverse_range("check_chat", start_offset, end_offset, limit) != \
+                        _legacy_reverse_range(summary, "check_chat", start_offset, end_offset, limit):
+                    mismatches += 1
+
+                lo = base + rng.uniform(0, rows * 60)
+                hi = lo + rng.uniform(0, rows * 30)
+                start_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(lo))
+                end_time = time.strftime("%Y-%m-%d %H:%M", time.localtime(hi))
+                if rng.random() < 0.5:
+                    start_time, end_time = end_time, start_time
+                exclude_recent = rng.choice((0, 10, 30, retained, retained + 5))
+                max_messages = rng.choice((3, 50, 500))
+                if summary.get_messages_by_time_window("check_chat", start_time, end_time, exclude_recent, max_messages) != \
+                        _legacy_time_window(summary, "check_chat", start_time, end_time, exclude_recent, max_messages):
+                    mismatches += 1
+            summary.close_db()
+        print(f"窗口查询一致性: {rounds * 2} 次随机查询，不一致 {mismatches} 次")
+
+    _check_windowing()
+
+    # 关键词搜索：旧实现逐条扫描全部保留消息，新实现由全文索引/LIKE 圈定候选锚点
+    def _legacy_search(summary, chat_id, keywords, context_window=5, max_groups=20, exclude_recent=30):
+        normalized = [(kw, kw.lower()) for kw in keywords]
+        messages = summary.get_messages(chat_id)
+        cutoff_index = len(messages) - exclude_recent
+        results = []
+        used_indices = set()
+        for idx in range(cutoff_index - 1, -1, -1):
+            message = messages[idx]
+            lower_content = (message.get("content") or "").lower()
+            matched = [orig for orig, lower in normalized if lower and lower in lower_content]
+            if not message.get("content") or not matched or idx in used_indices:
+                continue
+            start = max(0, idx - context_window)
+            end = min(len(messages), idx + context_window + 1)
+            segment, lines, seen = [], [], set()
+            for pos in range(start, end):
+                msg = messages[pos]
+                line = f"{msg.get('time')} {msg.get('sender')} {msg.get('content')}"
+                if line not in seen:
+                    seen.add(line)
+                    lines.append(line)
+                segment.append({"time": msg.get("time"), "sender": msg.get("sender"),
+                                "sender_wxid": msg.get("sender_wxid"), "content": msg.get("content"),
+                                "relative_offset": pos - idx, "is_match": pos == idx})
+            results.append({"matched_keywords": matched, "anchor_index": idx,
+                            "anchor_time": message.get("time"), "anchor_sender": message.get("sender"),
+                            "anchor_sender_wxid": message.get("sender_wxid"),
+                            "messages": segment, "formatted_messages": lines})
+            used_indices.update(range(start, end))
+            if len(results) >= max_groups:
+                break
+        return results
+
+    _WORDS = ["今天", "天气", "不错", "周末", "一起", "吃饭", "火锅", "项目", "进度", "会议",
+              "Python", "deploy", "服务器", "数据库", "报错", "重启", "测试", "上线", "好的", "哈哈"]
+
+    def _random_content(rng, i):
+        return "".join(rng.choice(_WORDS) for _ in range(rng.randint(2, 8))) + f" #{i}"
+
+    def _check_keyword_search(retained=300, rows=600, rounds=200, seed=11):
+        rng = random.Random(seed)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            summary = MessageSummary(
+                max_history=retained,
+                db_path=os.path.join(tmp_dir, "search.db"),
+                trim_slack=retained // 2,
+            )
+            ts = time.time() - rows * 60
+            data = []
+            for i in range(rows):
+                ts += rng.choice((0, 1, 30))
+                content = _random_content(rng, i)
+                if rng.random() < 0.1:
+                    content = content.upper()
+                data.append(("search_chat", f"用户{i % 4}", f"wxid_{i % 4}", content, ts,
+                             time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))))
+            summary.conn.executemany(
+                "INSERT INTO messages (chat_id, sender, sender_wxid, content, timestamp_float, timestamp_str) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                data,
+            )
+            summary.conn.commit()
+            for i in range(20):
+                summary.record_message("search_chat", "机器人", "wxid_bot", _random_content(rng, rows + i))
+            summary.clear_message_history("other_chat")  # 触发删除触发器
+
+            mismatches = 0
+            for _ in range(rounds):
+                keywords = rng.sample(_WORDS + ["python", "DEPLOY", "#12", "火锅不错", "不存在的词"], rng.randint(1, 3))
+                context_window = rng.choice((0, 2, 10))
+                max_groups = rng.choice((1, 5, 20))
+                exclude_recent = rng.choice((0, 30, retained - 5, retained + 5))
+                if summary.search_messages_with_context("search_chat", keywords, context_window, max_groups, exclude_recent) != \
+                        _legacy_search(summary, "search_chat", keywords, context_window, max_groups, exclude_recent):
+                    mismatches += 1
+            fts = summary._fts_enabled
+            summary.close_db()
+        print(f"关键词搜索一致性 (全文索引={'开' if fts else '关'}): {rounds} 次随机查询，不一致 {mismatches} 次")
+
+    def _bench_keyword_search(total_rows=1_000_000, chats=100, queries=50, seed=3):
+        rng = random.Random(seed)
+        per_chat = total_rows // chats
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            summary = MessageSummary(max_history=per_chat, db_path=os.path.join(tmp_dir, "fts_bench.db"))
+            started = time.perf_counter()
+            base = time.time() - per_chat * 60
+            for c in range(chats):
+                summary.conn.executemany(
+                    "INSERT INTO messages (chat_id, sender, sender_wxid, content, timestamp_float, timestamp_str) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(f"chat_{c}", "u", "wxid_u", _random_content(rng, i), base + i * 60, "2024-01-01 00:00:00")
+                     for i in range(per_chat)],
+                )
+                summary.conn.commit()
+            print(f"已生成 {chats} 个聊天共 {chats * per_chat} 条消息 (含全文索引)，耗时 {time.perf_counter() - started:.1f}s")
+
+            cases = (
+                ("罕见关键词", ["#4242"]),           # 每个聊天只有 1 条命中，旧实现需要扫描全部消息
+                ("常见关键词", ["火锅", "数据库"]),   # 2 字关键词走 LIKE 范围扫描
+                ("常见长关键词", ["服务器报错"]),
+                ("无命中", ["不存在的词"]),
+                ("全库高频", ["python", "deploy"]),  # 全文索引命中过多，退回聊天内扫描
+            )
+            print(f"{'查询':<8} | {'旧(ms)':>9} | {'新(ms)':>9} | {'相关度排序(ms)':>9} | 结果一致")
+            for label, keywords in cases:
+                timings = {"旧": [], "新": [], "排序": []}
+                same = True
+                for q in range(queries):
+                    chat_id = f"chat_{rng.randrange(chats)}"
+                    start = time.perf_counter()
+                    legacy = _legacy_search(summary, chat_id, keywords, 10, 20, 30)
+                    timings["旧"].append((time.perf_counter() - start) * 1000)
+                    start = time.perf_counter()
+                    current = summary.search_messages_with_context(chat_id, keywords, 10, 20, 30)
+                    timings["新"].append((time.perf_counter() - start) * 1000)
+                    start = time.perf_counter()
+                    summary.search_messages_with_context(chat_id, keywords, 10, 20, 30, ranked=True)
+                    timings["排序"].append((time.perf_counter() - start) * 1000)
+                    same = same and legacy == current
+                print(f"{label:<8} | {statistics.mean(timings['旧']):>9.2f} | {statistics.mean(timings['新']):>9.2f} | "
+                      f"{statistics.mean(timings['排序']):>9.2f} | {same}")
+            summary.close_db()
+
+    def _legacy_compressed_context(summary, chat_id, max_context_chars=8000, max_recent=None):
+        """旧实现：每次构建上下文都读出全部历史，重新拼接近期窗口之前的所有消息"""
+        messages = summary.get_messages(chat_id)
+        char_budget = max_context_chars
+        recent = []
+        cutoff_idx = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            msg = messages[i]
+            if _is_internal_tool_message(msg["content"]):
+                continue
+            msg_chars = len(msg["sender"]) + 2 + len(msg["content"])
+            if char_budget - msg_chars < 0 and recent:
+                break
+            char_budget -= msg_chars
+            recent.insert(0, msg)
+            cutoff_idx = i
+            if max_recent and len(recent) >= max_recent:
+                break
+        older = [f"[{m['time']}] {m['sender']}: {m['content']}" for m in messages[:cutoff_idx]
+                 if not _is_internal_tool_message(m["content"])]
+        if not older:
+            return recent, None
+        return recent, MessageSummary._fold_summary_text("", older, min(2000, max(500, char_budget)))
+
+    def _bench_compressed_context(retained=(1000, 5000, 20000), rounds=200, seed=13):
+        """模拟每条新消息后构建一次 Kimi 上下文：旧实现随历史长度线性增长，滚动摘要只处理新移出窗口的消息"""
+        print(f"{'保留条数':>8} | {'旧(ms)':>8} | {'滚动摘要(ms)':>8} | 近期窗口一致 | 摘要末尾一致")
+        for size in retained:
+            rng = random.Random(seed)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                summary = MessageSummary(max_history=size, db_path=os.path.join(tmp_dir, "ctx.db"),
+                                         semantic_search=False)
+                base = time.time() - size * 60
+                summary.conn.executemany(
+                    "INSERT INTO messages (chat_id, sender, sender_wxid, content, timestamp_float, timestamp_str) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [("ctx_chat", f"用户{i % 5}", f"wxid_{i % 5}", _random_content(rng, i), base + i * 60,
+                      time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(base + i * 60))) for i in range(size)],
+                )
+                summary.conn.commit()
+                summary.get_compressed_context("ctx_chat", max_recent=30)  # 首次调用折叠全部早期消息
+
+                legacy_ms, rolling_ms = [], []
+                same_recent = same_tail = True
+                for i in range(rounds):
+                    summary.record_message("ctx_chat", f"用户{i % 5}", f"wxid_{i % 5}", _random_content(rng, size + i))
+                    start = time.perf_counter()
+                    recent, text = summary.get_compressed_context("ctx_chat", max_recent=30)
+                    rolling_ms.append((time.perf_counter() - start) * 1000)
+                    start = time.perf_counter()
+                    legacy_recent, legacy_text = _legacy_compressed_context(summary, "ctx_chat", max_recent=30)
+                    legacy_ms.append((time.perf_counter() - start) * 1000)
+                    same_recent = same_recent and [m["content"] for m in recent] == [m["content"] for m in legacy_recent]
+                    # 两者都保留最近的早期消息，末尾一段应当相同
+                    same_tail = same_tail and text[-200:] == legacy_text[-200:]
+                summary.close_db()
+            print(f"{size:>8} | {statistics.mean(legacy_ms):>8.2f} | {statistics.mean(rolling_ms):>8.2f} | "
+                  f"{same_recent} | {same_tail}")
+
+    _check_keyword_search()
+    _bench_compressed_context()
+    _bench_keyword_search()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""Token 计数
+
+按字符数估算上下文长度对中英混排文本误差很大（一个汉字通常是 1 个 token，
+而 4 个英文字母才约 1 个 token），这里提供统一的 token 计数接口：
+
+- 安装了 tiktoken 时使用其本地 BPE 编码（o200k_base / cl100k_base）精确计数；
+- 否则退回到按 BPE 预分词规则近似的估算器，不需要词表和网络。
+
+消息的 token 数在写入时计算一次并缓存在 messages.token_count 列中，
+构建上下文时直接按 token 预算装填历史消息。任何提供 name 和 count 的对象都可以替换默认计数器。
+"""
+
+import logging
+import math
+import re
+from typing import Iterable, List, Optional
+
+try:
+    import tiktoken
+except ImportError:  # 可选依赖，缺失时使用估算器
+    tiktoken = None
+
+logger = logging.getLogger("TokenCounter")
+
+DEFAULT_ENCODING = "o200k_base"
+MESSAGE_TOKEN_OVERHEAD = 4          # 每条 chat 消息的角色与分隔符开销
+DEFAULT_CONTEXT_WINDOW = 8192       # 未知模型的保守上下文窗口
+DEFAULT_RESPONSE_RESERVE_TOKENS = 4096  # 为模型回复和工具定义预留的 token 数（不超过窗口的 1/4）
+
+# 常见模型的上下文窗口 (token)，按前缀匹配，越具体的前缀越靠前
+MODEL_CONTEXT_WINDOWS = (
+    ("gpt-3.5-turbo", 16385),
+    ("gpt-4o", 128000),
+    ("gpt-4.1", 1047576),
+    ("gpt-4-turbo", 128000),
+    ("gpt-4-vision", 128000),
+    ("gpt-4-32k", 32768),
+    ("gpt-4", 8192),
+    ("gpt-5", 400000),
+    ("o1", 200000),
+    ("o3", 200000),
+    ("o4", 200000),
+    ("deepseek-chat", 65536),
+    ("deepseek-reasoner", 65536),
+    ("kimi-k2", 131072),
+    ("kimi-latest", 131072),
+    ("moonshot-v1-8k", 8192),
+    ("moonshot-v1-32k", 32768),
+    ("moonshot-v1-128k", 131072),
+    ("sonar", 127072),
+)
+
+# 近似 BPE 预分词：英文单词、数字、汉字/假名/谚文、其他非 ASCII 字符、标点
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TOKEN_PIECE = re.compile(
+    rf"(?P<word>[A-Za-z]+)|(?P<digits>[0-9]+)|(?P<cjk>[{_CJK}])|(?P<other>[^\x00-\x7f])|[^\sA-Za-z0-9]"
+)
+
+
+class EstimatingTokenCounter:
+    """不依赖词表的 token 估算器
+
+    规则取自主流 BPE 编码的统计特征：常见英文单词 1 个 token，长单词约每 4 个字母 1 个；
+    数字每 3 位 1 个；常用汉字约 1 个；emoji 等其他非 ASCII 字符约 2 个；标点各 1 个。
+    """
+
+    name = "estimate-v1"
+
+    def count(self, text: Optional[str]) -> int:
+        if not text:
+            return 0
+        tokens = 0
+        for match in _TOKEN_PIECE.finditer(text):
+            kind = match.lastgroup
+            if kind == "word":
+                length = match.end() - match.start()
+                tokens += 1 if length <= 6 else math.ceil(length / 4)
+            elif kind == "digits":
+                tokens += math.ceil((match.end() - match.start()) / 3)
+            elif kind == "other":
+                tokens += 2
+            else:  # 汉字或标点
+                tokens += 1
+        return tokens
+
+    def count_many(self, texts: Iterable[Optional[str]]) -> List[int]:
+        return [self.count(text) for text in texts]
+
+
+class TiktokenCounter:
+    """使用 tiktoken 本地 BPE 编码精确计数（首次使用时 tiktoken 需要下载编码文件）"""
+
+    def __init__(self, encoding: str = DEFAULT_ENCODING):
+        self._encoding = tiktoken.get_encoding(encoding)
+        self.name = f"tiktoken-{encoding}"
+
+    def count(self, text: Optional[str]) -> int:
+        if not text:
+            return 0
+        return len(self._encoding.encode_ordinary(text))
+
+    def count_many(self, texts: Iterable[Optional[str]]) -> List[int]:
+        texts = [text or "" for text in texts]
+        return [len(tokens) for tokens in self._encoding.encode_ordinary_batch(texts)]
+
+
+def create_token_counter(encoding: str = DEFAULT_ENCODING):
+    """创建默认计数器：优先 tiktoken，不可用时退回估算器"""
+    if tiktoken is not None:
+        for name in (encoding, "cl100k_base"):
+            try:
+                return TiktokenCounter(name)
+            except Exception as e:  # 编码文件下载失败等
+                logger.warning(f"加载 tiktoken 编码 {name} 失败: {e}")
+    return EstimatingTokenCounter()
+
+
+def context_window_for(model: Optional[str], default: int = DEFAULT_CONTEXT_WINDOW) -> int:
+    """按模型名查找上下文窗口大小，未知模型返回 default"""
+    model = (model or "").lower()
+    for prefix, window in MODEL_CONTEXT_WINDOWS:
+        if model.startswith(prefix):
+            return window
+    return default
+
+
+def history_token_budget(counter, context_window: int, fixed_messages: Iterable[dict],
+                         reserve_tokens: Optional[int] = None) -> int:
+    """计算可用于历史消息的 token 预算
+
+    Args:
+        counter: token 计数器
+        context_window: 模型上下文窗口
+        fixed_messages: 必须发送的消息（系统提示、当前问题等）
+        reserve_tokens: 为回复预留的 token 数，None 表示使用默认值
+
+    Returns:
+        int: 历史消息（含早期摘要）可使用的 token 数
+    """
+    if reserve_tokens is None:
+        reserve_tokens = min(DEFAULT_RESPONSE_RESERVE_TOKENS, context_window // 4)
+    used = sum(counter.count(message.get("content") or "") + MESSAGE_TOKEN_OVERHEAD for message in fixed_messages)
+    return max(0, context_window - reserve_tokens - used)
+
+
+if __name__ == "__main__":
+    # 基准测试：按 token 预算装填上下文，对比使用缓存的 token_count 与每次重新计数
+    # 用法: python -m function.func_tokens
+    import os
+    import random
+    import statistics
+    import tempfile
+    import time
+
+    from function.func_summary import MessageSummary
+
+    MESSAGES = 10000
+    ROUNDS = 20
+
+    class _UncachedSummary(MessageSummary):
+        """对照组：忽略缓存列，每次构建上下文都重新计算每条消息的 token 数"""
+
+        def _message_tokens(self, row_id, content, cached):
+            return self.token_counter.count(content)
+
+    words = ["今天", "天气", "不错", "周末", "一起", "吃饭", "火锅", "项目", "进度", "会议", "Python", "deploy",
+             "服务器", "数据库", "报错", "重启", "测试", "上线", "好的", "哈哈", "https://example.com/a?b=1", "12345"]
+
+    logging.basicConfig(level=logging.ERROR)
+    counter = create_token_counter()
+    print(f"计数器: {counter.name}")
+    rng = random.Random(1)
+    samples = ["".join(rng.choice(words) for _ in range(rng.randint(5, 60))) for _ in range(2000)]
+    started = time.perf_counter()
+    counter.count_many(samples)
+    print(f"计数 2000 条消息: {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "tokens.db")
+        summary = MessageSummary(max_history=MESSAGES, db_path=db_path, semantic_search=False)
+        for i in range(MESSAGES):
+            summary.record_message("chat", f"用户{i % 7}", f"wxid_{i % 7}",
+                                   "".join(rng.choice(words) for _ in range(rng.randint(5, 60))))
+        summary.close_db()
+
+        print(f"{'token 预算':>10} | {'缓存(ms)':>9} | {'不缓存(ms)':>9} | 近期条数")
+        for budget in (4000, 32000, 120000):
+            timings = {}
+            for label, cls in (("缓存", MessageSummary), ("不缓存", _UncachedSummary)):
+                summary = cls(max_history=MESSAGES, db_path=db_path, semantic_search=False)
+                summary.get_compressed_context("chat", max_context_tokens=budget)  # 预热
+                latencies = []
+                for _ in range(ROUNDS):
+                    start = time.perf_counter()
+                    recent, _ = summary.get_compressed_context("chat", max_context_tokens=budget)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                timings[label] = statistics.mean(latencies)
+                summary.close_db()
+            print(f"{budget:>10} | {timings['缓存']:>9.2f} | {timings['不缓存']:>9.2f} | {len(recent)}")
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
 import logging
 import re
 import time
@@ -8,6 +9,7 @@ from queue import Empty
 from threading import Thread
 import random
 import copy
+from typing import Optional, Tuple
 from image.img_manager import ImageGenerationManager
 
 from wcferry import Wcf, WxMsg
@@ -19,22 +21,28 @@ from ai_providers.ai_perplexity import Perplexity
 from function.func_weather import Weather
 from function.func_news import News
 from function.func_summary import MessageSummary  # 导入新的MessageSummary类
+from function.func_embedding import create_embedder
 from function.func_reminder import ReminderManager  # 导入ReminderManager类
 from function.func_persona import (
     PersonaManager,
     fetch_persona_for_context,
     handle_persona_command,
 )  # 导入人设相关工具
-from configuration import Config
+from configuration import ChatPolicy, Config
 from constants import ChatType
 from job_mgmt import Job
 from function.func_xml_process import XmlProcessor
+from function.func_search_cache import create_search_cache
 
 # 导入上下文及常用处理函数
 from commands.context import MessageContext
-from commands.handlers import handle_chitchat  # 导入闲聊处理函数
+from commands.handlers import handle_chitchat, handle_chitchat_async  # 导入闲聊处理函数
 from commands.keyword_triggers import KeywordTriggerProcessor
 from commands.message_forwarder import MessageForwarder
+from commands.message_dispatcher import AsyncMessageDispatcher, MessageDispatcher
+from commands.send_queue import PRIORITY_REPLY, PRIORITY_STATUS, OutboundMessage, create_send_queue
+from tools.cache import tool_cache
+from tools.selector import tool_selector
 
 __version__ = "39.2.4.0"
 
@@ -51,32 +59,23 @@ class Robot(Job):
         self.LOG = logging.getLogger("Robot")
         self.wxid = self.wcf.get_self_wxid() # 获取机器人自己的wxid
         self.allContacts = self.getAllContacts()
-        self._msg_timestamps = []
-        default_random_prob = getattr(self.config, "GROUP_RANDOM_CHITCHAT_DEFAULT", 0.0)
-        try:
-            self.group_random_reply_default = float(default_random_prob)
-        except (TypeError, ValueError):
-            self.group_random_reply_default = 0.0
-        self.group_random_reply_default = max(0.0, min(1.0, self.group_random_reply_default))
-
-        mapping_random_prob = getattr(self.config, "GROUP_RANDOM_CHITCHAT", {})
-        self.group_random_reply_mapping = {}
-        if isinstance(mapping_random_prob, dict):
-            for room_id, rate in mapping_random_prob.items():
-                try:
-                    numeric_rate = float(rate)
-                except (TypeError, ValueError):
-                    numeric_rate = self.group_random_reply_default
-                numeric_rate = max(0.0, min(1.0, numeric_rate))
-                self.group_random_reply_mapping[room_id] = numeric_rate
-
+        # 出站消息队列：发送节奏与频率限制由发送线程负责，调用方入队后立即返回
+        self.send_queue = create_send_queue(
+            getattr(self.config, "SEND_QUEUE", {}),
+            self.config.SEND_RATE_LIMIT,
+            self._deliver_text,
+            self.LOG,
+        )
+        self.send_queue.start()
+        # 随机闲聊概率已在 Config.reload 中归一化并编译进 CHAT_POLICIES
         self.group_random_reply_state = {}
 
-        if self.group_random_reply_default > 0:
+        default_random_prob = getattr(self.config, "GROUP_RANDOM_CHITCHAT_DEFAULT", 0.0)
+        if default_random_prob > 0:
             self.LOG.info(
-                f"群聊随机闲聊默认开启，概率={self.group_random_reply_default}"
+                f"群聊随机闲聊默认开启，概率={default_random_prob}"
             )
-        for room_id, rate in self.group_random_reply_mapping.items():
+        for room_id, rate in getattr(self.config, "GROUP_RANDOM_CHITCHAT", {}).items():
             self.LOG.info(
                 f"群聊随机闲聊设置: 群={room_id}, 概率={rate}"
             )
@@ -88,7 +87,24 @@ class Robot(Job):
              db_path = "data/message_history.db"
              # 使用 getattr 安全地获取 MAX_HISTORY，如果不存在则默认为 300
              max_hist = getattr(config, 'MAX_HISTORY', 300)
-             self.message_summary = MessageSummary(max_history=max_hist, db_path=db_path)
+             history_conf = getattr(config, 'MESSAGE_HISTORY', {}) or {}
+             semantic_conf = history_conf.get("semantic_search", True)
+             if not isinstance(semantic_conf, dict):
+                 semantic_conf = {"enable": bool(semantic_conf)}
+             semantic_enabled = bool(semantic_conf.get("enable", True))
+             self.message_summary = MessageSummary(
+                 max_history=max_hist,
+                 db_path=db_path,
+                 write_batch_size=history_conf.get("write_batch_size", 50),
+                 write_flush_interval_ms=history_conf.get("write_flush_interval_ms", 500),
+                 trim_slack=history_conf.get("trim_slack"),
+                 cache_max_chats=history_conf.get("cache_max_chats", 256),
+                 cache_max_messages=history_conf.get("cache_max_messages", 50000),
+                 semantic_search=semantic_enabled,
+                 embedder=create_embedder(
+                     spec=semantic_conf.get("embedder"), options=semantic_conf.get("options")
+                 ) if semantic_enabled else None,
+             )
              self.LOG.info(f"消息历史记录器已初始化 (max_history={self.message_summary.max_history})")
         except Exception as e:
              self.LOG.error(f"初始化 MessageSummary 失败: {e}", exc_info=True)
@@ -204,29 +220,33 @@ class Robot(Job):
             except Exception as e:
                 self.LOG.error(f"初始化 Perplexity 模型时出错: {str(e)}")
             
-        # 根据chat_type参数选择默认模型
-        self.current_model_id = None
+        # 根据chat_type参数选择默认模型（仅作为默认值，单条消息的模型选择记录在 MessageContext 上）
         if chat_type > 0 and chat_type in self.chat_models:
             self.chat = self.chat_models[chat_type]
             self.default_model_id = chat_type
-            self.current_model_id = chat_type
         else:
             # 如果没有指定chat_type或指定的模型不可用，尝试使用配置文件中指定的默认模型
             self.default_model_id = self.config.GROUP_MODELS.get('default', 0)
             if self.default_model_id in self.chat_models:
                 self.chat = self.chat_models[self.default_model_id]
-                self.current_model_id = self.default_model_id
             elif self.chat_models:  # 如果有任何可用模型，使用第一个
                 self.default_model_id = list(self.chat_models.keys())[0]
                 self.chat = self.chat_models[self.default_model_id]
-                self.current_model_id = self.default_model_id
             else:
                 self.LOG.warning("未配置任何可用的模型")
                 self.chat = None
                 self.default_model_id = 0
-                self.current_model_id = None
 
         self.LOG.info(f"默认模型: {self.chat}，模型ID: {self.default_model_id}")
+
+        # 滚动摘要使用的模型（建议使用 flash 模型），未配置时只做文本截断
+        summary_model_id = (getattr(self.config, 'MESSAGE_HISTORY', {}) or {}).get("summary_model")
+        if self.message_summary and summary_model_id:
+            if summary_model_id in self.chat_models:
+                self.message_summary.set_summary_model(self.chat_models[summary_model_id])
+                self.LOG.info(f"滚动摘要模型: {self.chat_models[summary_model_id].__class__.__name__}(ID:{summary_model_id})")
+            else:
+                self.LOG.warning(f"滚动摘要模型ID {summary_model_id} 不可用，将只做文本截断")
         
         # 显示群组-模型映射信息
         if hasattr(self.config, 'GROUP_MODELS'):
@@ -260,15 +280,41 @@ class Robot(Job):
         
         # 工具系统在首次 handle_chitchat 调用时自动加载
         self.LOG.info("Agent 工具系统就绪（延迟加载）")
+
+        # 工具结果缓存：新消息写入后作废该会话的历史查询结果
+        agent_conf = getattr(self.config, "AGENT", {}) or {}
+        tool_cache.configure(agent_conf.get("tool_cache"))
+        tool_selector.configure(agent_conf.get("tool_filter"))
+        if self.message_summary:
+            self.message_summary.add_record_listener(
+                lambda chat_id: tool_cache.invalidate("lookup_chat_history", chat_id)
+            )
         
         # 初始化提醒管理器
         try:
             # 使用与MessageSummary相同的数据库路径
             db_path = getattr(self.message_summary, 'db_path', "data/message_history.db")
             self.reminder_manager = ReminderManager(self, db_path)
+            self.reminder_manager.add_change_listener(
+                lambda wxid: tool_cache.invalidate("reminder_list", wxid)
+            )
             self.LOG.info("提醒管理器已初始化，与消息历史使用相同数据库。")
         except Exception as e:
             self.LOG.error(f"初始化提醒管理器失败: {e}", exc_info=True)
+
+        # 初始化联网搜索结果缓存（同一数据库）
+        self.search_cache = None
+        search_cache_conf = getattr(self.config, "WEB_SEARCH_CACHE", {}) or {}
+        try:
+            db_path = getattr(self.message_summary, 'db_path', "data/message_history.db")
+            self.search_cache = create_search_cache(search_cache_conf, db_path)
+            if self.search_cache:
+                evict_interval = search_cache_conf.get("evict_interval_minutes", 30)
+                if evict_interval:
+                    self.onEveryMinutes(evict_interval, self.search_cache.evict)
+                self.LOG.info("联网搜索缓存已初始化，与消息历史使用相同数据库。")
+        except Exception as e:
+            self.LOG.error(f"初始化联网搜索缓存失败: {e}", exc_info=True)
         
         # 初始化人设管理器
         persona_db_path = getattr(self.message_summary, 'db_path', "data/message_history.db") if getattr(self, 'message_summary', None) else "data/message_history.db"
@@ -286,6 +332,36 @@ class Robot(Job):
         )
         forwarding_conf = getattr(self.config, "MESSAGE_FORWARDING", {})
         self.message_forwarder = MessageForwarder(self, forwarding_conf, self.LOG)
+
+        # 初始化消息分发器：按会话串行、跨会话并行处理消息
+        dispatcher_conf = getattr(self.config, "MESSAGE_DISPATCHER", {})
+        dispatcher_mode = dispatcher_conf.get("mode", "thread") if isinstance(dispatcher_conf, dict) else "thread"
+        if dispatcher_mode == "asyncio":
+            # asyncio 运行时：少量线程承载大量并发中的 LLM 会话
+            self.message_dispatcher = AsyncMessageDispatcher(
+                self.processMsgAsync,
+                dispatcher_conf,
+                self.LOG,
+                on_drop=self._record_dropped_message,
+            )
+        else:
+            self.message_dispatcher = MessageDispatcher(
+                self.processMsg,
+                dispatcher_conf,
+                self.LOG,
+                on_drop=self._record_dropped_message,
+            )
+        stats_interval = dispatcher_conf.get("stats_interval_minutes", 5) if isinstance(dispatcher_conf, dict) else 5
+        if self.message_dispatcher.enabled and stats_interval:
+            self.onEveryMinutes(stats_interval, self.message_dispatcher.log_stats)
+        if stats_interval:
+            # 各模型的 token 用量与服务端前缀缓存命中率
+            self.onEveryMinutes(stats_interval, self._log_model_usage)
+            self.onEveryMinutes(stats_interval, tool_cache.log_stats)
+            self.onEveryMinutes(stats_interval, tool_selector.log_stats)
+            self.onEveryMinutes(stats_interval, self.send_queue.log_stats)
+            if self.search_cache:
+                self.onEveryMinutes(stats_interval, self.search_cache.log_stats)
         
     @staticmethod
     def value_check(args: dict) -> bool:
@@ -293,12 +369,15 @@ class Robot(Job):
             return all(value is not None for key, value in args.items() if key != 'proxy')
         return False
 
+    def _get_chat_policy(self, chat_id: str, is_group: bool) -> ChatPolicy:
+        """从预编译的策略表中查找会话策略（每次读取 config 上的最新表，reload 后立即生效）"""
+        return self.config.CHAT_POLICIES.lookup(chat_id, is_group)
+
     def _is_group_enabled(self, room_id: str) -> bool:
         """判断群聊是否在配置的允许名单内。"""
         if not room_id:
             return False
-        enabled_groups = getattr(self.config, "GROUPS", None) or []
-        return room_id in enabled_groups
+        return self._get_chat_policy(room_id, True).enabled
 
     def processMsg(self, msg: WxMsg) -> None:
         """
@@ -306,120 +385,171 @@ class Robot(Job):
         :param msg: 微信消息对象
         """
         try:
-            # 1. 使用MessageSummary记录消息(保持不变)
-            self.message_summary.process_message_from_wxmsg(msg, self.wcf, self.allContacts, self.wxid)
-            
-            # 2. 根据消息来源选择使用的AI模型
-            self._select_model_for_message(msg)
-            
-            # 3. 获取本次对话特定的历史消息限制
-            specific_limit = self._get_specific_history_limit(msg)
-            self.LOG.debug(f"本次对话 ({msg.sender} in {msg.roomid or msg.sender}) 使用历史限制: {specific_limit}")
-            
-            # 4. 预处理消息，生成MessageContext
-            ctx = self.preprocess(msg)
-            # 确保context能访问到当前选定的chat模型及特定历史限制
-            setattr(ctx, 'chat', self.chat)
-            setattr(ctx, 'specific_max_history', specific_limit)
-            persona_text = fetch_persona_for_context(self, ctx)
-            setattr(ctx, 'persona', persona_text)
-            group_enabled = ctx.is_group and self._is_group_enabled(msg.roomid)
-            setattr(ctx, 'group_enabled', group_enabled)
-
-            # 检查是否配置了 force_reasoning（闲聊时强制使用推理模型，AI路由仍正常执行）
-            force_reasoning = getattr(self, '_current_force_reasoning', False)
-            setattr(ctx, 'force_reasoning', force_reasoning)
-
-            trigger_decision = None
-            if getattr(self, "keyword_trigger_processor", None):
-                trigger_decision = self.keyword_trigger_processor.evaluate(ctx)
-                ctx.reasoning_requested = trigger_decision.reasoning_requested
-                setattr(ctx, 'keyword_trigger_decision', trigger_decision)
+            ctx = self._route_message(msg)
+            if ctx is not None:
+                self._handle_chitchat(ctx, None)
+                self._after_chitchat(ctx)
+        except Exception as e:
+            self.LOG.error(f"处理消息时发生错误: {str(e)}", exc_info=True)
+
+    async def processMsgAsync(self, msg: WxMsg) -> None:
+        """
+        processMsg 的异步版本，供 asyncio 运行时使用。
+        路由阶段（写历史、查人设、wcf 调用等）都是阻塞操作，放到线程池中执行；
+        LLM 调用则在事件循环上并发等待。
+        :param msg: 微信消息对象
+        """
+        try:
+            ctx = await asyncio.to_thread(self._route_message, msg)
+            if ctx is not None:
+                await self._handle_chitchat_async(ctx, None)
+                self._after_chitchat(ctx)
+        except Exception as e:
+            self.LOG.error(f"异步处理消息时发生错误: {str(e)}", exc_info=True)
+
+    def _route_message(self, msg: WxMsg) -> Optional[MessageContext]:
+        """
+        记录并路由消息，处理所有非 Agent 的分支
+        :param msg: 微信消息对象
+        :return: 需要交给 Agent 回复时返回消息上下文，否则返回 None
+        """
+        # 1. 使用MessageSummary记录消息(保持不变)
+        self.message_summary.process_message_from_wxmsg(msg, self.wcf, self.allContacts, self.wxid)
+        
+        # 2. 根据消息来源选择使用的AI模型（结果只写入本条消息的上下文）
+        policy = self._get_chat_policy(msg.roomid if msg.from_group() else msg.sender, msg.from_group())
+        model_id = self._select_model_for_message(msg, policy)
+        chat_model = self.chat_models.get(model_id) if model_id is not None else None
+        
+        # 3. 获取本次对话特定的历史消息限制
+        specific_limit = self._get_specific_history_limit(msg, chat_model, policy)
+        self.LOG.debug(f"本次对话 ({msg.sender} in {msg.roomid or msg.sender}) 使用历史限制: {specific_limit}")
+        
+        # 4. 预处理消息，生成MessageContext
+        ctx = self.preprocess(msg)
+        ctx.chat = chat_model
+        ctx.chat_model_id = model_id
+        ctx.reasoning_chat = self.reasoning_chat_models.get(model_id) if model_id is not None else None
+        # force_reasoning：闲聊时强制使用推理模型
+        ctx.force_reasoning = policy.force_reasoning
+        ctx.specific_max_history = specific_limit
+        ctx.allowed_tools = policy.tools
+        persona_text = fetch_persona_for_context(self, ctx)
+        setattr(ctx, 'persona', persona_text)
+        group_enabled = ctx.is_group and policy.enabled
+        setattr(ctx, 'group_enabled', group_enabled)
+
+        trigger_decision = None
+        if getattr(self, "keyword_trigger_processor", None):
+            trigger_decision = self.keyword_trigger_processor.evaluate(ctx)
+            ctx.reasoning_requested = trigger_decision.reasoning_requested
+            setattr(ctx, 'keyword_trigger_decision', trigger_decision)
+        else:
+            ctx.reasoning_requested = bool(getattr(ctx, 'reasoning_requested', False))
+
+        if getattr(self, "message_forwarder", None):
+            try:
+                self.message_forwarder.forward_if_needed(ctx)
+            except Exception as forward_error:
+                self.LOG.error(f"消息转发失败: {forward_error}", exc_info=True)
+
+        if ctx.is_group and not group_enabled:
+            persona_allowed = False
+        else:
+            persona_allowed = True
+
+        if persona_allowed and handle_persona_command(self, ctx):
+            return None
+
+        if trigger_decision and trigger_decision.summary_requested:
+            if self.keyword_trigger_processor.handle_summary(ctx):
+                return None
+
+        if ctx.reasoning_requested:
+            self.LOG.info("检测到推理模式触发词，直接进入推理模式。")
+            return ctx
+
+        # 5. 特殊消息处理（非 AI 决策）
+        if msg.type == 37:  # 好友请求
+            if getattr(self.config, "AUTO_ACCEPT_FRIEND_REQUEST", False):
+                self.LOG.info("检测到好友请求，自动通过。")
+                self.autoAcceptFriendRequest(msg)
             else:
-                ctx.reasoning_requested = bool(getattr(ctx, 'reasoning_requested', False))
+                self.LOG.info("检测到好友请求，保持待处理。")
+            return None
 
-            if getattr(self, "message_forwarder", None):
-                try:
-                    self.message_forwarder.forward_if_needed(ctx)
-                except Exception as forward_error:
-                    self.LOG.error(f"消息转发失败: {forward_error}", exc_info=True)
+        if msg.type == 10000:  # 系统消息
+            if (
+                "加入了群聊" in msg.content
+                and msg.from_group()
+                and group_enabled
+            ):
+                new_member_match = re.search(r'"(.+?)"邀请"(.+?)"加入了群聊', msg.content)
+                if new_member_match:
+                    inviter = new_member_match.group(1)
+                    new_member = new_member_match.group(2)
+                    welcome_msg = self.config.WELCOME_MSG.format(new_member=new_member, inviter=inviter)
+                    self.sendTextMsg(welcome_msg, msg.roomid)
+            return None
 
-            if ctx.is_group and not group_enabled:
-                persona_allowed = False
+        if msg.type == 10000 and "你已添加了" in msg.content:
+            self.sayHiToNewFriend(msg)
+            return None
+
+        # 6. Agent 响应：LLM 自主决定调什么工具
+        # 6.1 群聊：@机器人 或 随机插嘴
+        if msg.from_group() and group_enabled:
+            if msg.is_at(self.wxid):
+                return ctx
             else:
-                persona_allowed = True
+                can_auto_reply = (
+                    not msg.from_self()
+                    and ctx.text
+                    and (msg.type == 1 or (msg.type == 49 and ctx.text))
+                )
+                if can_auto_reply:
+                    rate = self._prepare_group_random_reply_current_rate(msg.roomid, policy)
+                    if rate > 0:
+                        rand_val = random.random()
+                        if rand_val < rate:
+                            self.LOG.info(
+                                f"触发群聊主动闲聊: 群={msg.roomid}, 概率={rate:.2f}, 随机值={rand_val:.2f}"
+                            )
+                            setattr(ctx, 'auto_random_reply', True)
+                            return ctx
+
+        # 6.2 私聊
+        elif not msg.from_group() and not msg.from_self():
+            if msg.type == 1 or (msg.type == 49 and ctx.text):
+                return ctx
+
+        return None
 
-            if persona_allowed and handle_persona_command(self, ctx):
-                return
+    def _after_chitchat(self, ctx: MessageContext) -> None:
+        """Agent 回复结束后的收尾：主动插话后清零该群的随机闲聊概率"""
+        if getattr(ctx, 'auto_random_reply', False) and ctx.is_group:
+            self._apply_group_random_reply_decay(ctx.msg.roomid)
 
-            if trigger_decision and trigger_decision.summary_requested:
-                if self.keyword_trigger_processor.handle_summary(ctx):
-                    return
+    def dispatchMsg(self, msg: WxMsg) -> None:
+        """将消息交给分发器，按会话（群ID或私聊对象）排队处理"""
+        conversation_id = msg.roomid if msg.from_group() else msg.sender
+        self.message_dispatcher.submit(conversation_id, msg)
 
-            if ctx.reasoning_requested:
-                self.LOG.info("检测到推理模式触发词，直接进入推理模式。")
-                self._handle_chitchat(ctx, None)
-                return
-
-            # 5. 特殊消息处理（非 AI 决策）
-            if msg.type == 37:  # 好友请求
-                if getattr(self.config, "AUTO_ACCEPT_FRIEND_REQUEST", False):
-                    self.LOG.info("检测到好友请求，自动通过。")
-                    self.autoAcceptFriendRequest(msg)
-                else:
-                    self.LOG.info("检测到好友请求，保持待处理。")
-                return
-
-            if msg.type == 10000:  # 系统消息
-                if (
-                    "加入了群聊" in msg.content
-                    and msg.from_group()
-                    and msg.roomid in getattr(self.config, "GROUPS", [])
-                ):
-                    new_member_match = re.search(r'"(.+?)"邀请"(.+?)"加入了群聊', msg.content)
-                    if new_member_match:
-                        inviter = new_member_match.group(1)
-                        new_member = new_member_match.group(2)
-                        welcome_msg = self.config.WELCOME_MSG.format(new_member=new_member, inviter=inviter)
-                        self.sendTextMsg(welcome_msg, msg.roomid)
-                return
-
-            if msg.type == 10000 and "你已添加了" in msg.content:
-                self.sayHiToNewFriend(msg)
-                return
-
-            # 6. Agent 响应：LLM 自主决定调什么工具
-            # 6.1 群聊：@机器人 或 随机插嘴
-            if msg.from_group() and msg.roomid in self.config.GROUPS:
-                if msg.is_at(self.wxid):
-                    self._handle_chitchat(ctx, None)
-                else:
-                    can_auto_reply = (
-                        not msg.from_self()
-                        and ctx.text
-                        and (msg.type == 1 or (msg.type == 49 and ctx.text))
-                    )
-                    if can_auto_reply:
-                        rate = self._prepare_group_random_reply_current_rate(msg.roomid)
-                        if rate > 0:
-                            rand_val = random.random()
-                            if rand_val < rate:
-                                self.LOG.info(
-                                    f"触发群聊主动闲聊: 群={msg.roomid}, 概率={rate:.2f}, 随机值={rand_val:.2f}"
-                                )
-                                setattr(ctx, 'auto_random_reply', True)
-                                self._handle_chitchat(ctx, None)
-                                self._apply_group_random_reply_decay(msg.roomid)
-
-            # 6.2 私聊
-            elif not msg.from_group() and not msg.from_self():
-                if msg.type == 1 or (msg.type == 49 and ctx.text):
-                    self._handle_chitchat(ctx, None)
-                    
-        except Exception as e:
-            self.LOG.error(f"处理消息时发生错误: {str(e)}", exc_info=True)
+    def _log_model_usage(self) -> None:
+        seen = set()
+        for model in list(self.chat_models.values()) + list(self.reasoning_chat_models.values()):
+            if id(model) in seen or not hasattr(model, "log_usage_stats"):
+                continue
+            seen.add(id(model))
+            model.log_usage_stats()
+
+    def _record_dropped_message(self, msg: WxMsg) -> None:
+        """会话积压过多被丢弃的消息不再回复，但仍写入历史以保留上下文"""
+        if self.message_summary:
+            self.message_summary.process_message_from_wxmsg(msg, self.wcf, self.allContacts, self.wxid)
 
     def enableRecvMsg(self) -> None:
+        self.message_dispatcher.start()
         self.wcf.enable_recv_msg(self.onMsg)
 
     def enableReceivingMsg(self) -> None:
@@ -428,36 +558,51 @@ class Robot(Job):
                 try:
                     msg = wcf.get_msg()
                     self.LOG.info(msg)
-                    self.processMsg(msg)
+                    self.dispatchMsg(msg)
                 except Empty:
                     continue  # Empty message
                 except Exception as e:
                     self.LOG.error(f"Receiving message error: {e}")
 
+        self.message_dispatcher.start()
         self.wcf.enable_receiving_msg()
         Thread(target=innerProcessMsg, name="GetMessage", args=(self.wcf,), daemon=True).start()
 
-    def sendTextMsg(self, msg: str, receiver: str, at_list: str = "", record_message: bool = True) -> None:
-        """ 发送消息并记录
+    def sendTextMsg(self, msg: str, receiver: str, at_list: str = "", record_message: bool = True,
+                    priority: int = PRIORITY_REPLY) -> None:
+        """ 记录并发送消息（放入发送队列，立即返回）
         :param msg: 消息字符串
         :param receiver: 接收人wxid或者群id
         :param at_list: 要@的wxid, @所有人的wxid为：notify@all
         :param record_message: 是否将本条消息写入消息历史
+        :param priority: 发送优先级，状态提示使用 PRIORITY_STATUS，让位于正式回复
         """
-        # 延迟和频率限制 (逻辑不变)
-        time.sleep(float(str(time.time()).split('.')[-1][-2:]) / 100.0 + 0.3)
-        now = time.time()
-        if self.config.SEND_RATE_LIMIT > 0:
-            self._msg_timestamps = [t for t in self._msg_timestamps if now - t < 60]
-            if len(self._msg_timestamps) >= self.config.SEND_RATE_LIMIT:
-                self.LOG.warning(f"发送消息过快，已达到每分钟{self.config.SEND_RATE_LIMIT}条上限。")
-                return
-            self._msg_timestamps.append(now)
-
         # 去除 Markdown 粗体标记，避免微信端出现多余符号
         msg = msg.replace("**", "")
+        # 入队时就写入消息历史：发送可能因限流延后数十秒，其间到达的下一条消息应能在上下文中看到这条回复
+        if getattr(self, "message_summary", None):
+            if record_message:  # 仅在需要时记录消息
+                # 确定机器人的名字
+                robot_name = self.allContacts.get(self.wxid, "机器人")
+                # 使用 self.wxid 作为 sender_wxid
+                # 注意：这里不生成时间戳，让 record_message 内部生成
+                self.message_summary.record_message(
+                    chat_id=receiver,
+                    sender_name=robot_name,
+                    sender_wxid=self.wxid, # 传入机器人自己的 wxid
+                    content=msg
+                )
+                self.LOG.debug(f"已记录机器人发送的消息到 {receiver}")
+        else:
+            self.LOG.warning("MessageSummary 未初始化，无法记录发送的消息")
+        self.send_queue.submit(receiver, msg, at_list, priority=priority)
+
+    def _deliver_text(self, message: OutboundMessage) -> None:
+        """在发送线程中实际发送一条消息"""
+        msg = message.content
+        receiver = message.receiver
+        at_list = message.at_list
         ats = ""
-        message_to_send = msg # 保存清理后的消息用于记录
         if at_list:
             if at_list == "notify@all":
                 ats = " @所有人"
@@ -466,34 +611,18 @@ class Robot(Job):
                 for wxid_at in wxids: # Renamed variable
                     ats += f" @{self.wcf.get_alias_in_chatroom(wxid_at, receiver)}"
 
-        try:
-            # 发送消息 (逻辑不变)
-            if ats == "":
-                self.LOG.info(f"To {receiver}: {msg}")
-                self.wcf.send_text(f"{msg}", receiver, at_list)
-            else:
-                full_msg_content = f"{ats}\n\n{msg}"
-                self.LOG.info(f"To {receiver}:\n{ats}\n{msg}")
-                self.wcf.send_text(full_msg_content, receiver, at_list)
-
-            if self.message_summary:
-                if record_message:  # 仅在需要时记录消息
-                    # 确定机器人的名字
-                    robot_name = self.allContacts.get(self.wxid, "机器人")
-                    # 使用 self.wxid 作为 sender_wxid
-                    # 注意：这里不生成时间戳，让 record_message 内部生成
-                    self.message_summary.record_message(
-                        chat_id=receiver,
-                        sender_name=robot_name,
-                        sender_wxid=self.wxid, # 传入机器人自己的 wxid
-                        content=message_to_send
-                    )
-                    self.LOG.debug(f"已记录机器人发送的消息到 {receiver}")
-            else:
-                self.LOG.warning("MessageSummary 未初始化，无法记录发送的消息")
+        if ats == "":
+            self.LOG.info(f"To {receiver}: {msg}")
+            self.wcf.send_text(f"{msg}", receiver, at_list)
+        else:
+            full_msg_content = f"{ats}\n\n{msg}"
+            self.LOG.info(f"To {receiver}:\n{ats}\n{msg}")
+            self.wcf.send_text(full_msg_content, receiver, at_list)
 
-        except Exception as e:
-            self.LOG.error(f"发送消息失败: {e}")
+    def send_quota_remaining(self, receiver: Optional[str] = None) -> Optional[int]:
+        """频率限制下还能立即发送给 receiver 的消息条数（取全局与该会话限额的较小值，已扣除排队中的消息），
+        未设置任何频率限制时返回 None"""
+        return self.send_queue.quota_remaining(receiver)
 
     def getAllContacts(self) -> dict:
         """
@@ -579,6 +708,16 @@ class Robot(Job):
         """清理所有资源，在程序退出前调用"""
         self.LOG.info("开始清理机器人资源...")
         
+        # 停止消息分发器，等待已排队的消息处理完毕
+        if getattr(self, 'message_dispatcher', None):
+            self.LOG.info("正在停止消息分发器...")
+            self.message_dispatcher.stop()
+
+        # 发出队列中剩余的消息
+        if getattr(self, 'send_queue', None):
+            self.LOG.info("正在停止发送队列...")
+            self.send_queue.stop()
+
         # 清理Perplexity线程
         self.cleanup_perplexity_threads()
         
@@ -586,6 +725,10 @@ class Robot(Job):
         if hasattr(self, 'message_summary') and self.message_summary:
             self.LOG.info("正在关闭消息历史数据库...")
             self.message_summary.close_db()
+        if getattr(self, 'reminder_manager', None):
+            self.reminder_manager.close()
+        if getattr(self, 'search_cache', None):
+            self.search_cache.close()
         if hasattr(self, 'persona_manager') and self.persona_manager:
             self.LOG.info("正在关闭人设数据库连接...")
             try:
@@ -620,12 +763,13 @@ class Robot(Job):
             
         return None
     
-    def _get_reasoning_chat_model(self):
-        """获取当前聊天模型对应的推理模型实例"""
-        model_id = getattr(self, 'current_model_id', None)
-        if model_id is None:
+    def _get_reasoning_chat_model(self, ctx):
+        """获取本条消息所选模型对应的推理模型实例"""
+        if ctx.reasoning_chat is not None:
+            return ctx.reasoning_chat
+        if ctx.chat_model_id is None:
             return None
-        return self.reasoning_chat_models.get(model_id)
+        return self.reasoning_chat_models.get(ctx.chat_model_id)
 
     def _get_fallback_model_ids(self) -> list:
         """从配置中读取全局 fallback 模型 ID 列表。"""
@@ -638,6 +782,46 @@ class Robot(Job):
 
     def _handle_chitchat(self, ctx, match=None):
         """统一处理消息，支持推理模式切换和模型 Fallback。"""
+        reasoning_requested, original_chat, candidate_ids = self._begin_chitchat(ctx)
+
+        handled = False
+        for i, model_id in enumerate(candidate_ids):
+            if i > 0:
+                self._switch_to_fallback(ctx, model_id, reasoning_requested)
+
+            try:
+                handled = handle_chitchat(ctx, match)
+                if handled:
+                    break
+            except Exception as e:
+                self.LOG.warning(f"模型 {model_id} 调用失败: {e}")
+                continue
+
+        self._end_chitchat(ctx, handled, reasoning_requested, original_chat)
+        return handled
+
+    async def _handle_chitchat_async(self, ctx, match=None):
+        """_handle_chitchat 的异步版本，发送提示消息等阻塞调用经线程池执行。"""
+        reasoning_requested, original_chat, candidate_ids = await asyncio.to_thread(self._begin_chitchat, ctx)
+
+        handled = False
+        for i, model_id in enumerate(candidate_ids):
+            if i > 0:
+                self._switch_to_fallback(ctx, model_id, reasoning_requested)
+
+            try:
+                handled = await handle_chitchat_async(ctx, match)
+                if handled:
+                    break
+            except Exception as e:
+                self.LOG.warning(f"模型 {model_id} 调用失败: {e}")
+                continue
+
+        await asyncio.to_thread(self._end_chitchat, ctx, handled, reasoning_requested, original_chat)
+        return handled
+
+    def _begin_chitchat(self, ctx) -> Tuple[bool, object, list]:
+        """切换推理模型并构建候选模型列表（当前模型 + fallback）"""
         force_reasoning = bool(getattr(ctx, 'force_reasoning', False))
         reasoning_requested = bool(getattr(ctx, 'reasoning_requested', False)) or force_reasoning
         original_chat = getattr(ctx, 'chat', None)
@@ -647,15 +831,15 @@ class Robot(Job):
                 self.LOG.info("群配置了 force_reasoning，将使用推理模型。")
             else:
                 self.LOG.info("检测到推理模式请求，将启用深度思考。")
-                ctx.send_text("正在深度思考，请稍候...", record_message=False)
-            reasoning_chat = self._get_reasoning_chat_model()
+                ctx.send_text("正在深度思考，请稍候...", record_message=False, priority=PRIORITY_STATUS)
+            reasoning_chat = self._get_reasoning_chat_model(ctx)
             if reasoning_chat:
                 ctx.chat = reasoning_chat
             else:
                 self.LOG.warning("当前模型未配置推理模型，使用默认模型")
 
         # 构建候选模型列表：当前模型 + fallback
-        primary_id = getattr(self, 'current_model_id', None)
+        primary_id = ctx.chat_model_id
         fallback_ids = self._get_fallback_model_ids()
         candidate_ids = []
         if primary_id is not None:
@@ -664,27 +848,20 @@ class Robot(Job):
             if fid not in candidate_ids and fid in self.chat_models:
                 candidate_ids.append(fid)
 
-        handled = False
-        for i, model_id in enumerate(candidate_ids):
-            if i > 0:
-                # 切换到 fallback 模型
-                fallback_model = self.chat_models[model_id]
-                if reasoning_requested:
-                    fallback_reasoning = self.reasoning_chat_models.get(model_id)
-                    ctx.chat = fallback_reasoning or fallback_model
-                else:
-                    ctx.chat = fallback_model
-                model_name = getattr(ctx.chat, '__class__', type(ctx.chat)).__name__
-                self.LOG.info(f"Fallback: 切换到模型 {model_name}(ID:{model_id})")
+        return reasoning_requested, original_chat, candidate_ids
 
-            try:
-                handled = handle_chitchat(ctx, match)
-                if handled:
-                    break
-            except Exception as e:
-                self.LOG.warning(f"模型 {model_id} 调用失败: {e}")
-                continue
+    def _switch_to_fallback(self, ctx, model_id: int, reasoning_requested: bool) -> None:
+        """切换到 fallback 模型"""
+        fallback_model = self.chat_models[model_id]
+        if reasoning_requested:
+            fallback_reasoning = self.reasoning_chat_models.get(model_id)
+            ctx.chat = fallback_reasoning or fallback_model
+        else:
+            ctx.chat = fallback_model
+        model_name = getattr(ctx.chat, '__class__', type(ctx.chat)).__name__
+        self.LOG.info(f"Fallback: 切换到模型 {model_name}(ID:{model_id})")
 
+    def _end_chitchat(self, ctx, handled: bool, reasoning_requested: bool, original_chat) -> None:
         # 恢复原始模型
         if original_chat is not None:
             ctx.chat = original_chat
@@ -695,11 +872,10 @@ class Robot(Job):
             else:
                 ctx.send_text("抱歉，服务暂时不可用，请稍后再试。")
 
-        return handled
-
-    def _describe_chat_model(self, chat_model, reasoning: bool = False) -> str:
-        """根据配置返回模型名称，默认回退到实例类名"""
-        model_id = getattr(self, 'current_model_id', None)
+    def _describe_chat_model(self, ctx, reasoning: bool = False) -> str:
+        """根据本条消息所选模型的配置返回模型名称，默认回退到实例类名"""
+        chat_model = ctx.chat
+        model_id = ctx.chat_model_id
         config_entry = self._get_model_config(model_id) if model_id is not None else None
 
         if config_entry:
@@ -724,14 +900,13 @@ class Robot(Job):
         }
         return mapping.get(model_id)
 
-    def _get_group_random_reply_base_rate(self, room_id: str) -> float:
-        mapping = getattr(self, 'group_random_reply_mapping', {})
-        if room_id and isinstance(mapping, dict) and room_id in mapping:
-            return mapping[room_id]
-        return getattr(self, 'group_random_reply_default', 0.0)
+    def _get_group_random_reply_base_rate(self, room_id: str, policy: Optional[ChatPolicy] = None) -> float:
+        if policy is None:
+            policy = self._get_chat_policy(room_id, True)
+        return policy.random_chitchat_probability
 
-    def _prepare_group_random_reply_current_rate(self, room_id: str) -> float:
-        base_rate = self._get_group_random_reply_base_rate(room_id)
+    def _prepare_group_random_reply_current_rate(self, room_id: str, policy: Optional[ChatPolicy] = None) -> float:
+        base_rate = self._get_group_random_reply_base_rate(room_id, policy)
         if base_rate <= 0:
             return 0.0
 
@@ -745,8 +920,8 @@ class Robot(Job):
         self.group_random_reply_state[room_id] = current
         return current
 
-    def _apply_group_random_reply_decay(self, room_id: str) -> None:
-        base_rate = self._get_group_random_reply_base_rate(room_id)
+    def _apply_group_random_reply_decay(self, room_id: str, policy: Optional[ChatPolicy] = None) -> None:
+        base_rate = self._get_group_random_reply_base_rate(room_id, policy)
         if base_rate <= 0:
             return
 
@@ -759,114 +934,51 @@ class Robot(Job):
             f"群聊随机闲聊概率已清零: 群={room_id}"
         )
 
-    def _select_model_for_message(self, msg: WxMsg) -> None:
-        """根据消息来源选择对应的AI模型
+    def _select_model_for_message(self, msg: WxMsg, policy: Optional[ChatPolicy] = None) -> Optional[int]:
+        """根据消息来源选择对应的AI模型，不修改 Robot 的共享状态
         :param msg: 接收到的消息
+        :param policy: 预先查好的会话策略，未提供时按消息来源查找
+        :return: 模型ID，没有可用模型时为 None
         """
-        # 重置 force_reasoning 标记
-        self._current_force_reasoning = False
+        if not getattr(self, 'chat_models', None):
+            return None  # 没有可用模型
 
-        if not hasattr(self, 'chat_models') or not self.chat_models:
-            return  # 没有可用模型，无需切换
+        default_id = self.default_model_id if self.default_model_id in self.chat_models else None
+        if policy is None:
+            policy = self._get_chat_policy(msg.roomid if msg.from_group() else msg.sender, msg.from_group())
+        if not policy.mapped:
+            return default_id
 
-        # 获取消息来源ID
-        source_id = msg.roomid if msg.from_group() else msg.sender
+        if policy.model_id in self.chat_models:
+            return policy.model_id
 
-        # 检查配置
-        if not hasattr(self.config, 'GROUP_MODELS'):
-            # 没有配置，使用默认模型
-            if self.default_model_id in self.chat_models:
-                self.chat = self.chat_models[self.default_model_id]
-                self.current_model_id = self.default_model_id
-            return
+        source_label = "群" if policy.is_group else "私聊用户"
+        self.LOG.warning(f"{source_label} {policy.chat_id} 配置的模型ID {policy.model_id} 不可用，使用默认模型")
+        return default_id
 
-        # 群聊消息处理
-        if msg.from_group():
-            model_mappings = self.config.GROUP_MODELS.get('mapping', [])
-            for mapping in model_mappings:
-                if mapping.get('room_id') == source_id:
-                    model_id = mapping.get('model')
-                    # 读取 force_reasoning 配置
-                    self._current_force_reasoning = bool(mapping.get('force_reasoning', False))
-                    if model_id in self.chat_models:
-                        # 切换到指定模型
-                        if self.chat != self.chat_models[model_id]:
-                            self.chat = self.chat_models[model_id]
-                            self.LOG.info(f"已为群 {source_id} 切换到模型: {self.chat.__class__.__name__}")
-                        self.current_model_id = model_id
-                    else:
-                        self.LOG.warning(f"群 {source_id} 配置的模型ID {model_id} 不可用，使用默认模型")
-                        if self.default_model_id in self.chat_models:
-                            self.chat = self.chat_models[self.default_model_id]
-                            self.current_model_id = self.default_model_id
-                    return
-        # 私聊消息处理
-        else:
-            private_mappings = self.config.GROUP_MODELS.get('private_mapping', [])
-            for mapping in private_mappings:
-                if mapping.get('wxid') == source_id:
-                    model_id = mapping.get('model')
-                    if model_id in self.chat_models:
-                        # 切换到指定模型
-                        if self.chat != self.chat_models[model_id]:
-                            self.chat = self.chat_models[model_id]
-                            self.LOG.info(f"已为私聊用户 {source_id} 切换到模型: {self.chat.__class__.__name__}")
-                        self.current_model_id = model_id
-                    else:
-                        self.LOG.warning(f"私聊用户 {source_id} 配置的模型ID {model_id} 不可用，使用默认模型")
-                        if self.default_model_id in self.chat_models:
-                            self.chat = self.chat_models[self.default_model_id]
-                            self.current_model_id = self.default_model_id
-                    return
-        
-        # 如果没有找到对应配置，使用默认模型
-        if self.default_model_id in self.chat_models:
-            self.chat = self.chat_models[self.default_model_id]
-            self.current_model_id = self.default_model_id
-            
-    def _get_specific_history_limit(self, msg: WxMsg) -> int:
+    def _get_specific_history_limit(self, msg: WxMsg, chat_model=None, policy: Optional[ChatPolicy] = None) -> int:
         """根据消息来源和配置，获取特定的历史消息数量限制
         
         :param msg: 微信消息对象
+        :param chat_model: 本条消息选定的模型实例，用于读取默认值
+        :param policy: 预先查好的会话策略，未提供时按消息来源查找
         :return: 历史消息数量限制，如果没有特定配置则返回None
         """
-        if not hasattr(self.config, 'GROUP_MODELS'):
-            # 没有配置，使用当前模型默认值
-            return getattr(self.chat, 'max_history_messages', None)
-            
-        # 获取消息来源ID
-        source_id = msg.roomid if msg.from_group() else msg.sender
-        
-        # 确定查找的映射和字段名
-        if msg.from_group():
-            mappings = self.config.GROUP_MODELS.get('mapping', [])
-            key_field = 'room_id'
-        else:
-            mappings = self.config.GROUP_MODELS.get('private_mapping', [])
-            key_field = 'wxid'
-            
-        # 在映射中查找特定配置
-        for mapping in mappings:
-            if mapping.get(key_field) == source_id:
-                # 找到了对应的配置
-                if 'max_history' in mapping:
-                    specific_limit = mapping['max_history']
-                    self.LOG.debug(f"为 {source_id} 找到特定历史限制: {specific_limit}")
-                    return specific_limit
-                else:
-                    # 找到了配置但没有max_history，使用模型默认值
-                    self.LOG.debug(f"为 {source_id} 找到映射但无特定历史限制，使用模型默认值")
-                    break
-                    
+        if chat_model is None:
+            chat_model = self.chat
+        if policy is None:
+            policy = self._get_chat_policy(msg.roomid if msg.from_group() else msg.sender, msg.from_group())
+
+        if policy.max_history is not None:
+            return policy.max_history
+
         # 没有找到特定限制，使用当前模型的默认值
-        default_limit = getattr(self.chat, 'max_history_messages', None)
-        self.LOG.debug(f"未找到 {source_id} 的特定历史限制，使用模型默认值: {default_limit}")
-        return default_limit
+        return getattr(chat_model, 'max_history_messages', None)
 
     def onMsg(self, msg: WxMsg) -> int:
         try:
             self.LOG.info(msg)
-            self.processMsg(msg)
+            self.dispatchMsg(msg)
         except Exception as e:
             self.LOG.error(e)
 
@@ -1,17 +1,38 @@
 """
 工具系统 —— 让 LLM 在 Agent 循环中自主调用工具。
 
-每个 Tool 提供 OpenAI function-calling 格式的 schema 和一个同步执行函数。
+每个 Tool 提供 OpenAI function-calling 格式的 schema 和一个同步执行函数，
+可选提供异步执行函数供 asyncio 运行时使用。
 ToolRegistry 汇总所有工具，生成 tools 列表和统一的 tool_handler。
+
+工具模块按需导入：TOOL_MODULES 登记了工具名与定义它的模块，首次用到某个工具
+（或首次需要完整的 tools 列表）时才导入对应模块，模块导入时向 tool_registry 注册。
+新增工具时在这里登记一行，并在模块末尾调用 tool_registry.register()。
 """
 
+import asyncio
+import importlib
 import json
 import logging
+import threading
 from dataclasses import dataclass, field
-from typing import Any, Callable, Dict, List, Optional
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from commands.send_queue import PRIORITY_STATUS
+from function.func_cancel import ToolCancelled
+from tools.cache import tool_cache
 
 logger = logging.getLogger(__name__)
 
+# 工具名 -> 定义该工具的模块；顺序即 tools 列表中的顺序，保持稳定以利于服务端前缀缓存
+TOOL_MODULES: Dict[str, str] = {
+    "web_search": "tools.web_search",
+    "reminder_create": "tools.reminder",
+    "reminder_list": "tools.reminder",
+    "reminder_delete": "tools.reminder",
+    "lookup_chat_history": "tools.history",
+}
+
 
 @dataclass
 class Tool:
@@ -20,7 +41,9 @@ class Tool:
     description: str
     parameters: dict                          # JSON Schema
     handler: Callable[..., str] = None        # (ctx, **kwargs) -> str
+    async_handler: Optional[Callable[..., Awaitable[str]]] = None  # async (ctx, **kwargs) -> str
     status_text: str = ""                     # 执行前发给用户的状态提示，空则不发
+    status_args: Tuple[str, ...] = ()         # 取第一个非空参数附在状态提示后
 
     def to_openai_schema(self) -> dict:
         return {
@@ -36,70 +59,190 @@ class Tool:
 class ToolRegistry:
     """收集工具，为 Agent 循环提供 tools + tool_handler。"""
 
-    def __init__(self):
+    def __init__(self, modules: Optional[Dict[str, str]] = None):
         self._tools: Dict[str, Tool] = {}
+        self._modules: Dict[str, str] = dict(modules or {})
+        self._order: List[str] = list(self._modules)
+        self._lock = threading.RLock()
+        self._loaded_modules = set()
+        self._schemas: Optional[List[dict]] = None
+        self._subsets: Dict[Tuple[str, ...], List[dict]] = {}
 
     def register(self, tool: Tool) -> None:
-        self._tools[tool.name] = tool
+        with self._lock:
+            self._tools[tool.name] = tool
+            if tool.name not in self._order:
+                self._order.append(tool.name)
+            self._schemas = None
+            self._subsets = {}
         logger.info(f"注册工具: {tool.name}")
 
     def get(self, name: str) -> Optional[Tool]:
-        return self._tools.get(name)
+        tool = self._tools.get(name)
+        if tool is None and name in self._modules:
+            self._load_module(self._modules[name])
+            tool = self._tools.get(name)
+        return tool
 
     @property
     def tools(self) -> Dict[str, Tool]:
+        self.load_all()
         return dict(self._tools)
 
+    def load_all(self) -> None:
+        """导入所有登记过的工具模块"""
+        for module_name in dict.fromkeys(self._modules.values()):
+            self._load_module(module_name)
+
     def get_openai_tools(self) -> List[dict]:
-        """返回所有工具的 OpenAI function-calling schema 列表。"""
-        return [t.to_openai_schema() for t in self._tools.values()]
+        """返回所有工具的 OpenAI function-calling schema 列表。
+
+        列表在首次调用时构建并缓存，注册新工具后重建；返回的是共享对象，调用方不要修改。
+        """
+        schemas = self._schemas
+        if schemas is None:
+            self.load_all()
+            with self._lock:
+                if self._schemas is None:
+                    self._schemas = [
+                        self._tools[name].to_openai_schema() for name in self._order if name in self._tools
+                    ]
+                schemas = self._schemas
+        return schemas
+
+    def get_tool_names(self) -> List[str]:
+        """按 tools 列表中的顺序返回所有工具名"""
+        return [schema["function"]["name"] for schema in self.get_openai_tools()]
+
+    def get_openai_tools_for(self, names: Iterable[str]) -> List[dict]:
+        """返回指定工具的 schema 列表，顺序与完整列表一致；同一组工具复用同一个缓存列表"""
+        wanted = set(names)
+        schemas = self.get_openai_tools()
+        key = tuple(schema["function"]["name"] for schema in schemas if schema["function"]["name"] in wanted)
+        if len(key) == len(schemas):
+            return schemas
+        subset = self._subsets.get(key)
+        if subset is None:
+            subset = [schema for schema in schemas if schema["function"]["name"] in wanted]
+            with self._lock:
+                if self._schemas is schemas:
+                    self._subsets[key] = subset
+        return subset
+
+    def _load_module(self, module_name: str) -> None:
+        if module_name in self._loaded_modules:
+            return
+        with self._lock:
+            if module_name in self._loaded_modules:
+                return
+            try:
+                importlib.import_module(module_name)
+            except Exception as e:
+                logger.error(f"加载工具模块 {module_name} 失败: {e}", exc_info=True)
+            # 失败也不再重试，避免每条消息都重复导入
+            self._loaded_modules.add(module_name)
 
-    def create_handler(self, ctx: Any) -> Callable[[str, dict], str]:
+    def create_handler(self, ctx: Any, allowed: Optional[Iterable[str]] = None) -> Callable[[str, dict], str]:
         """创建一个绑定了消息上下文的 tool_handler 函数。
 
         执行工具前，如果该工具配置了 status_text，会先给用户发一条状态提示，
         让用户知道"机器人在干什么"（类似 OpenClaw/OpenCode 的中间过程输出）。
+        幂等工具的结果经 tool_cache 缓存，命中时直接返回，不发送状态提示。
+        allowed 不为 None 时只执行其中的工具（即本次提供给模型的工具）。
+        工具抛出的 ToolCancelled 不转换为错误结果，由 Agent 循环按超时处理。
         """
-        registry = self._tools
-
-        def _send_status(tool: 'Tool', arguments: dict) -> None:
-            """发送工具执行状态消息给用户。"""
-            if not tool.status_text:
-                return
-            try:
-                # 对搜索类工具，把查询关键词带上
-                status = tool.status_text
-                if tool.name == "web_search" and arguments.get("query"):
-                    status = f"{status}{arguments['query']}"
-                elif tool.name == "lookup_chat_history" and arguments.get("keywords"):
-                    kw_str = "、".join(str(k) for k in arguments["keywords"][:3])
-                    status = f"{status}{kw_str}"
-
-                ctx.send_text(status, record_message=False)
-            except Exception:
-                pass  # 状态提示失败不影响工具执行
+        allowed = None if allowed is None else frozenset(allowed)
 
         def handler(tool_name: str, arguments: dict) -> str:
-            tool = registry.get(tool_name)
+            tool = self.get(tool_name) if allowed is None or tool_name in allowed else None
             if not tool:
                 return json.dumps(
                     {"error": f"Unknown tool: {tool_name}"},
                     ensure_ascii=False,
                 )
 
-            _send_status(tool, arguments)
+            cache_key, cached = tool_cache.lookup(tool_name, ctx, arguments)
+            if cached is not None:
+                return cached
+
+            _send_status(ctx, tool, arguments)
 
             try:
                 result = tool.handler(ctx, **arguments)
                 if not isinstance(result, str):
                     result = json.dumps(result, ensure_ascii=False)
+                tool_cache.store(cache_key, result)
+                tool_cache.after_call(tool_name, ctx)
                 return result
+            except ToolCancelled:
+                raise  # 交给调用方按超时处理
             except Exception as e:
                 logger.error(f"工具 {tool_name} 执行失败: {e}", exc_info=True)
                 return json.dumps({"error": str(e)}, ensure_ascii=False)
 
         return handler
 
+    def create_async_handler(self, ctx: Any, allowed: Optional[Iterable[str]] = None) -> Callable[[str, dict], Awaitable[str]]:
+        """create_handler 的异步版本。
+
+        工具提供 async_handler 时直接在事件循环上等待，否则把同步 handler
+        放到线程池中执行；状态提示同样经线程池发送，避免阻塞事件循环。
+        """
+        allowed = None if allowed is None else frozenset(allowed)
+
+        async def handler(tool_name: str, arguments: dict) -> str:
+            tool = self.get(tool_name) if allowed is None or tool_name in allowed else None
+            if not tool:
+                return json.dumps(
+                    {"error": f"Unknown tool: {tool_name}"},
+                    ensure_ascii=False,
+                )
+
+            cache_key, cached = tool_cache.lookup(tool_name, ctx, arguments)
+            if cached is not None:
+                return cached
+
+            await asyncio.to_thread(_send_status, ctx, tool, arguments)
+
+            try:
+                if tool.async_handler:
+                    result = await tool.async_handler(ctx, **arguments)
+                else:
+                    result = await asyncio.to_thread(tool.handler, ctx, **arguments)
+                if not isinstance(result, str):
+                    result = json.dumps(result, ensure_ascii=False)
+                tool_cache.store(cache_key, result)
+                tool_cache.after_call(tool_name, ctx)
+                return result
+            except ToolCancelled:
+                raise  # 交给调用方按超时处理
+            except Exception as e:
+                logger.error(f"工具 {tool_name} 执行失败: {e}", exc_info=True)
+                return json.dumps({"error": str(e)}, ensure_ascii=False)
+
+        return handler
+
+
+def _send_status(ctx: Any, tool: Tool, arguments: dict) -> None:
+    """发送工具执行状态消息给用户。"""
+    if not tool.status_text:
+        return
+    try:
+        # 对搜索类工具，把查询关键词带上
+        status = tool.status_text
+        for arg_name in tool.status_args:
+            value = arguments.get(arg_name)
+            if not value:
+                continue
+            if isinstance(value, list):
+                value = "、".join(str(k) for k in value[:3])
+            status = f"{status}{value}"
+            break
+
+        ctx.send_text(status, record_message=False, priority=PRIORITY_STATUS)
+    except Exception:
+        pass  # 状态提示失败不影响工具执行
+
 
 # ── 全局工具注册表 ──────────────────────────────────────────
-tool_registry = ToolRegistry()
+tool_registry = ToolRegistry(TOOL_MODULES)
@@ -0,0 +1,208 @@
+"""
+工具结果缓存 —— 对幂等工具的调用结果做记忆化。
+
+同一轮 Agent 循环里模型经常重复调用相同参数的 lookup_chat_history / reminder_list，
+不同群也会在几分钟内搜索同一个问题。缓存键由 (工具名, 归一化参数, 作用域) 组成，
+作用域决定结果能在哪些调用之间共享：global 全局共享、chat 按会话、sender 按发送者。
+
+失效分两种：
+- 过期：每个工具单独配置 TTL；
+- 主动失效：invalidate(工具名, 作用域值) 使该作用域下的缓存全部作废，
+  例如 reminder_create/reminder_delete 执行后作废该用户的 reminder_list，
+  新消息写入历史后作废该会话的 lookup_chat_history。
+
+失效通过递增作用域版本号实现（版本号是缓存键的一部分），O(1) 完成，旧条目由 LRU 淘汰。
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 1024
+
+
+@dataclass
+class CachePolicy:
+    """单个工具的缓存策略。"""
+    ttl: float = 0.0                 # 结果有效秒数，0 表示不缓存
+    scope: str = "chat"              # global / chat / sender
+    invalidates: Tuple[str, ...] = ()  # 执行后需要作废的工具（同一作用域值）
+    context_attrs: Tuple[str, ...] = ()  # 影响结果的上下文属性，计入缓存键
+
+
+DEFAULT_POLICIES: Dict[str, CachePolicy] = {
+    "web_search": CachePolicy(ttl=600, scope="global"),
+    "lookup_chat_history": CachePolicy(ttl=300, scope="chat", context_attrs=("specific_max_history",)),
+    "reminder_list": CachePolicy(ttl=300, scope="sender"),
+    "reminder_create": CachePolicy(scope="sender", invalidates=("reminder_list",)),
+    "reminder_delete": CachePolicy(scope="sender", invalidates=("reminder_list",)),
+}
+
+
+def _is_empty(value: Any) -> bool:
+    """未填写的参数与显式传入的默认值（None/False/空字符串/空列表）视为相同"""
+    if value is None or value is False:
+        return True
+    return isinstance(value, (str, list, tuple, dict)) and not value
+
+
+def _normalize(value: Any) -> Any:
+    """参数归一化：字符串去首尾空白、合并连续空白并忽略大小写，丢弃空值"""
+    if isinstance(value, str):
+        return " ".join(value.split()).casefold()
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items() if not _is_empty(v)}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def _scope_value(scope: str, ctx: Any) -> Optional[str]:
+    if scope == "global":
+        return ""
+    if scope == "sender":
+        msg = getattr(ctx, "msg", None)
+        return getattr(msg, "sender", None)
+    if scope == "chat":
+        get_receiver = getattr(ctx, "get_receiver", None)
+        return get_receiver() if get_receiver else None
+    return None
+
+
+class ToolResultCache:
+    """按工具策略缓存调用结果，线程安全。"""
+
+    def __init__(self, policies: Optional[Dict[str, CachePolicy]] = None, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.enabled = True
+        self.max_entries = max_entries
+        # 逐项复制，configure 调整 TTL 时不会改到模块级的默认策略对象
+        source = DEFAULT_POLICIES if policies is None else policies
+        self.policies: Dict[str, CachePolicy] = {name: replace(policy) for name, policy in source.items()}
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, Tuple[float, str]]" = OrderedDict()  # key -> (过期时间, 结果)
+        self._versions: Dict[Tuple[str, str], int] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def configure(self, config: Optional[dict]) -> None:
+        """从配置更新开关、容量和各工具 TTL。
+
+        config 示例: {"enable": true, "max_entries": 1024, "ttl": {"web_search": 600}}
+        """
+        if not isinstance(config, dict):
+            return
+        self.enabled = bool(config.get("enable", True))
+        try:
+            self.max_entries = max(0, int(config.get("max_entries", self.max_entries)))
+        except (TypeError, ValueError):
+            pass
+        for tool_name, ttl in (config.get("ttl") or {}).items():
+            try:
+                ttl = max(0.0, float(ttl))
+            except (TypeError, ValueError):
+                continue
+            policy = self.policies.get(tool_name)
+            if policy is None:
+                self.policies[tool_name] = CachePolicy(ttl=ttl)
+            else:
+                self.policies[tool_name] = replace(policy, ttl=ttl)
+        self.clear()
+
+    def lookup(self, tool_name: str, ctx: Any, arguments: dict) -> Tuple[Optional[tuple], Optional[str]]:
+        """查找缓存结果。
+
+        Returns:
+            (key, result)：key 为 None 表示该工具不参与缓存；result 为 None 表示未命中，
+            执行工具后用同一个 key 调用 store。
+        """
+        policy = self.policies.get(tool_name)
+        if not self.enabled or policy is None or policy.ttl <= 0:
+            return None, None
+        scope_value = _scope_value(policy.scope, ctx)
+        if scope_value is None:
+            return None, None
+        try:
+            normalized = json.dumps(_normalize(arguments or {}), ensure_ascii=False, sort_keys=True)
+        except (TypeError, ValueError):
+            return None, None
+        extras = tuple(getattr(ctx, attr, None) for attr in policy.context_attrs)
+
+        now = time.monotonic()
+        with self._lock:
+            # 版本号在查找时确定：执行期间发生的失效会让随后 store 的结果落在旧版本下，不会被命中
+            version = self._versions.get((tool_name, scope_value), 0)
+            key = (tool_name, scope_value, version, normalized, extras)
+            stats = self._stats.setdefault(tool_name, {"hits": 0, "misses": 0})
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, result = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    stats["hits"] += 1
+                    return key, result
+                del self._entries[key]
+            stats["misses"] += 1
+        return key, None
+
+    def store(self, key: Optional[tuple], result: Any) -> None:
+        """保存工具结果；出错的结果不缓存"""
+        if key is None or not isinstance(result, str) or result.startswith('{"error"'):
+            return
+        policy = self.policies.get(key[0])
+        if policy is None or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + policy.ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def after_call(self, tool_name: str, ctx: Any) -> None:
+        """工具执行后，按策略作废受其影响的缓存（例如创建提醒后作废 reminder_list）"""
+        policy = self.policies.get(tool_name)
+        if policy is None or not policy.invalidates:
+            return
+        scope_value = _scope_value(policy.scope, ctx)
+        if scope_value is None:
+            return
+        for target in policy.invalidates:
+            self.invalidate(target, scope_value)
+
+    def invalidate(self, tool_name: str, scope_value: str = "") -> None:
+        """作废某个工具在指定作用域下的全部缓存结果"""
+        with self._lock:
+            key = (tool_name, scope_value)
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        """各工具的命中次数、未命中次数与命中率"""
+        with self._lock:
+            stats = {name: dict(values) for name, values in self._stats.items()}
+        for values in stats.values():
+            total = values["hits"] + values["misses"]
+            values["hit_rate"] = values["hits"] / total if total else 0.0
+        return stats
+
+    def log_stats(self) -> None:
+        stats = self.get_stats()
+        if not stats:
+            return
+        summary = ", ".join(
+            f"{name} {values['hits']}/{values['hits'] + values['misses']} ({values['hit_rate']:.1%})"
+            for name, values in sorted(stats.items())
+        )
+        logger.info(f"工具结果缓存命中率: {summary}，当前条目数: {len(self._entries)}")
+
+
+# ── 全局工具结果缓存 ────────────────────────────────────────
+tool_cache = ToolResultCache()
@@ -1,13 +1,15 @@
-"""聊天历史查询工具 —— 从 handlers.py 的内联定义中提取而来。
+"""聊天历史查询工具。
 
-支持三种查询模式：
+支持四种查询模式：
   keywords  — 关键词模糊搜索
+  semantic  — 按字符重叠模糊匹配（本地向量，只要共享部分字词即可命中，纯同义词不能命中）
   range     — 按倒序偏移取连续消息
   time      — 按时间窗口取消息
 """
 
 import json
 
+from function.func_cancel import check_cancelled
 from tools import Tool, tool_registry
 
 DEFAULT_VISIBLE_LIMIT = 30
@@ -16,7 +18,7 @@ DEFAULT_VISIBLE_LIMIT = 30
 def _handle_lookup_chat_history(ctx, mode: str = "", keywords: list = None,
                                 start_offset: int = None, end_offset: int = None,
                                 start_time: str = None, end_time: str = None,
-                                **_) -> str:
+                                query: str = None, **_) -> str:
     message_summary = getattr(ctx.robot, "message_summary", None) if ctx.robot else None
     if not message_summary:
         return json.dumps({"error": "消息历史功能不可用"}, ensure_ascii=False)
@@ -37,8 +39,43 @@ def _handle_lookup_chat_history(ctx, mode: str = "", keywords: list = None,
             mode = "time"
         elif start_offset is not None and end_offset is not None:
             mode = "range"
+        elif query and not keywords:
+            mode = "semantic"
         else:
             mode = "keywords"
+    check_cancelled()  # 已超时或整轮预算用完时不再查库
+
+    # ── semantic ────────────────────────────────────────────
+    if mode == "semantic":
+        query = str(query or "").strip()
+        if not query:
+            return json.dumps({"error": "semantic 模式需要 query", "results": []}, ensure_ascii=False)
+        if getattr(message_summary, "embedder", None) is None:
+            return json.dumps({"error": "语义检索未启用，请改用 keywords 模式", "results": []}, ensure_ascii=False)
+
+        search_results = message_summary.search_messages_semantic(
+            chat_id=chat_id,
+            query=query,
+            context_window=10,
+            max_groups=10,
+            exclude_recent=visible_limit,
+        )
+
+        segments = []
+        lines_seen = set()
+        for seg in search_results:
+            formatted = [l for l in seg.get("formatted_messages", []) if l not in lines_seen]
+            lines_seen.update(formatted)
+            if formatted:
+                segments.append({
+                    "relevance": seg.get("relevance"),
+                    "messages": formatted,
+                })
+
+        payload = {"segments": segments, "returned_groups": len(segments), "query": query}
+        if not segments:
+            payload["notice"] = "未找到语义相关的消息，可尝试 keywords 模式。"
+        return json.dumps(payload, ensure_ascii=False)
 
     # ── keywords ────────────────────────────────────────────
     if mode == "keywords":
@@ -68,6 +105,7 @@ def _handle_lookup_chat_history(ctx, mode: str = "", keywords: list = None,
             context_window=10,
             max_groups=20,
             exclude_recent=visible_limit,
+            ranked=True,
         )
 
         segments = []
@@ -78,6 +116,7 @@ def _handle_lookup_chat_history(ctx, mode: str = "", keywords: list = None,
             if formatted:
                 segments.append({
                     "matched_keywords": seg.get("matched_keywords", []),
+                    "relevance": seg.get("relevance"),
                     "messages": formatted,
                 })
 
@@ -143,14 +182,18 @@ def _handle_lookup_chat_history(ctx, mode: str = "", keywords: list = None,
 tool_registry.register(Tool(
     name="lookup_chat_history",
     status_text="正在翻阅聊天记录: ",
+    status_args=("keywords", "query"),
     description=(
         "查询聊天历史记录。你当前只能看到最近的消息，调用此工具可以回溯更早的上下文。"
-        "支持三种模式：\n"
-        "1. mode=\"keywords\" — 用关键词模糊搜索历史消息，返回匹配片段及上下文。"
+        "支持四种模式：\n"
+        "1. mode=\"keywords\" — 用关键词模糊搜索历史消息，返回匹配片段及上下文，片段按相关度从高到低排列。"
         "   需要 keywords 数组（2-4 个关键词）。\n"
-        "2. mode=\"range\" — 按倒序偏移获取连续消息块。"
+        "2. mode=\"semantic\" — 按字符重叠做模糊匹配，适合只记得原话中部分字词、不确定完整说法的情况，"
+        "   需要 query（一句话描述要找的内容）。只能找到与 query 有公共字词的消息，"
+        "   换成同义词的说法找不到，这时请改用 keywords 并尝试不同的关键词。\n"
+        "3. mode=\"range\" — 按倒序偏移获取连续消息块。"
         "   需要 start_offset 和 end_offset（均需大于当前可见消息数）。\n"
-        "3. mode=\"time\" — 按时间窗口获取消息。"
+        "4. mode=\"time\" — 按时间窗口获取消息。"
         "   需要 start_time 和 end_time（格式如 2025-05-01 08:00）。\n"
         "可多次调用，例如先用 keywords 找到锚点，再用 range/time 扩展上下文。"
     ),
@@ -159,7 +202,7 @@ tool_registry.register(Tool(
         "properties": {
             "mode": {
                 "type": "string",
-                "enum": ["keywords", "range", "time"],
+                "enum": ["keywords", "semantic", "range", "time"],
                 "description": "查询模式",
             },
             "keywords": {
@@ -167,6 +210,10 @@ tool_registry.register(Tool(
                 "items": {"type": "string"},
                 "description": "mode=keywords 时的搜索关键词",
             },
+            "query": {
+                "type": "string",
+                "description": "mode=semantic 时用一句话描述要找的内容",
+            },
             "start_offset": {
                 "type": "integer",
                 "description": "mode=range 时的起始偏移（从最新消息倒数）",
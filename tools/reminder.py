@@ -6,6 +6,7 @@ LLM 直接传入结构化参数，不再需要二级路由或二次 AI 解析。
 import json
 from datetime import datetime
 
+from function.func_cancel import check_cancelled
 from tools import Tool, tool_registry
 
 
@@ -60,6 +61,7 @@ def _handle_reminder_create(ctx, type: str = "once", time: str = "",
         data["weekday"] = weekday
 
     roomid = ctx.msg.roomid if ctx.is_group else None
+    check_cancelled()
     success, result = ctx.robot.reminder_manager.add_reminder(ctx.msg.sender, data, roomid=roomid)
 
     if success:
@@ -88,12 +90,14 @@ def _handle_reminder_delete(ctx, reminder_id: str = "", delete_all: bool = False
         return json.dumps({"error": "提醒管理器未初始化"}, ensure_ascii=False)
 
     if delete_all:
+        check_cancelled()
         success, message, count = ctx.robot.reminder_manager.delete_all_reminders(ctx.msg.sender)
         return json.dumps({"success": success, "message": message, "deleted_count": count}, ensure_ascii=False)
 
     if not reminder_id:
         return json.dumps({"error": "请提供 reminder_id，或设置 delete_all=true 删除全部"}, ensure_ascii=False)
 
+    check_cancelled()
     success, message = ctx.robot.reminder_manager.delete_reminder(ctx.msg.sender, reminder_id)
     return json.dumps({"success": success, "message": message}, ensure_ascii=False)
 
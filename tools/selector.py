@@ -0,0 +1,170 @@
+"""
+工具裁剪 —— 按会话配置和消息内容决定本次提供给模型哪些工具。
+
+每个工具的 schema 都要随请求发送，完整列表约数百 token，而大多数消息只是闲聊。
+这里在本地做两步廉价的筛选：
+1. 会话白名单：groups.models 的 mapping / private_mapping 中可以用 tools 指定该会话可用的工具，
+   结果在同一会话内不变，系统提示中的工具指引也按白名单生成；
+2. 意图预筛（默认关闭，agent.tool_filter.enable 开启）：为工具配置关键词正则，消息中没有相关字眼时
+   不提供该工具（例如没有提到"提醒/闹钟"就不带三个提醒工具）；没有配置关键词的工具总是保留，
+   web_search 只在消息是"哈哈""好的"这类纯应答时才省略。
+
+意图预筛会让同一会话相邻两次请求的 tools 不同，服务端的前缀缓存从工具定义处失效，
+省下的工具 token 可能抵不上失去的缓存命中，因此统计中同时记录工具集变化的次数，供开启前权衡。
+宁可多带也不要漏带：正则只用于排除"明显无关"的工具，拿不准的情况都保留。
+"""
+
+import json
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Pattern, Tuple
+
+from function.func_tokens import create_token_counter
+from tools import tool_registry
+
+logger = logging.getLogger(__name__)
+
+# 工具名 -> 相关意图的关键词；消息不匹配时省略该工具
+DEFAULT_INTENT_PATTERNS: Dict[str, str] = {
+    "reminder_create": (
+        r"提醒|闹钟|叫我|喊我|叫醒|通知我|别忘|定时|每天|每周|每晚|每早|"
+        r"\d+\s*[点:：]|[一二三四五六七八九十两]+点|分钟后|小时后|remind|alarm"
+    ),
+    "reminder_list": r"提醒|闹钟|日程|待办|remind",
+    "reminder_delete": r"提醒|闹钟|日程|待办|remind",
+    "lookup_chat_history": (
+        r"之前|以前|刚才|刚刚|上次|前面|前几天|昨天|前天|那天|上周|上个月|"
+        r"说过|聊过|提过|讲过|发过|问过|谁说|记得|记录|历史|总结|回顾|earlier|history"
+    ),
+}
+
+# 不需要任何搜索的纯应答
+_TRIVIAL_MESSAGE = re.compile(r"(哈|呵|嘿|嗯|哦|噢|啊|呀|啦|吧|的|了|好|对|行|是|赞|谢谢?|早安?|晚安|午安|在吗?|收到|ok|okay|lol|6)+")
+_PUNCTUATION = re.compile(r"[\W_]+", re.UNICODE)
+
+MAX_TRACKED_CHATS = 1024  # 记录上一次工具集的会话数上限
+
+
+class ToolSelector:
+    """按会话白名单与消息意图选择工具，并统计省下的 prompt token。"""
+
+    def __init__(self, registry: Any, patterns: Optional[Dict[str, str]] = None):
+        self.registry = registry
+        self.enabled = False  # 意图预筛开关，会话白名单始终生效
+        self._patterns: Dict[str, Pattern] = {}
+        self.set_patterns(DEFAULT_INTENT_PATTERNS if patterns is None else patterns)
+        self._counter = None
+        self._token_cache: Dict[str, int] = {}
+        self._token_source: Optional[List[dict]] = None
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._full_tokens = 0
+        self._saved_tokens = 0
+        self._last_selection: "OrderedDict[str, Tuple[str, ...]]" = OrderedDict()
+        self._selection_changes = 0  # 与同一会话上一次请求工具集不同的次数
+
+    def set_patterns(self, patterns: Dict[str, str]) -> None:
+        compiled = {}
+        for tool_name, pattern in patterns.items():
+            if not pattern:
+                continue
+            try:
+                compiled[tool_name] = re.compile(pattern, re.IGNORECASE)
+            except re.error as e:
+                logger.warning(f"工具 {tool_name} 的意图关键词无效，已忽略: {e}")
+        self._patterns = compiled
+
+    def configure(self, config: Optional[dict]) -> None:
+        """从配置更新开关与关键词。
+
+        config 示例: {"enable": true, "keywords": {"web_search": "搜索|查一下"}}，
+        关键词为空字符串表示该工具不做意图预筛。
+        """
+        if not isinstance(config, dict):
+            return
+        self.enabled = bool(config.get("enable", False))
+        patterns = dict(DEFAULT_INTENT_PATTERNS)
+        patterns.update(config.get("keywords") or {})
+        self.set_patterns(patterns)
+
+    def allowed_names(self, ctx: Any) -> List[str]:
+        """会话白名单内的全部工具名，只取决于会话配置，不随消息内容变化"""
+        allowed = getattr(ctx, "allowed_tools", None)
+        return [name for name in self.registry.get_tool_names() if allowed is None or name in allowed]
+
+    def select(self, ctx: Any) -> List[dict]:
+        """返回本条消息应提供给模型的工具 schema 列表（可能为空）"""
+        full = self.registry.get_openai_tools()
+        if not full:
+            return full
+        names = self.allowed_names(ctx)
+        if self.enabled:
+            text = getattr(ctx, "text", "") or ""
+            names = [name for name in names if self._is_relevant(name, text)]
+        selected = self.registry.get_openai_tools_for(names)
+        get_receiver = getattr(ctx, "get_receiver", None)
+        self._record(full, names, get_receiver() if get_receiver else None)
+        return selected
+
+    def _is_relevant(self, tool_name: str, text: str) -> bool:
+        pattern = self._patterns.get(tool_name)
+        if pattern is not None:
+            return pattern.search(text) is not None
+        if tool_name == "web_search":
+            stripped = _PUNCTUATION.sub("", text).casefold()
+            return len(stripped) >= 2 and not _TRIVIAL_MESSAGE.fullmatch(stripped)
+        return True
+
+    # ---- 统计 ----
+
+    def _record(self, full: List[dict], names: List[str], chat_id: Optional[str]) -> None:
+        with self._lock:
+            if self._token_source is not full:
+                # 工具列表变化（新注册了工具）后重新计数
+                if self._counter is None:
+                    self._counter = create_token_counter()
+                self._token_cache = {
+                    schema["function"]["name"]: self._counter.count(json.dumps(schema, ensure_ascii=False))
+                    for schema in full
+                }
+                self._token_source = full
+            full_tokens = sum(self._token_cache.values())
+            kept_tokens = sum(self._token_cache.get(name, 0) for name in names)
+            self._requests += 1
+            self._full_tokens += full_tokens
+            self._saved_tokens += full_tokens - kept_tokens
+            if chat_id is not None:
+                selection = tuple(names)
+                previous = self._last_selection.pop(chat_id, None)
+                if previous is not None and previous != selection:
+                    self._selection_changes += 1
+                self._last_selection[chat_id] = selection
+                while len(self._last_selection) > MAX_TRACKED_CHATS:
+                    self._last_selection.popitem(last=False)
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            requests, full_tokens, saved_tokens = self._requests, self._full_tokens, self._saved_tokens
+            changes = self._selection_changes
+        return {
+            "requests": requests,
+            "avg_saved_tokens": saved_tokens / requests if requests else 0.0,
+            "saved_ratio": saved_tokens / full_tokens if full_tokens else 0.0,
+            "selection_changes": changes,
+        }
+
+    def log_stats(self) -> None:
+        stats = self.get_stats()
+        if not stats["requests"]:
+            return
+        logger.info(
+            f"工具裁剪: {stats['requests']} 次请求，平均每次节省 {stats['avg_saved_tokens']:.0f} 个工具定义 token"
+            f"（{stats['saved_ratio']:.1%}）；其中 {stats['selection_changes']} 次工具集与该会话上一次请求不同，"
+            f"这些请求的服务端前缀缓存从工具定义处失效"
+        )
+
+
+# ── 全局工具选择器 ──────────────────────────────────────────
+tool_selector = ToolSelector(tool_registry)
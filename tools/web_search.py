@@ -1,15 +1,34 @@
 """网络搜索工具 —— 通过 Perplexity 联网搜索。
 
-直接调用 perplexity.get_answer() 获取同步结果，
-结果回传给 LLM 做综合回答，而非直接发送给用户。
+直接调用 perplexity.get_answer() 获取同步结果（asyncio 运行时下使用
+get_answer_async()），结果回传给 LLM 做综合回答，而非直接发送给用户。
+Robot 配置了 search_cache 时先查持久化缓存，命中则不再调用 Perplexity。
 """
 
+import asyncio
 import json
 import re
 
+from function.func_cancel import ToolCancelled
+from function.func_search_cache import is_error_response
 from tools import Tool, tool_registry
 
 
+def _format_search_result(response) -> str:
+    if not response:
+        return json.dumps({"error": "搜索无结果"}, ensure_ascii=False)
+    if is_error_response(response):
+        # 超时和接口错误以 error 返回，既让模型知道搜索失败，也不会被 tool_cache 当作结果缓存
+        return json.dumps({"error": f"搜索失败: {response}"}, ensure_ascii=False)
+
+    # 清理 <think> 标签（reasoning 模型可能返回）
+    cleaned = re.sub(r"<think>.*?</think>", "", response, flags=re.DOTALL).strip()
+    if not cleaned:
+        cleaned = response
+
+    return json.dumps({"result": cleaned}, ensure_ascii=False)
+
+
 def _handle_web_search(ctx, query: str = "", deep_research: bool = False, **_) -> str:
     if not query:
         return json.dumps({"error": "请提供搜索关键词"}, ensure_ascii=False)
@@ -19,19 +38,43 @@ def _handle_web_search(ctx, query: str = "", deep_research: bool = False, **_) -
         return json.dumps({"error": "Perplexity 搜索功能不可用，未配置或未初始化"}, ensure_ascii=False)
 
     try:
-        chat_id = ctx.get_receiver()
-        response = perplexity_instance.get_answer(query, chat_id, deep_research=deep_research)
+        search_cache = getattr(ctx.robot, "search_cache", None)
+        response = search_cache.get(query, deep_research) if search_cache else None
+        if response is None:
+            chat_id = ctx.get_receiver()
+            response = perplexity_instance.get_answer(query, chat_id, deep_research=deep_research)
+            if search_cache:
+                search_cache.put(query, deep_research, response)
+        return _format_search_result(response)
 
-        if not response:
-            return json.dumps({"error": "搜索无结果"}, ensure_ascii=False)
+    except ToolCancelled:
+        raise
+    except Exception as e:
+        return json.dumps({"error": f"搜索失败: {e}"}, ensure_ascii=False)
 
-        # 清理 <think> 标签（reasoning 模型可能返回）
-        cleaned = re.sub(r"<think>.*?</think>", "", response, flags=re.DOTALL).strip()
-        if not cleaned:
-            cleaned = response
 
-        return json.dumps({"result": cleaned}, ensure_ascii=False)
+async def _handle_web_search_async(ctx, query: str = "", deep_research: bool = False, **_) -> str:
+    if not query:
+        return json.dumps({"error": "请提供搜索关键词"}, ensure_ascii=False)
+
+    perplexity_instance = getattr(ctx.robot, "perplexity", None)
+    if not perplexity_instance:
+        return json.dumps({"error": "Perplexity 搜索功能不可用，未配置或未初始化"}, ensure_ascii=False)
+    if not hasattr(perplexity_instance, "get_answer_async"):
+        return await asyncio.to_thread(_handle_web_search, ctx, query=query, deep_research=deep_research)
+
+    try:
+        search_cache = getattr(ctx.robot, "search_cache", None)
+        response = await asyncio.to_thread(search_cache.get, query, deep_research) if search_cache else None
+        if response is None:
+            chat_id = ctx.get_receiver()
+            response = await perplexity_instance.get_answer_async(query, chat_id, deep_research=deep_research)
+            if search_cache:
+                await asyncio.to_thread(search_cache.put, query, deep_research, response)
+        return _format_search_result(response)
 
+    except ToolCancelled:
+        raise
     except Exception as e:
         return json.dumps({"error": f"搜索失败: {e}"}, ensure_ascii=False)
 
@@ -43,6 +86,7 @@ tool_registry.register(Tool(
         "deep_research 仅在问题非常复杂、需要深度研究时才开启。"
     ),
     status_text="正在联网搜索: ",
+    status_args=("query",),
     parameters={
         "type": "object",
         "properties": {
@@ -59,4 +103,38 @@ tool_registry.register(Tool(
         "additionalProperties": False,
     },
     handler=_handle_web_search,
+    async_handler=_handle_web_search_async,
 ))
+
+
+if __name__ == "__main__":
+    # 自检：web_search 超时/接口错误的结果不能被缓存并提供给其他会话
+    # 用法: python -m tools.web_search
+    from types import SimpleNamespace
+
+    from tools.cache import tool_cache
+
+    class FlakyPerplexity:
+        def __init__(self):
+            self.calls = 0
+
+        def get_answer(self, query, chat_id, deep_research=False):
+            self.calls += 1
+            return "发生错误: Request timed out." if self.calls == 1 else f"{query} 的搜索结果"
+
+    perplexity = FlakyPerplexity()
+    robot = SimpleNamespace(perplexity=perplexity, search_cache=None)
+
+    def make_ctx(chat_id, sender):
+        return SimpleNamespace(robot=robot, msg=SimpleNamespace(sender=sender), get_receiver=lambda: chat_id)
+
+    tool_cache.clear()
+    arguments = {"query": "今天北京天气"}
+    first = json.loads(tool_registry.create_handler(make_ctx("room-a", "alice"))("web_search", arguments))
+    assert "error" in first, first
+    second = json.loads(tool_registry.create_handler(make_ctx("room-b", "bob"))("web_search", arguments))
+    assert second == {"result": "今天北京天气 的搜索结果"}, second
+    assert perplexity.calls == 2, perplexity.calls
+    third = json.loads(tool_registry.create_handler(make_ctx("room-c", "carol"))("web_search", arguments))
+    assert third == second and perplexity.calls == 2, (third, perplexity.calls)
+    print("ok: 搜索失败的结果未被缓存，成功结果在会话间共享")